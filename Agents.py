@@ -7,29 +7,159 @@ Created on Fri Feb 28 19:41:28 2025
 """
 
 import base64
-from openai import OpenAI
-import os
+import threading
+import time
+
+from llm_backends import get_backend
+from llm_scheduler import get_scheduler, estimate_message_tokens
+
+
+DEFAULT_MODEL = "chatgpt-4o-latest"
+
+# 每个 agent 使用的模型：类名 -> 模型名，没有列出的 agent 使用 DEFAULT_MODEL
+AGENT_MODELS = {}
+
+HISTORY_TOKEN_LIMIT = 2000  # 有状态 agent 每次发送的对话历史（含本轮消息，不含系统提示）的 token 上限（估算）
+EARLIER_INPUTS = 10  # 压缩早期对话时最多保留的用户输入条数
+EARLIER_INPUT_CHARS = 200  # 压缩早期对话时每条用户输入保留的字数
+
+# 已加载的提示词文件缓存：文件路径 -> 文件内容
+_prompt_cache = {}
+_prompt_lock = threading.Lock()
+
+
+def model_for(agent_class) -> str:
+    """返回某个 agent 类配置的模型名（按类名在 AGENT_MODELS 中查找，沿继承链向上）。"""
+    for cls in agent_class.__mro__:
+        if cls.__name__ in AGENT_MODELS:
+            return AGENT_MODELS[cls.__name__]
+    return DEFAULT_MODEL
+
+
+def load_prompt(filepath: str) -> str:
+    """从指定文件中加载系统提示信息，每个文件只读取一次。"""
+    with _prompt_lock:
+        if filepath in _prompt_cache:
+            return _prompt_cache[filepath]
+    try:
+        with open(filepath, "r", encoding="utf-8") as file:
+            prompt = file.read()
+    except Exception as e:
+        # 读取失败时不缓存，下次再试
+        print(f"加载系统消息失败：{e}")
+        return "默认系统提示信息"
+    with _prompt_lock:
+        _prompt_cache[filepath] = prompt
+    return prompt
+
+
+class LLMAgent:
+    """
+    所有 agent 的公共实现：可替换的后端（llm_backends，默认调用 OpenAI）+ 缓存的系统提示词，
+    所有请求经过按模型共用的限流和重试调度器（llm_scheduler）。
+    model 为 None 时使用 AGENT_MODELS 中为该 agent 配置的模型，backend 为 None 时使用默认后端（见 llm_backends.set_backend）。
+    默认每次调用都是无状态的（只发送系统提示和本次 query），无需重置对话历史，
+    也可以反复复用同一个实例；stateful 为 True 时保留多轮对话历史（Coordinator 使用）。
+    有状态时对话历史不超过 history_limit 个 token（估算）：超出时最早的轮次移出历史，
+    其中的用户输入压缩成一条摘要放在系统提示之后，因此多轮澄清时每次请求的大小和延迟不会持续增长。
+    turn_usage 记录有状态时每一轮的 token 用量、发送的历史轮数和耗时。
+    """
+    exit_message = None  # 收到 'exit' 时直接返回的消息，None 表示不处理
+
+    def __init__(self, prompt_filepath: str, model: str = None, stateful: bool = False, backend=None,
+                 history_limit: int = HISTORY_TOKEN_LIMIT):
+        self.backend = backend if backend is not None else get_backend()
+        self.model = model or model_for(type(self))
+        self.stateful = stateful
+        self.history_limit = history_limit
+        self.system_prompt = load_prompt(prompt_filepath)
+        # 对话历史，系统提示信息作为第一条消息；无状态模式下不会增长
+        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+        self.earlier_inputs = []  # 已移出对话历史的用户输入（截断后），最多 EARLIER_INPUTS 条
+        self.turn_usage = []
 
+    @staticmethod
+    def load_system_prompt(filepath: str) -> str:
+        """从指定文件中加载系统提示信息。"""
+        return load_prompt(filepath)
+
+    @staticmethod
+    def message_text(message) -> str:
+        """取出一条消息中的文本（图片等非文本部分忽略）。"""
+        content = message.get("content")
+        if isinstance(content, list):
+            return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+        return str(content or "")
+
+    def trim_history(self, message):
+        """把最早的轮次移出对话历史，直到历史加上本轮消息不超过 history_limit；移出的用户输入记入 earlier_inputs。"""
+        history = self.conversation_history
+        while len(history) > 1 and estimate_message_tokens(history[1:] + [message], 0) > self.history_limit:
+            # 历史按 (用户, 助手) 成对保存，整轮移出
+            turn, history[1:3] = history[1:3], []
+            for old in turn:
+                if old["role"] == "user":
+                    self.earlier_inputs.append(self.message_text(old)[:EARLIER_INPUT_CHARS])
+        del self.earlier_inputs[:-EARLIER_INPUTS]
+
+    def history_messages(self, message):
+        """有状态时本轮发送的消息：系统提示、早期用户输入的摘要（如有）、最近的对话历史和本轮消息。"""
+        self.trim_history(message)
+        messages = self.conversation_history[:1]
+        if self.earlier_inputs:
+            summary = "\n".join(f"- {text}" for text in self.earlier_inputs)
+            messages.append({"role": "system", "content": f"此前对话中用户提供过的信息（已压缩）：\n{summary}"})
+        return messages + self.conversation_history[1:] + [message]
+
+    def complete(self, content) -> str:
+        """
+        发送一条用户消息并返回模型回复；有状态时把这一轮写入对话历史，并在 turn_usage 中记录本轮用量。
+        重试用尽或不可重试时抛出 llm_scheduler.LLMCallError 的子类，对话历史保持不变。
+        """
+        message = {"role": "user", "content": content}
+        if self.stateful:
+            messages = self.history_messages(message)
+        else:
+            messages = [self.conversation_history[0], message]
+        estimated = estimate_message_tokens(messages)
+        started = time.perf_counter()
+        response = get_scheduler(self.model).call(
+            lambda: self.backend.complete(self.model, messages),
+            estimated,
+        )
+        reply_content = response.choices[0].message.content
+        if self.stateful:
+            usage = getattr(response, "usage", None)
+            self.turn_usage.append({
+                "history_turns": (len(self.conversation_history) - 1) // 2,
+                "estimated_tokens": estimated,
+                "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                "completion_tokens": getattr(usage, "completion_tokens", None),
+                "seconds": round(time.perf_counter() - started, 3),
+            })
+            self.conversation_history.extend([message, {"role": "assistant", "content": reply_content}])
+        return reply_content
 
+    def run(self, query: str) -> str:
+        """
+        处理用户输入的 query，并返回模型回复。
+        当 query 为 'exit' 时，直接返回退出消息。调用失败时抛出 llm_scheduler.LLMCallError 的子类。
+        """
+        if self.exit_message and query.lower() == "exit":
+            return self.exit_message
+        return self.complete(query)
 
-class Coordinator:
-    def __init__(self, prompt_filepath: str):
-        # 初始化 OpenAI 客户端
-        self.client = OpenAI()
-        # 加载 operator 提示信息
-        self.operator_prompt = self.load_operator_prompt(prompt_filepath)
-        # 初始化对话历史，将系统提示信息作为第一条消息
-        self.conversation_history = [{"role": "system", "content": self.operator_prompt}]
+
+class Coordinator(LLMAgent):
+    def __init__(self, prompt_filepath: str, model: str = None, backend=None, history_limit: int = HISTORY_TOKEN_LIMIT):
+        # Coordinator 需要多轮对话来补全缺失信息，因此保留对话历史（不超过 history_limit 个 token）
+        super().__init__(prompt_filepath, model=model, stateful=True, backend=backend, history_limit=history_limit)
+        self.operator_prompt = self.system_prompt
 
     @staticmethod
     def load_operator_prompt(filepath: str) -> str:
         """从指定文件中加载 operator 提示信息。"""
-        try:
-            with open(filepath, "r", encoding="utf-8") as file:
-                return file.read()
-        except Exception as e:
-            print(f"加载系统消息失败：{e}")
-            return "默认系统提示信息"
+        return load_prompt(filepath)
 
     @staticmethod
     def encode_image(image_path: str) -> str:
@@ -49,6 +179,7 @@ class Coordinator:
             user_text: 用户输入的文本消息。
             send_image: 是否需要发送图片（默认为 False）。
             image_path: 如果 send_image 为 True，此处指定图片路径。
+        调用失败时抛出 llm_scheduler.LLMCallError 的子类。
         """
         # 构造消息内容
         if send_image and image_path:
@@ -69,136 +200,28 @@ class Coordinator:
                 message_content = [{"type": "text", "text": user_text}]
         else:
             message_content = [{"type": "text", "text": user_text}]
-        
-        # 将用户消息添加到对话历史中
-        self.conversation_history.append({"role": "user", "content": message_content})
-        
-        try:
-            # 调用 LLM 接口，传入完整的对话历史
-            response = self.client.chat.completions.create(
-                model="chatgpt-4o-latest",
-                messages=self.conversation_history,
-            )
-            reply_content = response.choices[0].message.content
-            # 将回复添加到对话历史
-            self.conversation_history.append({"role": "assistant", "content": reply_content})
-            return reply_content
-        except Exception as e:
-            return f"调用接口失败：{e}"
-        
-class SentimentAnalysistAgent:
-    def __init__(self, prompt_filepath: str):
-        # 初始化 OpenAI 客户端
-        self.client = OpenAI()
-        # 加载系统提示信息并初始化对话历史
-        sentiment_prompt = self.load_system_prompt(prompt_filepath)
-        self.conversation_history = [{"role": "system", "content": sentiment_prompt}]
 
-    @staticmethod
-    def load_system_prompt(filepath: str) -> str:
-        """从指定文件中加载系统提示信息。"""
-        try:
-            with open(filepath, "r", encoding="utf-8") as file:
-                return file.read()
-        except Exception as e:
-            print(f"加载系统消息失败：{e}")
-            return "默认系统提示信息"
+        # 调用 LLM 接口，传入完整的对话历史
+        return self.complete(message_content)
 
-    def run(self, query: str) -> str:
-        """
-        处理用户输入的 query，更新对话历史，并返回模型回复。
-        当 query 为 'exit' 时，直接返回退出消息。
-        """
-        if query.lower() == "exit":
-            return "退出 Sentiment_analysist agent."
-        
-        self.conversation_history.append({"role": "user", "content": query})
 
-        try:
-            response = self.client.chat.completions.create(
-                model="chatgpt-4o-latest",
-                messages=self.conversation_history,
-            )
-            reply_content = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": reply_content})
-            return reply_content
-        except Exception as e:
-            return f"调用接口失败：{e}"
-        
-class TopicModellingAgent:
-    def __init__(self, prompt_filepath: str):
-        # 初始化 OpenAI 客户端
-        self.client = OpenAI()
-        # 加载系统提示信息并初始化对话历史
-        topic_prompt = self.load_system_prompt(prompt_filepath)
-        self.conversation_history = [{"role": "system", "content": topic_prompt}]
+class SentimentAnalysistAgent(LLMAgent):
+    exit_message = "退出 Sentiment_analysist agent."
 
-    @staticmethod
-    def load_system_prompt(filepath: str) -> str:
-        """从指定文件中加载系统提示信息。"""
-        try:
-            with open(filepath, "r", encoding="utf-8") as file:
-                return file.read()
-        except Exception as e:
-            print(f"加载系统消息失败：{e}")
-            return "默认系统提示信息"
 
-    def run(self, query: str) -> str:
-        """
-        处理用户输入的 query，更新对话历史，并返回模型回复。
-        当 query 为 'exit' 时，直接返回退出消息。
-        """
-        if query.lower() == "exit":
-            return "退出 Topic_modelling agent."
-        
-        self.conversation_history.append({"role": "user", "content": query})
+class TopicModellingAgent(LLMAgent):
+    exit_message = "退出 Topic_modelling agent."
 
-        try:
-            response = self.client.chat.completions.create(
-                model="chatgpt-4o-latest",
-                #model = "o3_mini",
-                messages=self.conversation_history,
-            )
-            reply_content = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": reply_content})
-            return reply_content
-        except Exception as e:
-            return f"调用接口失败：{e}"
-        
-class Summarizer:
-    def __init__(self, prompt_filepath: str):
-        # 初始化 OpenAI 客户端
-        self.client = OpenAI()
-        # 加载系统提示信息并初始化对话历史
-        system_message = self.load_system_message(prompt_filepath)
-        self.conversation_history = [{"role": "system", "content": system_message}]
+
+class Summarizer(LLMAgent):
+    exit_message = "退出 Summarizer agent."
 
     @staticmethod
     def load_system_message(filepath: str) -> str:
         """从指定文件中加载系统提示信息。"""
-        try:
-            with open(filepath, "r", encoding="utf-8") as file:
-                return file.read()
-        except Exception as e:
-            print(f"加载系统消息失败：{e}")
-            return "默认系统提示信息"
+        return load_prompt(filepath)
 
-    def run(self, query: str) -> str:
-        """
-        处理用户输入的 query，更新对话历史，并返回模型回复。
-        当 query 为 'exit' 时，直接返回退出消息。
-        """
-        if query.lower() == "exit":
-            return "退出 Summarizer agent."
-        
-        self.conversation_history.append({"role": "user", "content": query})
-        try:
-            response = self.client.chat.completions.create(
-                model="chatgpt-4o-latest",
-                messages=self.conversation_history,
-            )
-            reply_content = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": reply_content})
-            return reply_content
-        except Exception as e:
-            return f"调用接口失败：{e}"
+
+class FusedAnalysisAgent(LLMAgent):
+    """一次调用同时完成情感分析和主题分析。"""
+    exit_message = "退出 Fused_analysis agent."
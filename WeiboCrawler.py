@@ -3,249 +3,1062 @@ from bs4 import BeautifulSoup as BS
 import pandas as pd
 import os
 import datetime
+import email.utils
+import gzip
+import hashlib
+import json
+import random
 import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
 
-def parse_weibo_time(time_str):
+try:
+    from lxml import html as lxml_html
+except ImportError:  # 未安装 lxml 时退回纯 Python 的 html.parser
+    lxml_html = None
+
+DEBUG_TIME_PARSE = False  # 为 True 时打印每次时间解析的前后结果（调试用，大规模爬取时请保持关闭）
+
+
+def _absolute_time(match, ref_time):
+    # "YYYY年MM月DD日 HH:MM"
+    year, month, day, hour, minute = map(int, match.groups())
+    return datetime.datetime(year, month, day, hour, minute)
+
+
+def _time_without_year(match, ref_time):
+    # "MM月DD日 HH:MM"，年份取参考时间的年份
+    month, day, hour, minute = map(int, match.groups())
+    return datetime.datetime(ref_time.year, month, day, hour, minute)
+
+
+def _reference_time(match, ref_time):
+    # "刚刚"、不带时刻的"今天"
+    return ref_time
+
+
+def _iso_datetime(match, ref_time):
+    # "YYYY-MM-DD HH:MM"
+    year, month, day, hour, minute = map(int, match.groups())
+    return datetime.datetime(year, month, day, hour, minute)
+
+
+def _iso_date(match, ref_time):
+    # "YYYY-MM-DD"
+    year, month, day = map(int, match.groups())
+    return datetime.datetime(year, month, day)
+
+
+def _today_time(match, ref_time):
+    # "今天 HH:MM"
+    hour, minute = map(int, match.groups())
+    return ref_time.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+
+def _minutes_ago(match, ref_time):
+    return ref_time - datetime.timedelta(minutes=int(match.group(1)))
+
+
+def _hours_ago(match, ref_time):
+    return ref_time - datetime.timedelta(hours=int(match.group(1)))
+
+
+# 时间格式分派表：按顺序尝试，第一个匹配且能构造出合法时间的规则生效。
+# 每项为 (预编译正则, 匹配方式, 构造函数)；'search' 在字符串任意位置匹配，'fullmatch' 要求整串匹配。
+TIME_RULES = [
+    (re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})日\s*(\d{1,2}):(\d{1,2})'), 'search', _absolute_time),
+    (re.compile(r'(\d{1,2})月(\d{1,2})日\s*(\d{1,2}):(\d{1,2})'), 'search', _time_without_year),
+    (re.compile(r'刚刚'), 'search', _reference_time),
+    (re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})\s+(\d{1,2}):(\d{1,2})'), 'fullmatch', _iso_datetime),
+    (re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'), 'fullmatch', _iso_date),
+    (re.compile(r'今天\s+(\d{1,2}):(\d{1,2})'), 'search', _today_time),
+    (re.compile(r'今天'), 'search', _reference_time),
+    (re.compile(r'(\d+)\s*分钟前'), 'search', _minutes_ago),
+    (re.compile(r'(\d+)\s*小时前'), 'search', _hours_ago),
+]
+
+
+def parse_weibo_time(time_str, ref_time=None):
     """
     尝试将微博发布时间字符串解析成 datetime 对象。
     支持格式：
       1) "YYYY年MM月DD日 HH:MM"  (例如 "2022年03月14日 00:57")
-      2) "刚刚"
-      3) "YYYY-MM-DD HH:MM"
-      4) "YYYY-MM-DD"
-      5) "今天 HH:MM"
-      6) "xx分钟前"
-      7) "xx小时前"
-
-    如果都无法匹配，返回 None。
-    """
-
-    # 打印传入的字符串 - 调试用
-    print(f"【parse_weibo_time】 解析前: {time_str}")
-
-    # ---------- 1) 匹配 "YYYY年MM月DD日 HH:MM" ----------
-    match = re.search(r'(\d{4})年(\d{1,2})月(\d{1,2})日\s*(\d{1,2}):(\d{1,2})', time_str)
-    if match:
-        year = int(match.group(1))
-        month = int(match.group(2))
-        day = int(match.group(3))
-        hour = int(match.group(4))
-        minute = int(match.group(5))
-        dt = datetime.datetime(year, month, day, hour, minute)
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-
-    # ---------- 2) 匹配 "MM月DD日 HH:MM" 格式（无年份）----------
-    match = re.search(r'(\d{1,2})月(\d{1,2})日\s*(\d{1,2}):(\d{1,2})', time_str)
-    if match:
-        current_year = datetime.datetime.now().year  # 默认使用当前年份
-        month = int(match.group(1))
-        day = int(match.group(2))
-        hour = int(match.group(3))
-        minute = int(match.group(4))
-        dt = datetime.datetime(current_year, month, day, hour, minute)
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-
-    # ---------- 3) 处理“刚刚” ----------
-    if '刚刚' in time_str:
-        dt = datetime.datetime.now()
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-
-    # ---------- 4) 优先解析 "YYYY-MM-DD HH:MM" ----------
-    try:
-        dt = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M')
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-    except:
-        pass
-
-    # ---------- 5) 再解析 "YYYY-MM-DD" ----------
-    try:
-        dt = datetime.datetime.strptime(time_str, '%Y-%m-%d')
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-    except:
-        pass
-
-    # ---------- 6) 处理“今天 HH:MM” ----------
-    if '今天' in time_str:
-        match = re.search(r'今天\s+(\d{1,2}):(\d{1,2})', time_str)
-        if match:
-            hour = int(match.group(1))
-            minute = int(match.group(2))
-            now = datetime.datetime.now()
-            dt = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-            print(f"【parse_weibo_time】 解析后: {dt}")
-            return dt
-        else:
-            dt = datetime.datetime.now()
-            print(f"【parse_weibo_time】 解析后: {dt}")
-            return dt
-
-    # ---------- 7) 处理“xx分钟前” ----------
-    match = re.search(r'(\d+)\s*分钟前', time_str)
-    if match:
-        minutes_ago = int(match.group(1))
-        dt = datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-
-    # ---------- 8) 处理“xx小时前” ----------
-    match = re.search(r'(\d+)\s*小时前', time_str)
-    if match:
-        hours_ago = int(match.group(1))
-        dt = datetime.datetime.now() - datetime.timedelta(hours=hours_ago)
-        print(f"【parse_weibo_time】 解析后: {dt}")
-        return dt
-
-    # ---------- 最后都没匹配到 ----------
-    print("【parse_weibo_time】 解析后: None (未知格式)")
-    return None
+      2) "MM月DD日 HH:MM"（年份取参考时间的年份）
+      3) "刚刚"
+      4) "YYYY-MM-DD HH:MM"
+      5) "YYYY-MM-DD"
+      6) "今天 HH:MM"
+      7) "xx分钟前"
+      8) "xx小时前"
+
+    相对时间（刚刚、今天、xx分钟前等）以 ref_time 为基准解析，
+    ref_time 为 None 时使用当前时间。如果都无法匹配，返回 None。
+    """
+    if ref_time is None:
+        ref_time = datetime.datetime.now()
+
+    dt = None
+    for pattern, method, build in TIME_RULES:
+        match = getattr(pattern, method)(time_str)
+        if match is None:
+            continue
+        try:
+            dt = build(match, ref_time)
+            break
+        except ValueError:
+            # 数值越界（例如 13 月），继续尝试后面的规则
+            continue
+
+    if DEBUG_TIME_PARSE:
+        print(f"【parse_weibo_time】 解析前: {time_str} 解析后: {dt}")
+    return dt
+
+
+def parse_weibo_times(times, ref_time=None):
+    """
+    parse_weibo_time 的批量版本：对一列时间字符串解析，返回 datetime64 的 pd.Series
+    （索引与输入一致），无法解析的为 NaT。
+    微博发布时间精确到分钟，同一列中大量重复，因此先 factorize 去重，
+    每个不同的字符串只解析一次，再按编码整体映射回原列。
+    """
+    if ref_time is None:
+        ref_time = datetime.datetime.now()
+    times = pd.Series(times)
+    codes, uniques = pd.factorize(times)
+    parsed = pd.to_datetime(pd.Series([parse_weibo_time(str(value), ref_time) for value in uniques],
+                                      dtype='object'))
+    # factorize 把缺失值编码为 -1，对应 NaT
+    values = parsed.reindex(codes).to_numpy()
+    return pd.Series(values, index=times.index, dtype='datetime64[ns]')
+
+
+def parse_csv_times(csv_file, column='发布时间', ref_time=None):
+    """读取已有的微博数据 CSV，批量解析 column 列，返回增加了 '<column>_解析' 列的 DataFrame。"""
+    df = pd.read_csv(csv_file, encoding='utf_8_sig')
+    df[column + '_解析'] = parse_weibo_times(df[column], ref_time)
+    return df
+
+
+SEARCH_URL = 'https://s.weibo.com/weibo'  # 请求地址是微博搜索地址
+MAX_PAGES = 49  # 微博搜索结果最多翻页数
+TIME_FORMAT = '%Y-%m-%d-%H'  # timescope 参数的时间格式，最小粒度为 1 小时
+PARSER_ENGINE = 'lxml'  # 搜索结果页的解析引擎：'lxml'（C 实现，较快）或 'html.parser'
+
+# 请求头（cookie 需替换为自己的微博登录 cookie）
+HEADERS = {
+    'accept':'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'accept-encoding':'gzip, deflate, br, zstd',
+    'accept-language':'zh-CN,zh;q=0.9,en;q=0.8',
+    'cookie':'SCF=AiYg3qAhnhJO4uYLpBc4UArOXovMlWHz4OnPneKvDpKTqUF3alcrtur8chfG2MxfQa70AsaFoADkYsGP3EHwq5s.; SUB=_2A25K_EDmDeRhGeFJ6VES9yfJwjWIHXVmcNwurDV8PUNbmtANLW6kkW9NfHC1nHHDqQWZdAnHZVyKqOIbTyDbyWJ_; SUBP=0033WrSXqPxfM725Ws9jqgMF55529P9D9WF_Rv7BfUnz3p_uhvisZn745JpX5KzhUgL.FoMNeoe0S0.f1K.2dJLoI77peoeXSKqNPcfadgYt; ALF=02_1746910646; _s_tentry=weibo.com; Apache=2379876944449.6523.1744318670381; SINAGLOBAL=2379876944449.6523.1744318670381; ULV=1744318670396:1:1:1:2379876944449.6523.1744318670381:',
+    'priority':'u=0, i',
+    'referer':'https://s.weibo.com/weibo?',
+    'sec-ch-ua':'"Not(A:Brand";v="99", "Google Chrome";v="133", "Chromium";v="133"',
+    'sec-ch-ua-mobile':'?0',
+    'sec-ch-ua-platform':'"Windows"',
+    'sec-fetch-dest':'document',
+    'sec-fetch-mode':'navigate',
+    'sec-fetch-site':'same-origin',
+    'sec-fetch-user':'?1',
+    'upgrade-insecure-requests':'1',
+    'user-agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36'}
+
+REQUEST_TIMEOUT = (5, 20)  # (连接超时, 读取超时)，单位秒
+MAX_RETRIES = 4  # 单页最多重试次数
+MAX_CONSECUTIVE_FAILURES = 3  # 一个时间段连续失败这么多页后停止翻页（通常是被封禁或服务中断）
+BACKOFF_BASE = 1.0  # 指数退避的基数（秒）
+BACKOFF_MAX = 60.0  # 单次重试等待的上限（秒）
+RETRY_STATUS = {429, 500, 502, 503, 504}  # 值得重试的 HTTP 状态码
+# 值得重试的传输层错误：超时、连接中断、响应体传输或解码中途出错
+RETRY_ERRORS = (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ContentDecodingError)
+POOL_SIZE = 16  # 连接池大小，应不小于并发爬取的 max_workers
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    """单页请求最终失败（重试用尽或不可重试的响应）。"""
+
+
+class CacheMiss(Exception):
+    """离线重放时，所需的页不在页面缓存中。"""
+
+
+class HostPacer:
+    """
+    按 host 控制请求节奏：同一 host 的两次请求之间至少间隔 min_interval 秒。
+    线程安全，供并发爬取时所有 worker 共享，避免请求过密被封。
+    """
+
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = {}  # host -> 下一次允许发请求的时间点(monotonic)
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def get_session():
+    """
+    返回进程内共享的 requests.Session（首次调用时创建）。
+    Session 复用 keep-alive 连接池，跨页、跨时间段的请求不再重复 TLS 握手，
+    请求头也只在创建时设置一次。
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(HEADERS)
+                _session = session
+    return _session
+
+
+def _retry_delay(attempt, response=None):
+    """计算第 attempt 次重试前的等待秒数：优先遵循 Retry-After，否则指数退避加随机抖动。"""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except ValueError:
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                    delay = (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds()
+                    return min(max(delay, 0), BACKOFF_MAX)
+                except (TypeError, ValueError):
+                    pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def search_params(v_keyword, v_start_time, v_end_time, page):
+    """构造一页微博搜索的请求参数。"""
+    # 请求参数(在Network中）
+    # 此时需要weibo网页点击下一页，让信息加载出来，在All下方第一条Payload中查看参数）
+    return {
+        'q':v_keyword,
+        'typeall':1,
+        'suball':1,
+        'timescope':'custom:{}:{}'.format(v_start_time, v_end_time),
+        'Refer':'g',
+        'page':page,
+    }
+
+
+def fetch_page(v_keyword, v_start_time, v_end_time, page, pacer=None):
+    """
+    请求一页微博搜索结果，返回页面 HTML 文本。
+    超时、连接错误、响应传输中断（RETRY_ERRORS）以及 429/5xx 响应会按指数退避重试 MAX_RETRIES 次；
+    重试用尽、遇到其它 4xx 响应或其它 requests 异常（例如重定向过多、URL 无效）时抛出 FetchError，
+    由调用方记录为失败页，而不是让原始异常中断整个爬取。
+    """
+    params = search_params(v_keyword, v_start_time, v_end_time, page)
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        if pacer is not None:
+            pacer.wait(SEARCH_URL)
+        response = None
+        try:
+            # 发送请求
+            response = session.get(SEARCH_URL, params=params, timeout=REQUEST_TIMEOUT)
+            print(response.status_code)
+            if response.status_code == 200:
+                return response.text
+            reason = 'HTTP {}'.format(response.status_code)
+            if response.status_code not in RETRY_STATUS:
+                raise FetchError(reason)
+        except RETRY_ERRORS as e:
+            reason = '{}: {}'.format(type(e).__name__, e)
+        except requests.RequestException as e:
+            raise FetchError('{}: {}'.format(type(e).__name__, e)) from e
+
+        if attempt < MAX_RETRIES:
+            delay = _retry_delay(attempt, response)
+            print(f'第 {page} 页请求失败（{reason}），{delay:.1f} 秒后第 {attempt + 1} 次重试')
+            time.sleep(delay)
+    raise FetchError(reason)
+
+
+def record_failed_page(v_result_file, v_keyword, v_start_time, v_end_time, page, reason):
+    """把请求失败的页记录到结果文件旁的 *_failed.csv，供之后 refetch_failed_pages 补爬。"""
+    failed_file = failed_pages_file(v_result_file)
+    df = pd.DataFrame([{
+        '关键词': v_keyword,
+        '开始时间': v_start_time,
+        '结束时间': v_end_time,
+        '页码': page,
+        '失败原因': reason,
+    }])
+    append_to_csv(df, failed_file)
+    print(f'第 {page} 页请求失败，已记录到 {failed_file}：{reason}')
+
+
+def failed_pages_file(v_result_file):
+    """结果文件对应的失败页记录文件名，例如 微博数据_xxx.csv -> 微博数据_xxx_failed.csv。"""
+    root, ext = os.path.splitext(v_result_file)
+    return '{}_failed{}'.format(root, ext)
+
+
+def _has_class(element, class_name):
+    """lxml 元素的 class 属性中是否包含 class_name（与 BeautifulSoup 的多值 class 匹配一致）。"""
+    return class_name in (element.get('class') or '').split()
+
+
+def _extract_feed_items_bs4(html):
+    """html.parser 引擎：纯 Python 解析整页，作为参考实现。"""
+    soup = BS(html, 'html.parser')
+    item_list = soup.find_all('div', {'action-type': 'feed_list_item'})
+    has_next = soup.find('a', {'class': 'next'}) is not None
+
+    records = []
+    for item in item_list:
+        content = item.find('p', {'node-type': 'feed_list_content'})
+        content_full = item.find('p', {'node-type': 'feed_list_content_full'})
+        from_div = item.find('div', {'class': 'from'})
+        card_act = item.find('div', {'class': 'card-act'})
+        # 判断是否有“全文”
+        text_node = content_full if content_full else content
+        records.append((
+            item.get('mid') or None,
+            content.get('nick-name') if content is not None else None,
+            from_div.text.strip() if from_div is not None else None,
+            text_node.text.strip() if text_node is not None else None,
+            [li.text.strip() for li in card_act.find_all('li')] if card_act is not None else None,
+        ))
+    return records, has_next
+
+
+def _extract_feed_items_lxml(html):
+    """
+    lxml 引擎：由 libxml2（C 实现）解析页面，Python 侧只遍历 feed 节点，
+    每条微博只做一次子树遍历，取出所需字段（均取文档顺序中的第一个匹配节点）。
+    """
+    if not html.strip():
+        return [], False
+    root = lxml_html.document_fromstring(html)
+    item_list = root.xpath('//div[@action-type="feed_list_item"]')
+    has_next = bool(root.xpath('//a[contains(concat(" ", normalize-space(@class), " "), " next ")]'))
+
+    records = []
+    for item in item_list:
+        content = content_full = from_div = card_act = None
+        for element in item.iter('p', 'div'):
+            if element.tag == 'p':
+                node_type = element.get('node-type')
+                if node_type == 'feed_list_content' and content is None:
+                    content = element
+                elif node_type == 'feed_list_content_full' and content_full is None:
+                    content_full = element
+            elif from_div is None and _has_class(element, 'from'):
+                from_div = element
+            elif card_act is None and _has_class(element, 'card-act'):
+                card_act = element
+        # 判断是否有“全文”
+        text_node = content_full if content_full is not None else content
+        records.append((
+            item.get('mid') or None,
+            content.get('nick-name') if content is not None else None,
+            from_div.text_content().strip() if from_div is not None else None,
+            text_node.text_content().strip() if text_node is not None else None,
+            [li.text_content().strip() for li in card_act.iter('li')] if card_act is not None else None,
+        ))
+    return records, has_next
+
+
+PARSER_ENGINES = {
+    'html.parser': _extract_feed_items_bs4,
+    'lxml': _extract_feed_items_lxml,
+}
+
+
+def extract_feed_items(html, engine=None):
+    """
+    从搜索结果页提取每条微博的原始字段。
+    返回 (records, has_next)：records 中每项为 (微博 mid, 昵称, from 区域文本, 正文, 互动区各 li 文本)，
+    缺失的节点为 None；has_next 表示页面中是否有“下一页”链接。
+    engine 为 PARSER_ENGINES 中的名字，默认使用 PARSER_ENGINE。
+    """
+    engine = engine or PARSER_ENGINE
+    if engine == 'lxml' and lxml_html is None:
+        engine = 'html.parser'
+    return PARSER_ENGINES[engine](html)
+
+
+def parse_page(html, v_keyword, dt_start, dt_end, page, engine=None, ref_time=None):
+    """
+    解析一页搜索结果。
+    返回 (df, is_last_page)：df 为时间范围内且正文包含关键词的微博 DataFrame，
+    is_last_page 表示这一页没有微博或没有“下一页”链接，即搜索结果已经翻完。
+    engine 选择解析引擎（'lxml' 或 'html.parser'），两者输出一致；
+    ref_time 为解析“刚刚”“xx分钟前”等相对时间的基准时间，默认为当前时间。
+    """
+    # 解析页面
+    records, has_next = extract_feed_items(html, engine)
+    is_last_page = (not records) or not has_next
+
+    # 先在每页开头创建这些列表
+    mid_list = [] #微博ID（mid）
+    name_list = [] #微博昵称
+    create_time_list = [] #发布时间
+    source_list = [] #微博来源
+    text_list = [] #微博正文
+    repost_count_list = [] #转发数
+    comment_count_list = []  #评论数
+    like_count_list = []  #点赞数
+
+    for mid, name, from_text, text, card_act_li in records:
+        if from_text is None or text is None:
+            # 结构不完整的条目（例如广告卡片），直接跳过
+            continue
+
+        create_time_str = from_text.split('来自')[0].strip()
+        dt = parse_weibo_time(create_time_str, ref_time)
+        if (dt is None) or (dt < dt_start) or (dt > dt_end):
+            # 如果时间无效/不在范围，直接跳过
+            continue
+
+        # 只有当微博时间满足条件时，再去解析其他字段
+        try:
+            source = from_text.split('来自')[1].strip()
+        except IndexError:
+            source = '无'
+
+        # 添加过滤条件，确保正文中包含完整的关键词
+        if v_keyword not in text:
+            continue
+
+        if card_act_li is None or len(card_act_li) < 3:
+            continue
+        repost_count = card_act_li[0]
+        comment_count = card_act_li[1]
+        like_count = card_act_li[2]
+
+        # 确定这条微博在时间范围内 -> 一次性 append 到各列表
+        mid_list.append(mid)
+        name_list.append(name)
+        create_time_list.append(create_time_str)
+        source_list.append(source)
+        text_list.append(text)
+        repost_count_list.append(repost_count)
+        comment_count_list.append(comment_count)
+        like_count_list.append(like_count)
+
+        print('微博正文：', text)
+
+    df = pd.DataFrame(
+        {
+            '页码': [page] * len(name_list),
+            '微博昵称': name_list,
+            '发布时间': create_time_list,
+            '微博来源': source_list,
+            '转发数': repost_count_list,
+            '评论数': comment_count_list,
+            '点赞数': like_count_list,
+            '微博正文': text_list,
+            '微博ID': mid_list,
+        }
+    )
+    return df, is_last_page
+
+
+def append_to_csv(df, v_result_file):
+    """把一页结果追加写入 CSV，文件不存在时写表头。"""
+    if os.path.exists(v_result_file): #如果文件存在，不再设置表头
+        header = False
+    else: #否则，设置csv文件表头
+        header = True
+    df.to_csv(v_result_file, mode='a+', index=False, header=header, encoding='utf_8_sig')
 
 
 def get_weibo(v_keyword, v_start_time, v_end_time, v_result_file, ):
     # 搜索关键字，搜索起始时间，搜索截止时间，结果文件
+    crawl_windows(v_keyword, [(v_start_time, v_end_time)], v_result_file)
+
+
+class PageCache:
+    """
+    原始搜索结果页的磁盘缓存，按请求参数的哈希寻址，每页 gzip 压缩后单独存成一个文件。
+    文件内容为 JSON：{"params": 请求参数, "fetched_at": 抓取时间, "html": 页面 HTML}。
+    总大小超过 max_bytes 时按最近最少使用（文件 mtime）淘汰。线程安全。
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes = {}  # 文件路径 -> 大小
+        os.makedirs(directory, exist_ok=True)
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith('.json.gz'):
+                    path = os.path.join(root, name)
+                    self._sizes[path] = os.path.getsize(path)
+
+    @staticmethod
+    def key(params):
+        """请求参数的内容哈希，作为缓存键。"""
+        canonical = json.dumps(params, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    def get(self, params):
+        """返回 (html, fetched_at)，未命中返回 None。"""
+        path = self._path(self.key(params))
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)  # 更新 mtime，供 LRU 淘汰
+        except (OSError, ValueError):
+            return None
+        return entry['html'], datetime.datetime.fromisoformat(entry['fetched_at'])
+
+    def put(self, params, html, fetched_at):
+        path = self._path(self.key(params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'params': params, 'fetched_at': fetched_at.isoformat(), 'html': html}
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._sizes[path] = os.path.getsize(path)
+            self._evict()
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        for path in sorted(self._sizes, key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0):
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def iter_entries(self):
+        """遍历缓存中的所有页，产出 (params, html, fetched_at)。"""
+        for path in sorted(self._sizes):
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            yield entry['params'], entry['html'], datetime.datetime.fromisoformat(entry['fetched_at'])
 
+
+def crawl_page(v_keyword, v_start_time, v_end_time, page, pacer=None, ref_time=None, cache=None, offline=False):
+    """
+    爬取并解析单页（一个时间段的某一页），返回 (df, is_last_page)。ref_time 见 parse_page。
+    给定 cache 时，联网抓到的原始页面写入缓存；offline 为 True 时只从缓存读取、不发任何请求，
+    并以页面的原始抓取时间作为相对时间的基准，未命中时抛出 CacheMiss。
+    """
+    print('开始爬取[从{}到{}],第{}页'.format(v_start_time, v_end_time, page))
     # 先把字符串形式的时间转换为 datetime，用来做严格过滤
-    dt_start = datetime.datetime.strptime(v_start_time, '%Y-%m-%d-%H')
-    dt_end = datetime.datetime.strptime(v_end_time, '%Y-%m-%d-%H')
+    dt_start = datetime.datetime.strptime(v_start_time, TIME_FORMAT)
+    dt_end = datetime.datetime.strptime(v_end_time, TIME_FORMAT)
     # 如果你想把这个“结束时间”改成包含 xx:59:59，自己加一小步，如：
     # dt_end = dt_end + datetime.timedelta(hours=1) - datetime.timedelta(seconds=1)
+    if offline:
+        entry = cache.get(search_params(v_keyword, v_start_time, v_end_time, page)) if cache is not None else None
+        if entry is None:
+            raise CacheMiss('[从{}到{}] 第 {} 页不在缓存中'.format(v_start_time, v_end_time, page))
+        html, ref_time = entry
+    else:
+        html = fetch_page(v_keyword, v_start_time, v_end_time, page, pacer=pacer)
+        if cache is not None:
+            cache.put(search_params(v_keyword, v_start_time, v_end_time, page), html, datetime.datetime.now())
+    return parse_page(html, v_keyword, dt_start, dt_end, page, ref_time=ref_time)
 
 
-    for page in range(1, 50):
-        print('开始爬取[从{}到{}],第{}页'.format(v_start_time, v_end_time, page))
-        # 请求地址是微博搜索地址
-        url = 'https://s.weibo.com/weibo'
-        # 请求参数(在Network中）
-        # 此时需要weibo网页点击下一页，让信息加载出来，在All下方第一条Payload中查看参数）
-        params = {
-            'q':v_keyword,
-            'typeall':1,
-            'suball':1,
-            'timescope':'custom:{}:{}'.format(v_start_time, v_end_time),
-            'Refer':'g',
-            'page':page,
-        }
+def split_window(v_start_time, v_end_time):
+    """
+    把时间段按整点从中间一分为二，返回两个子时间段；
+    timescope 的最小粒度是 1 小时，不足 2 小时的时间段无法再拆分，返回 None。
+    """
+    dt_start = datetime.datetime.strptime(v_start_time, TIME_FORMAT)
+    dt_end = datetime.datetime.strptime(v_end_time, TIME_FORMAT)
+    hours = int((dt_end - dt_start).total_seconds() // 3600)
+    if hours < 2:
+        return None
+    v_mid_time = (dt_start + datetime.timedelta(hours=hours // 2)).strftime(TIME_FORMAT)
+    return [(v_start_time, v_mid_time), (v_mid_time, v_end_time)]
+
+
+class CrawlCheckpoint:
+    """
+    爬取断点记录：以 JSON Lines 追加写入磁盘，每行记录一个时间段的结果，
+    进程崩溃时已写入的行不会丢失。记录两类事件：
+      - done: 时间段已爬完并写入结果文件，附带已写入的页码，即完成的 (关键词, 时间段, 页码) 单元；
+      - split: 时间段翻满页数上限，被拆分为 sub_windows。
+    重新运行时，已完成的时间段直接跳过，已拆分的时间段直接展开为子时间段。
+    """
 
-        # 请求头
-        h1 = {
-            'accept':'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'accept-encoding':'gzip, deflate, br, zstd',
-            'accept-language':'zh-CN,zh;q=0.9,en;q=0.8',
-            'cookie':'SCF=AiYg3qAhnhJO4uYLpBc4UArOXovMlWHz4OnPneKvDpKTqUF3alcrtur8chfG2MxfQa70AsaFoADkYsGP3EHwq5s.; SUB=_2A25K_EDmDeRhGeFJ6VES9yfJwjWIHXVmcNwurDV8PUNbmtANLW6kkW9NfHC1nHHDqQWZdAnHZVyKqOIbTyDbyWJ_; SUBP=0033WrSXqPxfM725Ws9jqgMF55529P9D9WF_Rv7BfUnz3p_uhvisZn745JpX5KzhUgL.FoMNeoe0S0.f1K.2dJLoI77peoeXSKqNPcfadgYt; ALF=02_1746910646; _s_tentry=weibo.com; Apache=2379876944449.6523.1744318670381; SINAGLOBAL=2379876944449.6523.1744318670381; ULV=1744318670396:1:1:1:2379876944449.6523.1744318670381:',
-            'priority':'u=0, i',
-            'referer':'https://s.weibo.com/weibo?',
-            'sec-ch-ua':'"Not(A:Brand";v="99", "Google Chrome";v="133", "Chromium";v="133"',
-            'sec-ch-ua-mobile':'?0',
-            'sec-ch-ua-platform':'"Windows"',
-            'sec-fetch-dest':'document',
-            'sec-fetch-mode':'navigate',
-            'sec-fetch-site':'same-origin',
-            'sec-fetch-user':'?1',
-            'upgrade-insecure-requests':'1',
-            'user-agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36'}
-        # 发送请求
-        r = requests.get(url, headers=h1, params=params)
-        print(r.status_code)
-
-        # 解析页面
-        soup = BS(r.text, 'html.parser')
-        item_list = soup.find_all('div', {'action-type': 'feed_list_item'})
-
-        # 先在每页开头创建这些列表
-        name_list = [] #微博昵称
-        create_time_list = [] #发布时间
-        source_list = [] #微博来源
-        text_list = [] #微博正文
-        repost_count_list = [] #转发数
-        comment_count_list = []  #评论数
-        like_count_list = []  #点赞数
-
-        for item in item_list:
-            name = item.find('p', {'node-type': 'feed_list_content'}).get('nick-name')
-
-            create_time_str = item.find('div', {'class': 'from'}).text.strip().split('来自')[0].strip()
-            dt = parse_weibo_time(create_time_str)
-            if (dt is None) or (dt < dt_start) or (dt > dt_end):
-                # 如果时间无效/不在范围，直接跳过
+    def __init__(self, path):
+        self.path = path
+        self.done = {}  # (关键词, 开始时间, 结束时间) -> 已写入的页码列表
+        self.splits = {}  # (关键词, 开始时间, 结束时间) -> 子时间段列表
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能留下不完整的最后一行，忽略即可
+                        continue
+                    key = (record['keyword'], record['start'], record['end'])
+                    if record['status'] == 'split':
+                        self.splits[key] = [tuple(window) for window in record['sub_windows']]
+                    else:
+                        self.done[key] = record['pages']
+
+    def _append(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+
+    def pending_windows(self, v_keyword, windows):
+        """过滤掉已完成的时间段，并把已拆分的时间段展开为子时间段，返回仍需爬取的时间段（保持时间顺序）。"""
+        pending = []
+        for window in windows:
+            key = (v_keyword,) + tuple(window)
+            if key in self.done:
                 continue
+            if key in self.splits:
+                pending.extend(self.pending_windows(v_keyword, self.splits[key]))
+            else:
+                pending.append(tuple(window))
+        return pending
 
-            # 只有当微博时间满足条件时，再去解析其他字段
-            try:
-                source = item.find('div', {'class': 'from'}).text.strip().split('来自')[1].strip()
-            except:
-                source = '无'
+    def mark_done(self, v_keyword, window, pages):
+        self.done[(v_keyword,) + tuple(window)] = pages
+        self._append({'keyword': v_keyword, 'start': window[0], 'end': window[1],
+                      'status': 'done', 'pages': pages})
+
+    def mark_split(self, v_keyword, window, sub_windows):
+        self.splits[(v_keyword,) + tuple(window)] = sub_windows
+        self._append({'keyword': v_keyword, 'start': window[0], 'end': window[1],
+                      'status': 'split', 'sub_windows': sub_windows})
+
+
+class DedupIndex:
+    """
+    微博去重索引：以微博 mid 为键，没有 mid 时退回到 (昵称, 正文) 的内容哈希。
+    用于过滤相邻时间段边界重叠（dt_end 同时是下一个时间段的起点）、置顶微博跨页重复、
+    以及多次运行之间重复爬到的微博。
+    给定 path 时键以追加方式持久化到磁盘，可在多次运行之间共享；
+    也可以用 load_csv 从已有结果文件恢复索引（断点续爬时结果文件本身就是最可靠的记录）。
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = set()
+        self._lock = threading.Lock()
+        self.reset_stats()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.keys.update(line.strip() for line in f if line.strip())
+
+    def reset_stats(self):
+        self.stats = {'checked': 0, 'kept': 0, 'duplicate_mid': 0, 'duplicate_hash': 0, 'cross_keyword': 0}
 
-            # 判断是否有“全文”
-            if item.find('p', {'node-type': 'feed_list_content_full'}):
-                text = item.find('p', {'node-type': 'feed_list_content_full'}).text.strip()
+    @staticmethod
+    def post_key(mid, name, text):
+        """单条微博的去重键：优先 'mid:<mid>'，否则 'sha1:<昵称+正文的哈希>'。"""
+        if isinstance(mid, str) and mid.strip():
+            return 'mid:' + mid.strip()
+        content = '{}\n{}'.format(name, ' '.join(str(text).split()))
+        return 'sha1:' + hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _keys_of(self, df):
+        mids = df['微博ID'] if '微博ID' in df else [None] * len(df)
+        return [self.post_key(mid, name, text) for mid, name, text in zip(mids, df['微博昵称'], df['微博正文'])]
+
+    def load_csv(self, csv_file):
+        """把已有结果 CSV 中的微博加入索引（不计入统计）。"""
+        if not os.path.exists(csv_file):
+            return
+        df = pd.read_csv(csv_file, encoding='utf_8_sig', dtype={'微博ID': str})
+        with self._lock:
+            self.keys.update(self._keys_of(df))
+
+    def filter(self, df, persist=True):
+        """
+        去掉 df 中已见过（包括 df 内部重复）的微博，把新微博的键加入索引，返回保留的行。
+        persist 为 False 时键只加入内存索引，调用方在保留的行写入结果文件后再用 persist() 持久化，
+        避免写入失败时键已落盘、行却丢失。
+        """
+        keep = []
+        new_keys = []
+        with self._lock:
+            for key in self._keys_of(df):
+                self.stats['checked'] += 1
+                if key in self.keys:
+                    keep.append(False)
+                    self.stats['duplicate_mid' if key.startswith('mid:') else 'duplicate_hash'] += 1
+                else:
+                    keep.append(True)
+                    self.keys.add(key)
+                    new_keys.append(key)
+            self.stats['kept'] += len(new_keys)
+            if persist:
+                self._write_keys(new_keys)
+        return df[pd.Series(keep, index=df.index, dtype=bool)]
+
+    def persist(self, df):
+        """把 df（filter(..., persist=False) 保留的行）的键追加到磁盘。"""
+        with self._lock:
+            self._write_keys(self._keys_of(df))
+
+    def _write_keys(self, keys):
+        if self.path and keys:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(keys) + '\n')
+
+    def merge_keywords(self, frames):
+        """
+        合并同一时间段内各关键词的结果：同一条微博被多个关键词搜到时只保留第一次出现的行，
+        并在 '匹配关键词' 列中记录所有搜到它的关键词（逗号分隔）。
+        frames 为 [(关键词, DataFrame), ...]，按关键词、时间、页码顺序排列。
+        合并掉的行计入统计，返回的 DataFrame 仍需经过 filter 与历史记录去重。
+        """
+        frames = [df.assign(匹配关键词=keyword) for keyword, df in frames]
+        non_empty = [df for df in frames if not df.empty]
+        if not non_empty:
+            return frames[0] if frames else pd.DataFrame()
+        combined = pd.concat(non_empty, ignore_index=True)
+        keys = pd.Series(self._keys_of(combined), index=combined.index)
+        grouped = combined.groupby(keys, sort=False)['匹配关键词']
+        tags = grouped.agg(lambda keywords: ','.join(dict.fromkeys(keywords)))
+        first_keyword = grouped.transform('first')
+        first = ~keys.duplicated()
+
+        dropped = ~first
+        with self._lock:
+            self.stats['checked'] += int(dropped.sum())
+            self.stats['cross_keyword'] += int((dropped & (combined['匹配关键词'] != first_keyword)).sum())
+            same_keyword = dropped & (combined['匹配关键词'] == first_keyword)
+            by_mid = keys[same_keyword].str.startswith('mid:')
+            self.stats['duplicate_mid'] += int(by_mid.sum())
+            self.stats['duplicate_hash'] += int((~by_mid).sum())
+
+        merged = combined[first].copy()
+        merged['匹配关键词'] = tags.reindex(keys[first]).to_numpy()
+        return merged
+
+    def report(self):
+        stats = self.stats
+        print('去重统计：检查 {} 条，保留 {} 条，按 mid 去重 {} 条，按内容哈希去重 {} 条，多关键词合并 {} 条'.format(
+            stats['checked'], stats['kept'], stats['duplicate_mid'], stats['duplicate_hash'],
+            stats['cross_keyword']))
+
+
+def checkpoint_file(v_result_file):
+    """结果文件对应的断点记录文件名，例如 微博数据_xxx.csv -> 微博数据_xxx_checkpoint.jsonl。"""
+    root, _ = os.path.splitext(v_result_file)
+    return '{}_checkpoint.jsonl'.format(root)
+
+
+def crawl_windows(v_keyword, windows, v_result_file, max_workers=1, min_interval=0.0, checkpoint=None,
+                  dedup=None, cache=None, offline=False, on_write=None):
+    """
+    爬取一个或多个关键字在多个时间段内的微博，结果写入 v_result_file。
+
+    - 每个 (关键字, 时间段) 从第 1 页开始逐页爬取，遇到最后一页（没有微博或没有“下一页”链接）即停止；
+    - 若翻满 MAX_PAGES 页、且第 MAX_PAGES 页成功返回仍未结束，说明结果被截断，丢弃已爬的页，
+      把该时间段拆成两个子时间段重新爬取，直到 1 小时的最小粒度；失败的页只记录到失败文件，不会触发拆分；
+    - 一个时间段连续 MAX_CONSECUTIVE_FAILURES 页失败时停止翻页，已成功的页照常写出，
+      但不记录为已完成，续爬时会重新爬取该时间段；
+    - 所有关键字、时间段的页作为独立任务放进同一个有界线程池（max_workers 个 worker），
+      所有 worker 共享同一个 HostPacer，同一 host 的请求间隔不小于 min_interval 秒；
+    - 一个时间段在所有关键字下都爬完后才写出，并且按时间顺序写入：前面的时间段写完后才写后面的，
+      因此输出顺序与并发度、各任务实际完成的先后无关；
+    - 同一时间段内被多个关键字搜到的微博只写一行，'匹配关键词' 列记录所有搜到它的关键字；
+    - 写入前经过去重索引过滤，已写过的微博（同一 mid 或相同内容）不会重复写入。
+
+    参数:
+        v_keyword: 搜索关键字，或关键字列表
+        windows: [(v_start_time, v_end_time), ...]，时间格式为 TIME_FORMAT
+        v_result_file: 结果 CSV 文件
+        max_workers: 最大并发请求数，1 即顺序爬取
+        min_interval: 同一 host 两次请求之间的最小间隔（秒）
+        checkpoint: 可选的 CrawlCheckpoint；给定时跳过已完成的时间段，
+                    并在每个时间段写入结果文件后记录完成状态，用于断点续爬
+        dedup: 可选的 DedupIndex，默认新建一个并用结果文件中已有的微博初始化
+        cache: 可选的 PageCache，联网爬取时把原始页面写入缓存
+        offline: 为 True 时不联网，只从 cache 重放已缓存的页面；缺失的页视为该时间段的最后一页
+        on_write: 可选回调，每个时间段写入结果文件后以新写入的 DataFrame 调用，
+                  供下游流式消费；回调阻塞时爬取也随之暂停（背压）
+
+    返回本次爬取的去重统计 dict。
+    """
+    keywords = [v_keyword] if isinstance(v_keyword, str) else list(v_keyword)
+    if dedup is None:
+        dedup = DedupIndex()
+        dedup.load_csv(v_result_file)
+    dedup.reset_stats()
+    pacer = HostPacer(min_interval) if min_interval > 0 else None
+    ref_time = datetime.datetime.now()  # 本次爬取中相对时间（刚刚、xx分钟前）的统一基准
+    order = [tuple(window) for window in windows]  # 尚未写出的时间段，按时间顺序排列
+    # (关键字, 时间段) -> 该时间段在该关键字下仍需爬取的子时间段（拆分后），按时间顺序排列
+    leaves = {}
+    for keyword in keywords:
+        for window in order:
+            if checkpoint is not None:
+                leaves[(keyword, window)] = checkpoint.pending_windows(keyword, [window])
             else:
-                text = item.find('p', {'node-type': 'feed_list_content'}).text.strip()
+                leaves[(keyword, window)] = [window]
+    if checkpoint is not None:
+        pending = sum(len(leaf_windows) for leaf_windows in leaves.values())
+        print(f'断点续爬：{pending} 个 (关键字, 时间段) 待爬取，已完成的已跳过')
+    pages = {}  # (关键字, 子时间段) -> 已解析的各页 [(页码, DataFrame), ...]
+    finished = set()  # 已爬完的 (关键字, 子时间段)
+    failures = {}  # (关键字, 子时间段) -> 连续失败的页数
+    stopped = set()  # 因连续失败而停止翻页的 (关键字, 子时间段)，不记录为已完成
+    futures = {}
 
-            # 添加过滤条件，确保正文中包含完整的关键词
-            if v_keyword not in text:
-                continue
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit(keyword, window, leaf, page):
+            future = executor.submit(crawl_page, keyword, leaf[0], leaf[1], page,
+                                     pacer, ref_time, cache, offline)
+            futures[future] = (keyword, window, leaf, page)
 
-            card_act_li = item.find('div', {'class': 'card-act'}).find_all('li')
-            repost_count = card_act_li[0].text.strip()
-            comment_count = card_act_li[1].text.strip()
-            like_count = card_act_li[2].text.strip()
-
-            # 确定这条微博在时间范围内 -> 一次性 append 到各列表
-            name_list.append(name)
-            create_time_list.append(create_time_str)
-            source_list.append(source)
-            text_list.append(text)
-            repost_count_list.append(repost_count)
-            comment_count_list.append(comment_count)
-            like_count_list.append(like_count)
-
-            print('微博正文：', text)
-
-        #保存数据
-        df = pd.DataFrame(
-            {
-                '页码': [page] * len(name_list),
-                '微博昵称': name_list,
-                '发布时间': create_time_list,
-                '微博来源': source_list,
-                '转发数': repost_count_list,
-                '评论数': comment_count_list,
-                '点赞数': like_count_list,
-                '微博正文': text_list,
-            }
-        )
-        if os.path.exists(v_result_file): #如果文件存在，不再设置表头
-            header = False
-        else: #否则，设置csv文件表头
-            header = True
-        df.to_csv(v_result_file, mode='a+', index=False, header=header, encoding='utf_8_sig')
-        print(f'第 {page} 页结果保存成功 -> {v_result_file}')
-    else:
-        print(f'第 {page} 页没有符合时间范围的微博数据，跳过写入。')
+        for (keyword, window), leaf_windows in leaves.items():
+            for leaf in leaf_windows:
+                pages[(keyword, leaf)] = []
+                submit(keyword, window, leaf, 1)
+
+        while True:
+            # 按时间顺序写出所有关键字都已爬完的时间段
+            while order and all((keyword, leaf) in finished
+                                for keyword in keywords for leaf in leaves[(keyword, order[0])]):
+                window = order.pop(0)
+                frames = []
+                done_leaves = []
+                for keyword in keywords:
+                    for leaf in leaves.pop((keyword, window)):
+                        finished.discard((keyword, leaf))
+                        failures.pop((keyword, leaf), None)
+                        leaf_pages = pages.pop((keyword, leaf))
+                        frames.extend((keyword, df) for _, df in leaf_pages)
+                        if (keyword, leaf) in stopped:
+                            stopped.discard((keyword, leaf))
+                        else:
+                            done_leaves.append((keyword, leaf, [page for page, _ in leaf_pages]))
+                # 先把行写入结果文件，再持久化去重键、记录完成状态：
+                # 写入失败或进程在两步之间被杀时，续爬会重新爬取这些时间段，而不是把它们当作已完成跳过
+                if frames:
+                    df = dedup.filter(dedup.merge_keywords(frames), persist=False)
+                    append_to_csv(df, v_result_file)
+                    dedup.persist(df)
+                    print(f'[从{window[0]}到{window[1]}] 结果保存成功 -> {v_result_file}')
+                    if on_write is not None:
+                        on_write(df)
+                if checkpoint is not None:
+                    for keyword, leaf, leaf_page_numbers in done_leaves:
+                        checkpoint.mark_done(keyword, leaf, leaf_page_numbers)
+
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                keyword, window, leaf, page = futures.pop(future)
+                v_start_time, v_end_time = leaf
+                failed = False
+                try:
+                    df, is_last_page = future.result()
+                    pages[(keyword, leaf)].append((page, df))
+                    failures[(keyword, leaf)] = 0
+                except FetchError as e:
+                    # 失败页已记录，可以用 refetch_failed_pages 补爬；连续失败太多时停止翻页
+                    record_failed_page(v_result_file, keyword, v_start_time, v_end_time, page, str(e))
+                    failed = True
+                    failures[(keyword, leaf)] = failures.get((keyword, leaf), 0) + 1
+                    is_last_page = failures[(keyword, leaf)] >= MAX_CONSECUTIVE_FAILURES
+                    if is_last_page:
+                        print(f'警告：{keyword} [从{v_start_time}到{v_end_time}] 连续 {MAX_CONSECUTIVE_FAILURES} 页失败，'
+                              f'停止翻页，续爬时将重新爬取该时间段。')
+                        stopped.add((keyword, leaf))
+                except CacheMiss as e:
+                    print(f'{e}，按最后一页处理')
+                    is_last_page = True
 
+                if is_last_page:
+                    finished.add((keyword, leaf))
+                elif page < MAX_PAGES:
+                    submit(keyword, window, leaf, page + 1)
+                elif failed:
+                    # 最后一页失败时无法判断结果是否被截断，不拆分（失败页已记录，可补爬）
+                    finished.add((keyword, leaf))
+                else:
+                    sub_windows = split_window(v_start_time, v_end_time)
+                    if sub_windows is None:
+                        print(f'警告：{keyword} [从{v_start_time}到{v_end_time}] 已达 {MAX_PAGES} 页上限且无法再拆分，结果可能被截断。')
+                        finished.add((keyword, leaf))
+                        continue
+                    print(f'{keyword} [从{v_start_time}到{v_end_time}] 已达 {MAX_PAGES} 页上限，拆分为 {sub_windows} 重新爬取。')
+                    leaf_windows = leaves[(keyword, window)]
+                    index = leaf_windows.index(leaf)
+                    leaf_windows[index:index + 1] = sub_windows
+                    if checkpoint is not None:
+                        checkpoint.mark_split(keyword, leaf, sub_windows)
+                    del pages[(keyword, leaf)]
+                    failures.pop((keyword, leaf), None)
+                    for sub_window in sub_windows:
+                        pages[(keyword, sub_window)] = []
+                        submit(keyword, window, sub_window, 1)
 
+    dedup.report()
+    return dedup.stats
 
-def run_weibo_crawl(year, month, day, keyword):
+
+def refetch_failed_pages(v_result_file):
+    """
+    补爬 *_failed.csv 中记录的失败页，成功的页追加到结果文件，
+    仍然失败的页重新写回失败记录。返回仍失败的页数。
+    每补爬完一页就把失败记录改写为“仍失败的页 + 尚未补爬的页”，补爬中途被打断时不会丢失失败记录；
+    补爬的页与 crawl_windows 一样经过 merge_keywords，带有 '匹配关键词' 列，与结果文件的表头一致。
+    """
+    failed_file = failed_pages_file(v_result_file)
+    if not os.path.exists(failed_file):
+        return 0
+    failed_df = pd.read_csv(failed_file, encoding='utf_8_sig')
+    pending = failed_df.drop_duplicates(['关键词', '开始时间', '结束时间', '页码']).to_dict('records')
+    still_failed = []
+    dedup = DedupIndex()
+    dedup.load_csv(v_result_file)
+    while pending:
+        row = pending.pop(0)
+        v_keyword, v_start_time, v_end_time, page = row['关键词'], row['开始时间'], row['结束时间'], int(row['页码'])
+        try:
+            df, _ = crawl_page(v_keyword, v_start_time, v_end_time, page)
+        except FetchError as e:
+            print(f'第 {page} 页补爬仍然失败：{e}')
+            still_failed.append(dict(row, 失败原因=str(e)))
+        else:
+            append_to_csv(dedup.filter(dedup.merge_keywords([(v_keyword, df)])), v_result_file)
+            print(f'[从{v_start_time}到{v_end_time}] 第 {page} 页补爬成功 -> {v_result_file}')
+        _rewrite_failed_pages(failed_file, still_failed + pending, failed_df.columns)
+    return len(still_failed)
+
+
+def _rewrite_failed_pages(failed_file, rows, columns):
+    """用 rows 原子地替换失败记录，没有失败页时删除失败记录文件。"""
+    if not rows:
+        if os.path.exists(failed_file):
+            os.remove(failed_file)
+        return
+    tmp_file = failed_file + '.tmp'
+    pd.DataFrame(rows, columns=columns).to_csv(tmp_file, index=False, encoding='utf_8_sig')
+    os.replace(tmp_file, failed_file)
+
+
+def run_weibo_crawl(year, month, day, keyword, max_workers=1, min_interval=1.0, window_hours=1,
+                    dedup_file=None, cache_dir=None, on_write=None):
     """
     运行微博爬虫，根据传入的年月日和关键字对该天的24小时进行爬取，
     并将结果保存到一个以 '微博数据_' 开头的 CSV 文件中。
+    keyword 可以是关键字列表：所有关键字在同一个任务队列、同一个请求节奏下爬取，
+    被多个关键字搜到的微博只保留一行，并在 '匹配关键词' 列中标注。
+    window_hours 为初始时间段长度（默认每小时一个时间段），翻满页数上限的时间段会自动拆分；
+    max_workers 大于 1 时启用并发模式，各时间段并行爬取，
+    同一 host 的请求间隔不小于 min_interval 秒，结果仍按时间顺序写入。
+    写入前按微博 mid 去重；给定 dedup_file 时去重索引持久化到该文件，
+    多次运行共用同一个 dedup_file 即可跨运行去重。
+    给定 cache_dir 时把原始搜索页压缩缓存到该目录，之后可用 replay_weibo_crawl 离线重建结果。
+    on_write 见 crawl_windows，用于把新爬到的微博流式交给下游分析。
     返回生成的 CSV 文件名。
     """
     now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     csv_filename = '微博数据_{}.csv'.format(now)
     start_time = datetime.datetime(year, month, day, 0)
-    
-    # 每小时为一个时间段，共爬取24小时
-    for i in range(24):
-        get_weibo(
-            v_keyword=keyword,
-            v_start_time=(start_time + datetime.timedelta(hours=i)).strftime('%Y-%m-%d-%H'),
-            v_end_time=(start_time + datetime.timedelta(hours=i+1)).strftime('%Y-%m-%d-%H'),
-            v_result_file=csv_filename
-        )
+
+    # 默认每小时为一个时间段，共爬取24小时
+    windows = [
+        ((start_time + datetime.timedelta(hours=i)).strftime(TIME_FORMAT),
+         (start_time + datetime.timedelta(hours=min(i + window_hours, 24))).strftime(TIME_FORMAT))
+        for i in range(0, 24, window_hours)
+    ]
+    crawl_windows(keyword, windows, csv_filename,
+                  max_workers=max_workers, min_interval=min_interval,
+                  dedup=DedupIndex(dedup_file), cache=PageCache(cache_dir) if cache_dir else None,
+                  on_write=on_write)
     return csv_filename
 
+
+def run_weibo_crawl_range(start_date, end_date, keyword, v_result_file=None,
+                          max_workers=1, min_interval=1.0, window_hours=1, dedup_file=None, cache_dir=None):
+    """
+    可断点续爬的多日爬取：爬取 start_date 到 end_date（含）每天 24 小时的微博。
+    日期可以是 datetime.date 或 'YYYY-MM-DD' 字符串。
+
+    结果文件默认为 '微博数据_<关键字>_<起始日期>_<结束日期>.csv'，同名的
+    *_checkpoint.jsonl 记录已完成的时间段。中途崩溃后用相同参数重新运行，
+    会跳过已完成的时间段，只把缺失的数据追加到同一结果文件。
+    已写入结果文件的微博不会重复写入（keyword、dedup_file、cache_dir 见 run_weibo_crawl）。
+    返回结果 CSV 文件名。
+    """
+    start_date, end_date, windows = _date_range_windows(start_date, end_date, window_hours)
+    if v_result_file is None:
+        v_result_file = '微博数据_{}_{}_{}.csv'.format(_keyword_label(keyword), start_date.strftime('%Y%m%d'),
+                                                   end_date.strftime('%Y%m%d'))
+
+    checkpoint = CrawlCheckpoint(checkpoint_file(v_result_file))
+    dedup = DedupIndex(dedup_file)
+    dedup.load_csv(v_result_file)
+    crawl_windows(keyword, windows, v_result_file,
+                  max_workers=max_workers, min_interval=min_interval,
+                  checkpoint=checkpoint, dedup=dedup, cache=PageCache(cache_dir) if cache_dir else None)
+    return v_result_file
+
+
+def _keyword_label(keyword):
+    """用于结果文件名的关键字标签，多个关键字以 '_' 连接。"""
+    return keyword if isinstance(keyword, str) else '_'.join(keyword)
+
+
+def _date_range_windows(start_date, end_date, window_hours=1):
+    """把日期区间（含两端，date 或 'YYYY-MM-DD'）切成时间段，返回 (start_date, end_date, windows)。"""
+    if isinstance(start_date, str):
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+    if isinstance(end_date, str):
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+    start_time = datetime.datetime.combine(start_date, datetime.time())
+    total_hours = ((end_date - start_date).days + 1) * 24
+    windows = [
+        ((start_time + datetime.timedelta(hours=i)).strftime(TIME_FORMAT),
+         (start_time + datetime.timedelta(hours=min(i + window_hours, total_hours))).strftime(TIME_FORMAT))
+        for i in range(0, total_hours, window_hours)
+    ]
+    return start_date, end_date, windows
+
+
+def replay_weibo_crawl(start_date, end_date, keyword, cache_dir, v_result_file=None, window_hours=1):
+    """
+    离线重放：完全不联网，用 cache_dir 中缓存的原始搜索页按与联网爬取相同的逻辑
+    （翻页、拆分时间段、去重）重新解析，重建 '微博数据_*.csv'。
+    适合修复解析问题后重新生成结果，相对时间按各页的原始抓取时间解析。
+    返回重建的 CSV 文件名。
+    """
+    start_date, end_date, windows = _date_range_windows(start_date, end_date, window_hours)
+    if v_result_file is None:
+        now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        v_result_file = '微博数据_{}_重放_{}.csv'.format(_keyword_label(keyword), now)
+    crawl_windows(keyword, windows, v_result_file, cache=PageCache(cache_dir), offline=True)
+    return v_result_file
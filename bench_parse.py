@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+微博搜索结果页解析基准：对保存下来的结果页分别用各解析引擎提取微博，
+校验输出一致，并打印每个引擎的耗时。
+
+用法:
+    python bench_parse.py 页面1.html 页面目录 ... [--repeat N]
+    python bench_parse.py --cache 页面缓存目录 [--repeat N]
+"""
+
+import argparse
+import os
+import time
+
+from WeiboCrawler import PARSER_ENGINES, PageCache, extract_feed_items
+
+
+def load_pages(paths):
+    """读取给定的 HTML 文件；目录则读取其中所有 .html 文件。"""
+    pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.html'))
+        else:
+            files = [path]
+        for file in files:
+            with open(file, 'r', encoding='utf-8') as f:
+                pages.append(f.read())
+    return pages
+
+
+def benchmark(pages, repeat=5):
+    """返回 {引擎: 每页平均耗时(毫秒)}；各引擎输出不一致时抛出 AssertionError。"""
+    engines = list(PARSER_ENGINES)
+    reference = [extract_feed_items(html, engines[0]) for html in pages]
+    timings = {}
+    for engine in engines:
+        outputs = [extract_feed_items(html, engine) for html in pages]
+        assert outputs == reference, f'{engine} 的解析结果与 {engines[0]} 不一致'
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for html in pages:
+                extract_feed_items(html, engine)
+        timings[engine] = (time.perf_counter() - start) * 1000 / (repeat * len(pages))
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='微博搜索结果页解析基准')
+    parser.add_argument('paths', nargs='*', help='保存的结果页 HTML 文件或目录')
+    parser.add_argument('--cache', help='爬虫页面缓存目录（run_weibo_crawl 的 cache_dir），使用其中缓存的全部页面')
+    parser.add_argument('--repeat', type=int, default=5, help='每个引擎重复解析的轮数')
+    args = parser.parse_args()
+
+    pages = load_pages(args.paths)
+    if args.cache:
+        pages += [html for _, html, _ in PageCache(args.cache).iter_entries()]
+    if not pages:
+        parser.error('没有可用的页面，请指定 HTML 文件/目录或 --cache')
+    print(f'共 {len(pages)} 页，各引擎输出一致性校验通过后计时：')
+    timings = benchmark(pages, args.repeat)
+    baseline = timings['html.parser']
+    for engine, ms in timings.items():
+        print(f'{engine:12s} {ms:8.2f} ms/页  加速比 {baseline / ms:5.1f}x')
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 后端：agent 通过后端发送对话消息，而不是直接调用 OpenAI 客户端。
+
+OpenAIBackend 调用真实接口；MockBackend 不联网，按消息内容确定性地生成格式正确的回复
+（情感分析、主题分析、融合分析的 JSON，Coordinator 的参数 JSON，Summarizer 的总结文本），
+并可以注入延迟和错误，用于在没有 API 的机器上测量流水线本身的开销和并发行为。
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+
+from local_models import SENTIMENT_LABELS, estimate_tokens
+
+
+# 进程内共享的 OpenAI 客户端（自带连接池），第一次使用时创建
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """返回进程内共享的 OpenAI 客户端，所有 agent 复用同一个连接池。"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+                _client = OpenAI()
+    return _client
+
+
+class OpenAIBackend:
+    """通过 OpenAI 客户端调用 Chat Completions 接口。client 为 None 时使用进程内共享的客户端。"""
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_client()
+
+    def complete(self, model, messages):
+        """发送对话消息，返回接口的原始响应（含 choices 和 usage）。"""
+        return self.client.chat.completions.create(model=model, messages=messages)
+
+
+class _Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MockAPIError(Exception):
+    """MockBackend 注入的错误，带有与 OpenAI 接口错误相同的 status_code，可被限流调度器归类和重试。"""
+
+    def __init__(self, status_code):
+        super().__init__(f"模拟的接口错误（HTTP {status_code}）")
+        self.status_code = status_code
+        self.response = _Namespace(status_code=status_code, headers={})
+
+
+_ENTRY = re.compile(r'^(\d+): (.*)$', re.M)
+_KEYWORD = re.compile(r'#[^#\s]{1,40}#')
+_DATE = re.compile(r'(\d{4})\s*[-/年.]\s*(\d{1,2})\s*[-/月.]\s*(\d{1,2})')
+
+
+def _digest(*parts):
+    return int(hashlib.md5('\x1f'.join(parts).encode('utf-8')).hexdigest(), 16)
+
+
+class MockBackend:
+    """
+    确定性的本地模拟后端：同样的消息总是得到同样的回复。
+    latency 为每次调用的固定延迟（秒），jitter 为额外的随机延迟上限（按消息内容确定）；
+    error_rate 为注入错误的比例，错误的 HTTP 状态码轮流取自 error_codes（同一消息的第 n 次调用是否出错也是确定的，
+    与线程调度无关）。stats 记录调用次数 calls 和注入的错误数 errors。
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_codes=(429, 503), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.seed = str(seed)
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'errors': 0}
+
+    def complete(self, model, messages):
+        """返回与 OpenAI 响应结构相同的对象（choices[0].message.content 和 usage）。"""
+        key = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+            self.stats['calls'] += 1
+        delay = self.latency + self.jitter * (_digest(self.seed, 'delay', key) % 1000) / 1000
+        if delay:
+            time.sleep(delay)
+        draw = _digest(self.seed, 'error', key, str(attempt))
+        if self.error_rate and draw % 10000 < self.error_rate * 10000:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise MockAPIError(self.error_codes[draw % len(self.error_codes)])
+
+        content = self.reply(messages)
+        prompt_tokens = sum(estimate_tokens(json.dumps(message.get("content"), ensure_ascii=False))
+                            for message in messages)
+        completion_tokens = estimate_tokens(content)
+        return _Namespace(
+            model=model,
+            choices=[_Namespace(index=0, message=_Namespace(role="assistant", content=content),
+                                finish_reason="stop")],
+            usage=_Namespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                             total_tokens=prompt_tokens + completion_tokens),
+        )
+
+    def reply(self, messages):
+        """按系统提示词判断任务类型，生成对最后一条用户消息的回复内容。"""
+        system_prompt = messages[0].get("content", "") if messages else ""
+        content = messages[-1].get("content", "") if messages else ""
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        if "public_opinion_analysist" in system_prompt:
+            return self.analyses(content, ("sentiment", "topics"))
+        if "sentiment_analysist" in system_prompt:
+            return self.analyses(content, ("sentiment",))
+        if "topic_modelling_agent" in system_prompt:
+            return self.analyses(content, ("topics",))
+        if "Public_opinion_analysis_operator" in system_prompt:
+            return self.crawl_parameters(content)
+        return self.summary(content)
+
+    def analyses(self, query, fields):
+        """为 query 中每条 “编号: 正文” 生成一条带 id 的结果；主题优先从 query 的当前主题列表里选。"""
+        body, _, listed = query.partition("当前主题列表：")
+        known = [topic.strip() for topic in listed.split("\n")[0].split(",")
+                 if topic.strip() and topic.strip() != "无"]
+        pool = known or [f"模拟主题{i}" for i in range(5)]
+        analyses = []
+        for number, text in _ENTRY.findall(body):
+            digest = _digest(self.seed, text)
+            item = {"id": int(number)}
+            if "sentiment" in fields:
+                item["sentiment"] = SENTIMENT_LABELS[digest % len(SENTIMENT_LABELS)]
+            if "topics" in fields:
+                item["topics"] = [pool[(digest // 7) % len(pool)]]
+            analyses.append(item)
+        return json.dumps({"analyses": analyses}, ensure_ascii=False)
+
+    def crawl_parameters(self, text):
+        """从用户输入中找出 #关键词# 和日期；信息不全时像 Coordinator 一样追问。"""
+        keywords = _KEYWORD.findall(text)
+        date = _DATE.search(text)
+        if not keywords or not date:
+            return "请提供事件关键词（用 #关键词# 表示）和事件开始日期（例如 2022-03-13）。目前只支持微博平台。"
+        year, month, day = date.groups()
+        return json.dumps({
+            "event_keywords": keywords,
+            "start_year": year,
+            "start_month": str(int(month)),
+            "start_day": str(int(day)),
+            "event_release_platform": "weibo",
+        }, ensure_ascii=False)
+
+    def summary(self, text):
+        """生成一段确定性的总结文本，引用输入中的前几行。"""
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        return "模拟总结：共收到 {} 行数据。{}".format(len(lines), "；".join(lines[:5]))
+
+
+# 默认后端：未指定 backend 的 agent 都使用它
+_default_backend = OpenAIBackend()
+
+
+def set_backend(backend):
+    """设置之后新建的 agent 默认使用的后端，例如 set_backend(MockBackend(latency=0.5))。"""
+    global _default_backend
+    _default_backend = backend
+
+
+def get_backend():
+    """返回当前的默认后端。"""
+    return _default_backend
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 分析结果的持久化缓存（SQLite）。
+
+按单条微博缓存：键为 模型名 + 系统提示词哈希 + 归一化后的微博正文，
+值为该条微博的分析结果（JSON）。因此同一批数据重新分批后仍能命中，
+重跑同一事件的分析时只有新微博需要调用 LLM。
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+LLM_CACHE_FILE = "llm_cache.sqlite"
+DEFAULT_TTL = 30 * 24 * 3600  # 缓存有效期（秒），None 表示永不过期
+DEFAULT_MAX_ENTRIES = 500000  # 超过后按最近最少使用淘汰
+EVICT_EVERY = 1000  # 每写入这么多条检查一次淘汰
+
+# 零宽字符（例如微博正文末尾常带的 \u200b）
+_ZERO_WIDTH = re.compile('[\u200b\u200c\u200d\u2060\ufeff]')
+
+
+def normalize_text(text) -> str:
+    """归一化微博正文：NFKC（全角转半角等）、去掉零宽字符、合并空白。"""
+    text = unicodedata.normalize('NFKC', str(text))
+    text = _ZERO_WIDTH.sub('', text)
+    return ' '.join(text.split())
+
+
+class LLMCache:
+    """
+    单条微博粒度的 LLM 结果缓存，线程安全。
+    stats 记录命中 hits、未命中 misses、写入 writes、淘汰 evicted 的条数。
+    """
+
+    def __init__(self, path=LLM_CACHE_FILE, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.reset_stats()
+        with self._lock:
+            self._evict()
+
+    def reset_stats(self):
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evicted': 0}
+
+    @staticmethod
+    def key(model, system_prompt, text):
+        """缓存键：模型名、系统提示词哈希和归一化正文共同决定。"""
+        prompt_hash = hashlib.sha1(system_prompt.encode('utf-8')).hexdigest()
+        content = '\x1f'.join([model, prompt_hash, normalize_text(text)])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get_many(self, model, system_prompt, texts):
+        """按顺序返回每条正文的缓存结果，未命中（或已过期）的位置为 None。"""
+        keys = [self.key(model, system_prompt, text) for text in texts]
+        now = time.time()
+        with self._lock:
+            found = {}
+            unique = list(set(keys))
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                rows = self._conn.execute(
+                    "SELECT key, value, created FROM entries WHERE key IN ({})".format(','.join('?' * len(part))),
+                    part).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = json.loads(value)
+            with self._conn:
+                self._conn.executemany("UPDATE entries SET accessed = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+            values = [found.get(key) for key in keys]
+            hits = sum(value is not None for value in values)
+            self.stats['hits'] += hits
+            self.stats['misses'] += len(values) - hits
+        return values
+
+    def put_many(self, model, system_prompt, items):
+        """写入 (正文, 结果) 列表，结果需可 JSON 序列化。"""
+        now = time.time()
+        rows = [(self.key(model, system_prompt, text), json.dumps(value, ensure_ascii=False), now, now)
+                for text, value in items]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", rows)
+            self.stats['writes'] += len(rows)
+            self._writes_since_evict += len(rows)
+            if self._writes_since_evict >= EVICT_EVERY:
+                self._evict()
+
+    def _evict(self):
+        """删除过期条目，并在条目数超过 max_entries 时删除最近最少使用的条目。"""
+        self._writes_since_evict = 0
+        with self._conn:
+            if self.ttl is not None:
+                cursor = self._conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+                self.stats['evicted'] += cursor.rowcount
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if self.max_entries is not None and count > self.max_entries:
+                cursor = self._conn.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,))
+                self.stats['evicted'] += cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def report(self):
+        stats = self.stats
+        total = stats['hits'] + stats['misses']
+        rate = stats['hits'] / total if total else 0.0
+        print('LLM 缓存统计：命中 {} 条，未命中 {} 条（命中率 {:.1%}），写入 {} 条，淘汰 {} 条'.format(
+            stats['hits'], stats['misses'], rate, stats['writes'], stats['evicted']))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+所有 LLM 调用共用的限流和重试调度器。
+
+每个模型一个调度器：按令牌桶同时限制每分钟请求数（RPM）和每分钟 token 数（TPM），
+调用前按估算的 token 数预占额度，返回后用 response.usage 的实际用量修正；
+遇到 429、5xx、超时和连接错误时指数退避重试（优先遵守 Retry-After），
+重试用尽或遇到不可重试的错误时抛出带类型的异常，而不是把错误信息当作回复返回。
+"""
+
+import random
+import threading
+import time
+
+from local_models import estimate_tokens
+
+
+DEFAULT_RPM = 500  # 每分钟最多请求数
+DEFAULT_TPM = 200000  # 每分钟最多 token 数（输入 + 输出）
+MAX_RETRIES = 5
+BASE_DELAY = 1.0  # 第一次重试前等待的秒数，之后每次翻倍
+MAX_DELAY = 60.0
+REPLY_TOKENS = 500  # 调用前估算的回复 token 数，返回后按实际用量修正
+MESSAGE_OVERHEAD = 4  # 每条消息的格式开销
+IMAGE_TOKENS = 1105  # 一张高清图片的大致 token 数
+
+
+class LLMCallError(RuntimeError):
+    """LLM 调用失败。attempts 为已尝试的次数，cause 为最后一次的原始异常。"""
+
+    def __init__(self, message, attempts=1, cause=None):
+        super().__init__(message)
+        self.attempts = attempts
+        self.cause = cause
+
+
+class LLMRateLimitError(LLMCallError):
+    """重试用尽后仍被限流（HTTP 429）。"""
+
+
+class LLMTransientError(LLMCallError):
+    """重试用尽后仍是临时性错误（5xx、超时、连接错误）。"""
+
+
+class LLMRequestError(LLMCallError):
+    """不可重试的错误，例如请求无效或鉴权失败（其余 4xx）。"""
+
+
+def _status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def classify_error(error):
+    """把原始异常归类为 LLMRateLimitError / LLMTransientError / LLMRequestError 之一（返回异常类）。"""
+    status = _status_code(error)
+    if status == 429:
+        return LLMRateLimitError
+    if status is not None:
+        return LLMTransientError if status >= 500 or status in (408, 409) else LLMRequestError
+    # 没有状态码：超时和连接错误（openai.APIConnectionError / APITimeoutError 等）可以重试
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if isinstance(error, (TimeoutError, ConnectionError)) or names & {'APIConnectionError', 'APITimeoutError'}:
+        return LLMTransientError
+    return LLMRequestError
+
+
+def retry_after(error):
+    """从错误响应的 Retry-After 头中取出建议等待的秒数，没有时返回 None。"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_message_tokens(messages, reply_tokens=REPLY_TOKENS):
+    """调用前估算一次请求的 token 数：所有消息的文本（图片按固定值）加上预计的回复长度。"""
+    total = reply_tokens
+    for message in messages:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        total += MESSAGE_OVERHEAD
+        for part in parts:
+            if part.get("type") == "image_url":
+                total += IMAGE_TOKENS
+            else:
+                total += estimate_tokens(part.get("text") or "")
+    return total
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟额度，按额度 / 60 每秒匀速补充。线程安全。"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount):
+        """取出 amount 个令牌，不够时等待；超过容量的请求按容量计（单个大请求不会永远等待）。"""
+        amount = min(float(amount), self.capacity)
+        with self._cond:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                self._cond.wait((amount - self.level) / self.rate)
+
+    def adjust(self, delta):
+        """按实际用量修正：delta 为正表示多用了（余额可以变为负数，之后的请求等待更久），为负表示退还。"""
+        with self._cond:
+            self._refill()
+            self.level = min(self.capacity, self.level - delta)
+            self._cond.notify_all()
+
+
+class LLMScheduler:
+    """
+    一个模型的限流和重试调度器。stats 记录请求数 requests、重试次数 retries、
+    失败次数 failures、估算 token 数 estimated_tokens 和实际 token 数 used_tokens。
+    """
+
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_retries=MAX_RETRIES,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'estimated_tokens': 0, 'used_tokens': 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def call(self, func, estimated_tokens):
+        """
+        在额度内调用 func()（一次 LLM 请求）并返回其结果，可重试的错误按指数退避重试，
+        重试用尽或遇到不可重试的错误时抛出 LLMCallError 的子类。
+        """
+        for attempt in range(1, self.max_retries + 2):
+            self.requests.acquire(1)
+            self.tokens.acquire(estimated_tokens)
+            self._count('requests')
+            self._count('estimated_tokens', estimated_tokens)
+            try:
+                response = func()
+            except Exception as e:
+                # 失败的请求不消耗 token 额度
+                self.tokens.adjust(-estimated_tokens)
+                error_type = classify_error(e)
+                if error_type is LLMRequestError or attempt > self.max_retries:
+                    self._count('failures')
+                    raise error_type(f"调用接口失败（第 {attempt} 次尝试）：{e}", attempt, e) from e
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                self._count('retries')
+                print(f"调用接口出错，{delay:.1f} 秒后重试：{e}")
+                time.sleep(delay)
+                continue
+            usage = getattr(response, 'usage', None)
+            used = getattr(usage, 'total_tokens', None)
+            if used is not None:
+                self.tokens.adjust(used - estimated_tokens)
+                self._count('used_tokens', used)
+            return response
+
+    def report(self):
+        stats = self.stats
+        print('LLM 调用统计：请求 {} 次（重试 {} 次，失败 {} 次），估算 {} tokens，实际 {} tokens'.format(
+            stats['requests'], stats['retries'], stats['failures'], stats['estimated_tokens'], stats['used_tokens']))
+
+
+# 每个模型一个调度器（服务商按模型分别限流），第一次使用时按默认额度创建
+_schedulers = {}
+_limits = {}
+_schedulers_lock = threading.Lock()
+
+
+def set_rate_limits(rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, model=None, **kwargs):
+    """
+    设置某个模型（model 为 None 时为所有模型的默认值）的 RPM / TPM 额度和重试参数，
+    替换已创建的调度器。kwargs 传给 LLMScheduler（例如 max_retries）。
+    """
+    with _schedulers_lock:
+        _limits[model] = dict(rpm=rpm, tpm=tpm, **kwargs)
+        for name in list(_schedulers):
+            if model is None or name == model:
+                del _schedulers[name]
+
+
+def get_scheduler(model) -> LLMScheduler:
+    """返回 model 共用的调度器。"""
+    with _schedulers_lock:
+        if model not in _schedulers:
+            _schedulers[model] = LLMScheduler(**_limits.get(model, _limits.get(None, {})))
+        return _schedulers[model]
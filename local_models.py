@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+不调用 LLM 的本地文本处理和模型：近似重复微博的聚类（SimHash）、token 数估算、本地情感分类器、已有主题的本地匹配、
+主题名的归并（主题词表）、用户查询中爬取参数的规则解析。
+
+同一热搜事件下大量微博是转发、复制粘贴的模板或机器人发帖，正文只在 @提及、表情、
+链接或结尾的零宽字符上有差别。这里把它们聚成簇，每簇只需要让 LLM 分析一条代表微博。
+"""
+
+import datetime
+import hashlib
+import re
+import threading
+import unicodedata
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from llm_cache import normalize_text
+
+
+SIMHASH_BITS = 64
+NGRAM_SIZE = 3  # 字符 n-gram 的长度
+NEAR_DUP_DISTANCE = 3  # SimHash 汉明距离不超过该值视为近似重复
+MIN_SIMHASH_CHARS = 20  # 短于该长度的正文只折叠完全相同的内容，SimHash 对短文本不可靠
+
+_MENTION = re.compile(r'@[^\s@:：,，]+')
+_URL = re.compile(r'https?://\S+')
+_EMOTICON = re.compile(r'\[[^\[\]\s]{1,8}\]')  # 微博表情，例如 [哈哈]
+_TRAILING = re.compile(r'\s*(展开全文|收起全文)[cd]?$')  # 微博正文结尾的“展开全文c”
+
+
+def near_dup_text(text) -> str:
+    """去掉 @提及、链接、微博表情和 emoji 等符号后的正文，用于判断近似重复。"""
+    text = normalize_text(text)
+    text = _URL.sub(' ', text)
+    text = _MENTION.sub(' ', text)
+    text = _EMOTICON.sub(' ', text)
+    text = ''.join(ch for ch in text if unicodedata.category(ch) not in ('So', 'Sk', 'Cs', 'Co'))
+    return _TRAILING.sub('', ' '.join(text.split()))
+
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """字符 n-gram 列表；不足 n 个字符时整段作为一个 n-gram。"""
+    if len(text) <= n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def _hash64(grams):
+    """每个 n-gram 的 64 位哈希，返回 uint64 数组。"""
+    digests = b''.join(hashlib.blake2b(gram.encode('utf-8'), digest_size=8).digest() for gram in grams)
+    return np.frombuffer(digests, dtype='<u8')
+
+
+def simhash(text, n=NGRAM_SIZE) -> int:
+    """文本的 64 位 SimHash 指纹（基于字符 n-gram，按出现次数加权）。"""
+    grams = char_ngrams(text, n)
+    if not grams:
+        return 0
+    hashes = _hash64(grams)
+    # 每行是一个 n-gram 哈希的 64 个比特（低位在前）
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 > len(grams)
+    return int(np.packbits(votes, bitorder='little').view('<u8')[0])
+
+
+def hamming_distance(a, b) -> int:
+    return bin(a ^ b).count('1')
+
+
+class NearDuplicateIndex:
+    """
+    在线的近似重复索引：按到达顺序给每条微博分配所属簇的代表（第一条出现的微博）。
+    SimHash 指纹切成 max_distance + 1 段分桶，汉明距离不超过 max_distance 的两个指纹
+    至少有一段完全相同（抽屉原理），因此只需在同桶中比较。线程安全。
+    """
+
+    def __init__(self, max_distance=NEAR_DUP_DISTANCE, min_chars=MIN_SIMHASH_CHARS):
+        self.max_distance = max_distance
+        self.min_chars = min_chars
+        bounds = [int(bound) for bound in np.linspace(0, SIMHASH_BITS, max_distance + 2)]
+        self._bands = [((1 << (hi - lo)) - 1, lo) for lo, hi in zip(bounds[:-1], bounds[1:])]
+        self._buckets = [{} for _ in self._bands]  # 每段：段值 -> [(指纹, 代表)]
+        self._exact = {}  # 短文本：正文 -> 代表
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'checked': 0, 'clusters': 0, 'duplicates': 0}
+
+    def assign(self, text, post_id):
+        """返回 post_id 这条微博所属簇的代表 id；没有近似重复时它自己成为新簇的代表。"""
+        key = near_dup_text(text)
+        if not key:
+            # 只有 @、表情之类的微博，按原文完全相同才折叠
+            key = normalize_text(text)
+        with self._lock:
+            self.stats['checked'] += 1
+            if len(key) < self.min_chars:
+                rep = self._exact.setdefault(key, post_id)
+            else:
+                rep = self._assign_simhash(simhash(key), post_id)
+            if rep == post_id:
+                self.stats['clusters'] += 1
+            else:
+                self.stats['duplicates'] += 1
+        return rep
+
+    def _assign_simhash(self, fingerprint, post_id):
+        parts = [(fingerprint >> shift) & mask for mask, shift in self._bands]
+        for bucket, part in zip(self._buckets, parts):
+            for other, rep in bucket.get(part, ()):
+                if hamming_distance(fingerprint, other) <= self.max_distance:
+                    return rep
+        for bucket, part in zip(self._buckets, parts):
+            bucket.setdefault(part, []).append((fingerprint, post_id))
+        return post_id
+
+    def report(self):
+        stats = self.stats
+        print('近似重复折叠：检查 {} 条，{} 个簇，折叠 {} 条（无需调用 LLM）'.format(
+            stats['checked'], stats['clusters'], stats['duplicates']))
+
+
+# 按 token 计大约各占 1 个 token 的字符：中日韩文字、假名、全角标点，以及 emoji 等 BMP 以外的字符
+_DENSE_CHARS = re.compile('[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef\U00010000-\U0010ffff]')
+
+
+def estimate_tokens(text) -> int:
+    """
+    本地粗略估计文本的 token 数，不依赖 tokenizer：
+    中文等字符约每个 1 个 token，其余（英文、数字、ASCII 标点和空白）约每 4 个字符 1 个 token。
+    """
+    text = str(text)
+    dense = len(_DENSE_CHARS.findall(text))
+    return dense + (len(text) - dense + 3) // 4
+
+
+SENTIMENT_LABELS = ("positive", "neutral", "negative")
+N_FEATURES = 2 ** 18  # 哈希特征空间大小
+LOCAL_MIN_AGREEMENT = 0.95  # 留出集上本地结果与 LLM 的一致率不低于该值的置信度阈值才会被启用
+MIN_LOCAL_SAMPLES = 20  # 某个阈值下留出集中至少有这么多条本地结果，其一致率才算数
+CALIBRATION_SCALES = np.logspace(-1, 3, 81)  # 校准时搜索的对数似然缩放系数（逆温度）
+
+
+def hashed_ngrams(texts, n_features=N_FEATURES, ngram_range=(1, 3)):
+    """
+    把每条文本的字符 n-gram 哈希到 [0, n_features) 的特征编号，
+    返回 (indices, offsets)：第 i 条文本的特征为 indices[offsets[i]:offsets[i + 1]]。
+    """
+    features = []
+    offsets = [0]
+    low, high = ngram_range
+    for text in texts:
+        text = near_dup_text(text)
+        grams = [text[i:i + n] for n in range(low, high + 1) for i in range(len(text) - n + 1)]
+        features.extend(zlib.crc32(gram.encode('utf-8')) for gram in grams)
+        offsets.append(len(features))
+    indices = np.array(features, dtype=np.int64) % n_features
+    return indices, np.array(offsets, dtype=np.int64)
+
+
+class SentimentClassifier:
+    """
+    CPU 上运行的本地情感分类器：字符 1~3-gram 哈希特征上的多项式朴素贝叶斯，
+    用已有的 LLM 情感标注（sentiment_analysis_output 文件）训练，对整个 DataFrame 向量化打分。
+    用作 LLM 之前的一级：置信度足够高的微博直接采用本地结果，其余再交给 LLM。
+    朴素贝叶斯把成百上千个相关的 n-gram 当作独立证据相加，原始后验几乎总是接近 0 或 1，
+    因此打分用按 n-gram 数平均的对数似然，再乘以在留出集上校准的系数 scale（见 calibrate）。
+    confidence 为经 sentiment_agreement_report 验证过的置信度阈值，None 表示不启用本地结果。
+    """
+
+    def __init__(self, n_features=N_FEATURES, ngram_range=(1, 3), alpha=0.1):
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.alpha = alpha
+        self.labels = SENTIMENT_LABELS
+        self.log_prior = None
+        self.log_prob = None  # 形状 (类别数, n_features)
+        self.scale = 1.0
+        self.confidence = None
+
+    def fit(self, texts, labels):
+        """用文本和对应的情感标签（positive / neutral / negative，其它标签忽略）训练。"""
+        labels = [str(label).strip().lower() for label in labels]
+        keep = [i for i, label in enumerate(labels) if label in self.labels]
+        texts = [texts[i] for i in keep]
+        y = np.array([self.labels.index(labels[i]) for i in keep], dtype=np.int64)
+        if not len(y):
+            raise ValueError("没有可用于训练的情感标注")
+        indices, offsets = hashed_ngrams(texts, self.n_features, self.ngram_range)
+        row_of_feature = np.repeat(y, np.diff(offsets))
+        counts = np.zeros((len(self.labels), self.n_features))
+        np.add.at(counts, (row_of_feature, indices), 1)
+        smoothed = counts + self.alpha
+        self.log_prob = np.log(smoothed / smoothed.sum(axis=1, keepdims=True))
+        class_counts = np.bincount(y, minlength=len(self.labels)) + 1
+        self.log_prior = np.log(class_counts / class_counts.sum())
+        return self
+
+    def log_likelihood(self, texts):
+        """返回形状 (len(texts), 3) 的每个 n-gram 的平均对数似然（按文本长度归一化），空文本为 0。"""
+        texts = list(texts)
+        indices, offsets = hashed_ngrams(texts, self.n_features, self.ngram_range)
+        # 把特征的对数概率按文本分段求和（末尾补一列 0，使空文本的和为 0）
+        weights = np.concatenate([self.log_prob[:, indices], np.zeros((len(self.labels), 1))], axis=1)
+        starts = np.minimum(offsets[:-1], len(indices))
+        sums = np.add.reduceat(weights, starts, axis=1)
+        lengths = np.diff(offsets)
+        sums[:, lengths == 0] = 0.0
+        return sums.T / np.maximum(lengths, 1)[:, None]
+
+    def _proba(self, log_likelihood, scale):
+        scores = scale * log_likelihood + self.log_prior
+        scores -= scores.max(axis=1, keepdims=True)
+        probs = np.exp(scores)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def predict_proba(self, texts):
+        """返回形状 (len(texts), 3) 的校准后的概率矩阵，列顺序同 self.labels。"""
+        return self._proba(self.log_likelihood(texts), self.scale)
+
+    def calibrate(self, texts, labels, scales=CALIBRATION_SCALES):
+        """在未参与训练的标注上选择使负对数似然最小的 scale（温度缩放），返回 self。"""
+        labels = [str(label).strip().lower() for label in labels]
+        keep = [i for i, label in enumerate(labels) if label in self.labels]
+        if not keep:
+            raise ValueError("没有可用于校准的情感标注")
+        log_likelihood = self.log_likelihood([texts[i] for i in keep])
+        y = np.array([self.labels.index(labels[i]) for i in keep], dtype=np.int64)
+        rows = np.arange(len(y))
+        losses = [-np.log(self._proba(log_likelihood, scale)[rows, y] + 1e-12).mean() for scale in scales]
+        self.scale = float(scales[int(np.argmin(losses))])
+        return self
+
+    def predict(self, texts):
+        """返回 (标签列表, 置信度数组)。"""
+        probs = self.predict_proba(texts)
+        best = probs.argmax(axis=1)
+        return [self.labels[i] for i in best], probs[np.arange(len(best)), best]
+
+    def save(self, path):
+        confidence = np.nan if self.confidence is None else self.confidence
+        np.savez_compressed(path, log_prob=self.log_prob, log_prior=self.log_prior,
+                            config=np.array([self.n_features, *self.ngram_range]), alpha=self.alpha,
+                            scale=self.scale, confidence=confidence)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        n_features, low, high = (int(value) for value in data['config'])
+        model = cls(n_features, (low, high), float(data['alpha']))
+        model.log_prob = data['log_prob']
+        model.log_prior = data['log_prior']
+        if 'scale' in data:
+            model.scale = float(data['scale'])
+            confidence = float(data['confidence'])
+            model.confidence = None if np.isnan(confidence) else confidence
+        return model
+
+    @classmethod
+    def from_outputs(cls, output_files, **kwargs):
+        """用一个或多个 sentiment_analysis_output 文件（.csv 或 .xlsx，含“微博正文”和 sentiment 列）训练。"""
+        texts, labels = load_sentiment_labels(output_files)
+        return cls(**kwargs).fit(texts, labels)
+
+
+def load_sentiment_labels(output_files):
+    """读取 sentiment_analysis_output 文件中的（微博正文, sentiment）标注。"""
+    if isinstance(output_files, str):
+        output_files = [output_files]
+    frames = []
+    for path in output_files:
+        if path.endswith(('.xlsx', '.xls')):
+            frames.append(pd.read_excel(path))
+        else:
+            frames.append(pd.read_csv(path, encoding='utf-8'))
+    df = pd.concat(frames, ignore_index=True).dropna(subset=['微博正文', 'sentiment'])
+    return list(df['微博正文'].astype(str)), list(df['sentiment'].astype(str))
+
+
+def sentiment_agreement_report(output_files, test_size=0.2, seed=0,
+                               thresholds=(0.5, 0.7, 0.8, 0.9, 0.95, 0.99), min_agreement=LOCAL_MIN_AGREEMENT,
+                               **kwargs):
+    """
+    在已有的 LLM 情感标注上随机留出 test_size，用其余部分训练本地分类器；
+    留出部分的一半用于校准打分（calibrate），另一半作为测试集，
+    报告每个置信度阈值下：本地处理的比例（LLM 调用减少的比例）和条数、本地结果与 LLM 的一致率，
+    以及级联（高置信度用本地、其余用 LLM）整体与纯 LLM 结果的一致率。
+    一致率不低于 min_agreement（且本地结果不少于 MIN_LOCAL_SAMPLES 条）的最低阈值记为分类器的 confidence；
+    没有这样的阈值时 confidence 为 None，分类器默认不启用，所有微博仍交给 LLM。
+    返回 (在全部标注上重新训练、沿用校准系数和 confidence 的分类器, 报告 DataFrame)。
+    """
+    texts, labels = load_sentiment_labels(output_files)
+    labels = [label.strip().lower() for label in labels]
+    keep = [i for i, label in enumerate(labels) if label in SENTIMENT_LABELS]
+    texts = [texts[i] for i in keep]
+    labels = np.array([labels[i] for i in keep])
+    order = np.random.default_rng(seed).permutation(len(texts))
+    n_held_out = max(2, int(len(texts) * test_size))
+    held_out, train = order[:n_held_out], order[n_held_out:]
+    calibration, test = held_out[:n_held_out // 2], held_out[n_held_out // 2:]
+
+    model = SentimentClassifier(**kwargs).fit([texts[i] for i in train], labels[train])
+    model.calibrate([texts[i] for i in calibration], labels[calibration])
+    predicted, confidence = model.predict([texts[i] for i in test])
+    agree = np.array(predicted) == labels[test]
+    rows = []
+    for threshold in thresholds:
+        local = confidence >= threshold
+        rows.append({
+            "threshold": threshold,
+            "local_share": local.mean(),
+            "local_count": int(local.sum()),
+            "local_agreement": agree[local].mean() if local.any() else float('nan'),
+            "cascade_agreement": (agree & local).sum() / len(test) + (~local).mean(),
+        })
+    report = pd.DataFrame(rows)
+    print('本地情感分类器：训练 {} 条，校准 {} 条（scale = {:.3g}），测试 {} 条，全部由本地分类时与 LLM 一致率 {:.1%}'.format(
+        len(train), len(calibration), model.scale, len(test), agree.mean()))
+    print(report.to_string(index=False))
+
+    final = SentimentClassifier(**kwargs).fit(texts, labels)
+    final.scale = model.scale
+    qualified = report[(report['local_agreement'] >= min_agreement) & (report['local_count'] >= MIN_LOCAL_SAMPLES)]
+    if len(qualified):
+        final.confidence = float(qualified['threshold'].min())
+        print('置信度阈值 {} 下本地结果与 LLM 一致率不低于 {:.0%}，启用本地分类'.format(final.confidence, min_agreement))
+    else:
+        print('没有置信度阈值下本地结果与 LLM 一致率达到 {:.0%}，本地分类器默认不启用（全部交给 LLM）'.format(min_agreement))
+    return final, report
+
+
+TOPIC_FEATURES = 2 ** 15  # 主题匹配的哈希特征空间大小
+TOPIC_MATCH_THRESHOLD = 0.2  # 与已有主题的相似度不低于该值时直接分配该主题
+TOPIC_MATCH_MARGIN = 0.05  # 最相似的主题领先第二名不足该值（且第二名未达阈值）时视为有歧义，交给 LLM
+MIN_TOPIC_EXAMPLES = 3  # 主题至少有这么多条 LLM 标注的示例微博后才参与本地匹配
+MAX_TOPIC_EXAMPLES = 50  # 每个主题最多累计的示例微博数
+MAX_LOCAL_TOPICS = 3  # 每条微博最多在本地分配的主题数
+
+_HASHTAG = re.compile(r'#[^#]{1,40}#')
+
+
+def _topic_text(text):
+    """主题匹配用的正文：去掉 #话题# 标签（每条微博都带，匹配时只看标签之外的内容）。"""
+    return _HASHTAG.sub(' ', str(text))
+
+
+class TopicMatcher:
+    """
+    已有主题的本地检索索引：字符 2~3-gram 哈希特征上的 TF-IDF 余弦相似度。
+    每个主题的向量由主题名和 LLM 已分配给该主题的示例微博累加而成，随着 LLM 给出新主题和新示例增量更新。
+    match 对一批微博向量化地计算与所有主题的相似度，相似度足够高且没有歧义的微博直接分配已有主题。线程安全。
+    """
+
+    def __init__(self, threshold=TOPIC_MATCH_THRESHOLD, margin=TOPIC_MATCH_MARGIN, n_features=TOPIC_FEATURES,
+                 min_examples=MIN_TOPIC_EXAMPLES, max_examples=MAX_TOPIC_EXAMPLES, max_topics=MAX_LOCAL_TOPICS):
+        self.threshold = threshold
+        self.margin = margin
+        self.n_features = n_features
+        self.min_examples = min_examples
+        self.max_examples = max_examples
+        self.max_topics = max_topics
+        self.topics = []
+        self._index = {}  # 主题名 -> 行号
+        self._profiles = np.zeros((0, n_features), dtype=np.float32)
+        self._examples = np.zeros(0, dtype=np.int64)
+        self._df = np.zeros(n_features, dtype=np.float32)  # 每个特征出现过的微博数
+        self._docs = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'checked': 0, 'matched': 0, 'ambiguous': 0}
+
+    def _vectors(self, texts):
+        """对数词频向量，形状 (len(texts), n_features)。"""
+        indices, offsets = hashed_ngrams([_topic_text(text) for text in texts], self.n_features, (2, 3))
+        rows = np.repeat(np.arange(len(texts)), np.diff(offsets))
+        vectors = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        np.add.at(vectors, (rows, indices), 1)
+        return np.log1p(vectors)
+
+    def _observe(self, vectors):
+        self._df += (vectors > 0).sum(axis=0)
+        self._docs += len(vectors)
+
+    def _add_topic(self, name):
+        if name in self._index:
+            return self._index[name]
+        self._index[name] = len(self.topics)
+        self.topics.append(name)
+        self._profiles = np.vstack([self._profiles, self._vectors([name])])
+        self._examples = np.append(self._examples, 0)
+        return self._index[name]
+
+    def update(self, texts, topic_lists):
+        """用 LLM 给出的结果更新索引：新主题加入索引，微博作为示例累加到所分配主题的向量上。"""
+        texts = list(texts)
+        if not texts:
+            return
+        vectors = self._vectors(texts)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-9)
+        with self._lock:
+            for vector, topics_list in zip(vectors, topic_lists):
+                for name in topics_list:
+                    row = self._add_topic(name)
+                    if self._examples[row] < self.max_examples:
+                        self._profiles[row] += vector
+                        self._examples[row] += 1
+
+    def match(self, texts):
+        """
+        返回与 texts 等长的列表：能在本地确定主题的微博为主题名列表，
+        没有足够相似的已有主题或有歧义的微博为 None（需要交给 LLM）。
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        vectors = self._vectors(texts)
+        with self._lock:
+            self._observe(vectors)
+            self.stats['checked'] += len(texts)
+            ready = np.flatnonzero(self._examples >= self.min_examples)
+            if not len(ready):
+                return [None] * len(texts)
+            idf = np.log((self._docs + 1) / (self._df + 1)) + 1
+            profiles = self._profiles[ready] * idf
+            names = [self.topics[row] for row in ready]
+        profiles /= np.maximum(np.linalg.norm(profiles, axis=1, keepdims=True), 1e-9)
+        queries = vectors * idf
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-9)
+        similarity = queries @ profiles.T
+
+        results = []
+        for row in similarity:
+            order = np.argsort(row)[::-1]
+            best = row[order[0]]
+            second = row[order[1]] if len(order) > 1 else 0.0
+            if best < self.threshold:
+                results.append(None)
+            elif second < self.threshold and best - second < self.margin:
+                results.append(None)
+                self.stats['ambiguous'] += 1
+            else:
+                chosen = [names[i] for i in order[:self.max_topics] if row[i] >= self.threshold]
+                results.append(chosen)
+                self.stats['matched'] += 1
+        return results
+
+    def report(self):
+        stats = self.stats
+        print('本地主题匹配：检查 {} 条，直接分配已有主题 {} 条，有歧义交给 LLM {} 条，当前索引 {} 个主题'.format(
+            stats['checked'], stats['matched'], stats['ambiguous'], len(self.topics)))
+
+
+TOPIC_ALIAS_SIMILARITY = 0.8  # 两个主题名的字符 2-gram Dice 相似度不低于该值时才考虑归并
+TOPIC_ALIAS_EDIT_SIMILARITY = 0.85  # 且按字符顺序的编辑相似度（1 - 编辑距离 / 较长名的长度）不低于该值
+MAX_PROMPT_TOPICS = 30  # 每次请求最多在 query 中列出的已有主题数
+TOPIC_RELEVANCE = 0.3  # 主题名中至少有这个比例的 2-gram 出现在本批微博里时视为相关
+
+_TOPIC_NOISE = re.compile(r'[\s\W_的]+')  # 归并主题名时忽略的空白、标点和“的”
+_NEGATION = re.compile('[不没无非未否别勿莫]')  # 否定词：否定词不同的两个主题名不归并
+
+
+def topic_key(name) -> str:
+    """主题名的归并键：NFKC、转小写，去掉空白、标点和“的”。"""
+    return _TOPIC_NOISE.sub('', normalize_text(name).lower())
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def edit_similarity(a, b) -> float:
+    """按字符顺序的相似度：1 - 编辑距离 / 较长字符串的长度。对调两个词（如主语和宾语）会明显拉低相似度。"""
+    if not a or not b:
+        return float(a == b)
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return 1 - previous[-1] / max(len(a), len(b))
+
+
+class TopicRegistry:
+    """
+    主题词表：把 LLM 给出的近义、只差标点或个别字的主题名归并到首次出现的规范主题
+    （2-gram Dice 相似度和按顺序的编辑相似度都足够高、且否定词相同时才归并，
+    “中国对美国加征关税”和“美国对中国加征关税”、“支持延迟退休”和“不支持延迟退休”不会被归并），
+    记录每个规范主题的讨论量，并为每个批次挑选最相关和最常见的 top-k 主题放进 query，
+    避免主题列表随分析进度无限增长。可以像主题名列表一样迭代、计数和判断成员。线程安全。
+    """
+
+    def __init__(self, topics=(), similarity=TOPIC_ALIAS_SIMILARITY, edit_similarity=TOPIC_ALIAS_EDIT_SIMILARITY):
+        self.similarity = similarity
+        self.edit_similarity = edit_similarity
+        self.topics = []  # 规范主题名，按首次出现顺序
+        self.counts = {}
+        self.aliases = {}  # 归并键 -> 规范主题名
+        self._grams = {}  # 规范主题名 -> 归并键的 2-gram 集合
+        self._postings = {}  # 2-gram -> 含有它的规范主题名
+        self._lock = threading.Lock()
+        for name in topics:
+            self.add([name])
+            self.counts[self.resolve(name)] = 0
+
+    def __iter__(self):
+        return iter(list(self.topics))
+
+    def __len__(self):
+        return len(self.topics)
+
+    def __contains__(self, name):
+        return name in self.counts
+
+    def __repr__(self):
+        return repr(self.topics)
+
+    def _lookup(self, key):
+        """按归并键找到规范主题名，没有足够相似的已有主题时返回 None。"""
+        if key in self.aliases:
+            return self.aliases[key]
+        grams = _bigrams(key)
+        candidates = {name for gram in grams for name in self._postings.get(gram, ())}
+        negations = sorted(_NEGATION.findall(key))
+        best, best_score = None, self.similarity
+        for name in candidates:
+            other = self._grams[name]
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score < best_score:
+                continue
+            other_key = topic_key(name)
+            if sorted(_NEGATION.findall(other_key)) != negations \
+                    or edit_similarity(key, other_key) < self.edit_similarity:
+                continue
+            best, best_score = name, score
+        return best
+
+    def _register(self, name):
+        """登记一个新的规范主题。"""
+        self.topics.append(name)
+        self.counts[name] = 0
+        self._grams[name] = _bigrams(topic_key(name))
+        for gram in self._grams[name]:
+            self._postings.setdefault(gram, []).append(name)
+
+    def state(self):
+        """可 JSON 序列化的词表状态，可用 from_state 恢复。"""
+        with self._lock:
+            return {"topics": list(self.topics), "counts": dict(self.counts), "aliases": dict(self.aliases)}
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        """从 state() 的结果恢复主题词表。"""
+        registry = cls(**kwargs)
+        for name in state["topics"]:
+            registry._register(name)
+        registry.counts.update(state["counts"])
+        registry.aliases.update(state["aliases"])
+        return registry
+
+    def resolve(self, name):
+        """返回主题名对应的规范主题名，不登记新主题；没有对应的已有主题时原样返回。"""
+        name = str(name).strip()
+        with self._lock:
+            return self._lookup(topic_key(name)) or name
+
+    def add(self, topics_list):
+        """
+        登记一条微博的主题：逐个映射为规范主题（新主题成为规范主题，近义名记为别名），
+        规范主题的讨论量加一，返回去重后的规范主题名列表。
+        """
+        canonical = []
+        with self._lock:
+            for name in topics_list:
+                name = str(name).strip()
+                key = topic_key(name)
+                if not key:
+                    continue
+                target = self._lookup(key)
+                if target is None:
+                    target = name
+                    self._register(target)
+                self.aliases.setdefault(key, target)
+                if target not in canonical:
+                    canonical.append(target)
+                    self.counts[target] += 1
+        return canonical
+
+    def prompt_topics(self, texts, k=MAX_PROMPT_TOPICS, relevance=TOPIC_RELEVANCE):
+        """
+        为一批微博挑选放进 query 的已有主题：先按相关度（主题名 2-gram 出现在这批正文中的比例，
+        不低于 relevance）和讨论量挑选相关主题，再用讨论量最高的主题补足 k 个。
+        """
+        grams = set()
+        for text in texts:
+            grams |= _bigrams(topic_key(near_dup_text(text)))
+        with self._lock:
+            scored = [(len(self._grams[name] & grams) / len(self._grams[name]), self.counts[name], name)
+                      for name in self.topics]
+        relevant = sorted((item for item in scored if item[0] >= relevance), key=lambda item: item[:2], reverse=True)
+        chosen = [name for _, _, name in relevant[:k]]
+        for _, _, name in sorted(scored, key=lambda item: item[1], reverse=True):
+            if len(chosen) >= k:
+                break
+            if name not in chosen:
+                chosen.append(name)
+        return chosen
+
+    def report(self):
+        print('主题词表：{} 个规范主题，归并了 {} 个近义主题名'.format(
+            len(self.topics), len(self.aliases) - len(self.topics)))
+
+
+# 用户查询的规则解析：话题标签、日期（ISO 和中文格式）和平台名
+_QUERY_HASHTAG = re.compile(r'#([^#\n]{1,40})#')
+_QUERY_DATES = [
+    re.compile(r'(?<!\d)(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*[日号]?'),
+    re.compile(r'(?<!\d)(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})(?!\d)'),
+    re.compile(r'(?<!\d)(\d{4})(\d{2})(\d{2})(?!\d)'),
+]
+_RELATIVE_DATE = re.compile(r'今天|昨天|前天|明天|上周|本周|这周|上个月|本月|这个月|去年|今年')
+PLATFORM_NAMES = {
+    "weibo": ("微博", "weibo", "新浪"),
+    "douyin": ("抖音", "douyin", "tiktok"),
+    "xiaohongshu": ("小红书", "xiaohongshu"),
+    "zhihu": ("知乎", "zhihu"),
+    "bilibili": ("b站", "哔哩哔哩", "bilibili"),
+    "wechat": ("微信", "公众号", "wechat"),
+    "twitter": ("推特", "twitter"),
+}
+
+
+def parse_crawl_query(text):
+    """
+    不调用 LLM，用规则从用户查询中提取爬取参数：#话题# 关键词、日期（2025-04-09、2025/4/9、2025.4.9、20250409、
+    2025年4月9日 等）和平台名。返回与 Coordinator 回复相同结构的字典（event_keywords、start_year、start_month、
+    start_day、event_release_platform）；信息不全或有歧义（没有话题标签、没有或有多个不同日期、含相对日期、
+    没有或有多个平台）时返回 None，交给 Coordinator 处理。
+    """
+    text = unicodedata.normalize('NFKC', str(text))
+    keywords = list(dict.fromkeys(f"#{keyword.strip()}#" for keyword in _QUERY_HASHTAG.findall(text)
+                                  if keyword.strip()))
+    rest = _QUERY_HASHTAG.sub(' ', text)
+    if not keywords or _RELATIVE_DATE.search(rest):
+        return None
+
+    dates = set()
+    for pattern in _QUERY_DATES:
+        for year, month, day in pattern.findall(rest):
+            try:
+                dates.add(datetime.date(int(year), int(month), int(day)))
+            except ValueError:
+                return None
+        rest = pattern.sub(' ', rest)
+    lowered = rest.lower()
+    platforms = [name for name, aliases in PLATFORM_NAMES.items() if any(alias in lowered for alias in aliases)]
+    if len(dates) != 1 or len(platforms) != 1:
+        return None
+
+    date = dates.pop()
+    return {
+        "event_keywords": keywords,
+        "start_year": str(date.year),
+        "start_month": str(date.month),
+        "start_day": str(date.day),
+        "event_release_platform": platforms[0],
+    }
@@ -0,0 +1,27 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# 测试直接导入仓库根目录下的模块（utils、local_models 等）
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """在临时目录中运行（输出文件和提示词都按相对路径读写）。"""
+    shutil.copytree(os.path.join(REPO_ROOT, "prompts"), tmp_path / "prompts")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def mock_backend(monkeypatch):
+    """新建的 agent 默认使用不联网的 MockBackend。"""
+    import llm_backends
+
+    backend = llm_backends.MockBackend()
+    monkeypatch.setattr(llm_backends, "_default_backend", backend)
+    return backend
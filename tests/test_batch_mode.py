@@ -0,0 +1,49 @@
+import os
+import shutil
+
+import pandas as pd
+
+import utils
+
+
+def write_posts(path, texts):
+    pd.DataFrame({"微博正文": texts}).to_csv(path, index=False, encoding="utf-8")
+    return str(path)
+
+
+def run_job(csv_file):
+    batch_file = utils.emit_batch_requests(csv_file, "sentiment", near_duplicates=False)
+    utils.fabricate_batch_results(batch_file)
+    return utils.ingest_batch_results(csv_file, "sentiment", cache_file=None, online_repair=False)
+
+
+JOB_A = [f"第一批微博：城市交通第{i}条讨论" for i in range(5)]
+JOB_B = [f"第二批微博：食品安全第{i}条评论" for i in range(3)]
+
+
+def test_two_jobs_back_to_back(workdir):
+    counts_a, output_file, complete_a = run_job(write_posts(workdir / "a.csv", JOB_A))
+    assert complete_a and sum(counts_a.values()) == len(JOB_A)
+
+    counts_b, _, complete_b = run_job(write_posts(workdir / "b.csv", JOB_B))
+    assert complete_b and sum(counts_b.values()) == len(JOB_B)
+    output = pd.read_csv(output_file, encoding="utf-8")
+    assert list(output["微博正文"]) == JOB_A + JOB_B
+
+
+def test_stale_state_from_another_job_is_ignored(workdir):
+    _, output_file, _ = run_job(write_posts(workdir / "a.csv", JOB_A))
+    state_file = utils.batch_paths("sentiment")[3]
+    shutil.copy(state_file, workdir / "stale_state.json")
+
+    csv_b = write_posts(workdir / "b.csv", JOB_B)
+    batch_file = utils.emit_batch_requests(csv_b, "sentiment", near_duplicates=False)
+    assert not os.path.exists(state_file)
+    utils.fabricate_batch_results(batch_file)
+    # 模拟留下了上一个任务的进度文件
+    shutil.copy(workdir / "stale_state.json", state_file)
+    counts, _, complete = utils.ingest_batch_results(csv_b, "sentiment", cache_file=None, online_repair=False)
+
+    assert complete and sum(counts.values()) == len(JOB_B)
+    output = pd.read_csv(output_file, encoding="utf-8")
+    assert list(output["微博正文"]) == JOB_A + JOB_B
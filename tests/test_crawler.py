@@ -0,0 +1,219 @@
+import os
+
+import pandas as pd
+import pytest
+
+import WeiboCrawler as W
+
+
+def feed_html(posts, has_next=False):
+    """拼出一页搜索结果：posts 为 [(mid, 昵称, 'HH:MM', 正文), ...]，日期固定为 2025-01-01。"""
+    items = ''.join(
+        f'<div action-type="feed_list_item" mid="{mid}">'
+        f'<p node-type="feed_list_content" nick-name="{name}">{text}</p>'
+        f'<div class="from"> 2025年01月01日 {clock} 来自 iPhone</div>'
+        f'<div class="card-act"><ul><li>1</li><li>2</li><li>3</li></ul></div></div>'
+        for mid, name, clock, text in posts)
+    return '<html><body>' + items + ('<a class="next">下一页</a>' if has_next else '') + '</body></html>'
+
+
+@pytest.fixture
+def result_file(tmp_path):
+    return str(tmp_path / '微博数据_test.csv')
+
+
+def test_refetch_keeps_unretried_pages_and_matches_header(result_file, monkeypatch):
+    pd.DataFrame([{'页码': 1, '微博昵称': 'a', '发布时间': '2025年01月01日 00:10', '微博来源': 'iPhone',
+                   '转发数': '1', '评论数': '2', '点赞数': '3', '微博正文': '关税 旧微博', '微博ID': '1',
+                   '匹配关键词': '关税'}]).to_csv(result_file, index=False, encoding='utf_8_sig')
+    for page in (2, 3, 4):
+        W.record_failed_page(result_file, '关税', '2025-01-01-00', '2025-01-01-01', page, 'HTTP 503')
+
+    calls = []
+
+    def fake_fetch(v_keyword, v_start_time, v_end_time, page, pacer=None):
+        calls.append(page)
+        if page == 2:
+            return feed_html([('2', 'b', '00:20', '关税 补爬到的微博')])
+        if page == 3:
+            raise W.FetchError('HTTP 503')
+        raise KeyboardInterrupt  # 模拟补爬到第 4 页时被打断
+
+    monkeypatch.setattr(W, 'fetch_page', fake_fetch)
+    with pytest.raises(KeyboardInterrupt):
+        W.refetch_failed_pages(result_file)
+    failed = pd.read_csv(W.failed_pages_file(result_file), encoding='utf_8_sig')
+    assert sorted(failed['页码']) == [3, 4]
+
+    monkeypatch.setattr(W, 'fetch_page', lambda *args, **kwargs: feed_html([]))
+    assert W.refetch_failed_pages(result_file) == 0
+    assert not os.path.exists(W.failed_pages_file(result_file))
+
+    result = pd.read_csv(result_file, encoding='utf_8_sig', dtype={'微博ID': str})
+    assert list(result['微博ID']) == ['1', '2']
+    assert list(result['匹配关键词']) == ['关税', '关税']
+    assert calls == [2, 3, 4]
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class FakeSession:
+    """按顺序返回 outcomes 中的响应或抛出其中的异常，最后一个结果重复使用。"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def session(monkeypatch):
+    """用 FakeSession 代替共享的 requests.Session，重试不等待。"""
+    def install(*outcomes):
+        fake = FakeSession(*outcomes)
+        monkeypatch.setattr(W, 'get_session', lambda: fake)
+        return fake
+
+    monkeypatch.setattr(W, '_retry_delay', lambda attempt, response=None: 0)
+    return install
+
+
+def test_fetch_page_retries_transient_transport_errors(session):
+    fake = session(W.requests.exceptions.ChunkedEncodingError('连接中断'),
+                   W.requests.exceptions.ContentDecodingError('解码失败'),
+                   FakeResponse(200, '<html></html>'))
+    assert W.fetch_page('关税', '2025-01-01-00', '2025-01-01-01', 1) == '<html></html>'
+    assert fake.calls == 3
+
+
+def test_fetch_page_wraps_other_request_errors(session):
+    fake = session(W.requests.TooManyRedirects('重定向过多'))
+    with pytest.raises(W.FetchError, match='TooManyRedirects'):
+        W.fetch_page('关税', '2025-01-01-00', '2025-01-01-01', 1)
+    assert fake.calls == 1
+
+
+def test_transport_errors_are_recorded_not_raised(session, result_file):
+    session(W.requests.TooManyRedirects('重定向过多'))
+    W.crawl_windows('关税', [('2025-01-01-00', '2025-01-01-01')], result_file, max_workers=2)
+    failed = pd.read_csv(W.failed_pages_file(result_file), encoding='utf_8_sig')
+    assert list(failed['页码']) == list(range(1, W.MAX_CONSECUTIVE_FAILURES + 1))
+
+
+def stub_pages(monkeypatch, pages, fail=None):
+    """
+    用 pages 代替联网请求：(关键词, 开始时间, 页码) -> 页面 HTML，没有列出的页为空页（最后一页）。
+    fail(关键词, 开始时间, 页码) 返回 True 时该页抛出 RuntimeError（模拟进程在爬取中途崩溃）。返回请求记录。
+    """
+    calls = []
+
+    def fake_fetch(v_keyword, v_start_time, v_end_time, page, pacer=None):
+        calls.append((v_keyword, v_start_time, page))
+        if fail is not None and fail(v_keyword, v_start_time, page):
+            raise RuntimeError('进程被中断')
+        return pages.get((v_keyword, v_start_time, page), feed_html([]))
+
+    monkeypatch.setattr(W, 'fetch_page', fake_fetch)
+    return calls
+
+
+HOURS = [('2025-01-01-00', '2025-01-01-01'), ('2025-01-01-01', '2025-01-01-02'), ('2025-01-01-02', '2025-01-01-03')]
+HOUR_PAGES = {
+    ('关税', '2025-01-01-00', 1): feed_html([('10', 'a', '00:10', '关税 第一小时')]),
+    ('关税', '2025-01-01-01', 1): feed_html([('20', 'b', '01:10', '关税 第二小时第一页')], has_next=True),
+    ('关税', '2025-01-01-01', 2): feed_html([('21', 'c', '01:20', '关税 第二小时第二页')]),
+    ('关税', '2025-01-01-02', 1): feed_html([('30', 'd', '02:10', '关税 第三小时')]),
+}
+
+
+def test_resume_after_interrupted_window(monkeypatch, result_file):
+    checkpoint = W.CrawlCheckpoint(W.checkpoint_file(result_file))
+    stub_pages(monkeypatch, HOUR_PAGES, fail=lambda keyword, start, page: (start, page) == ('2025-01-01-01', 2))
+    with pytest.raises(RuntimeError):
+        W.crawl_windows('关税', HOURS, result_file, checkpoint=checkpoint)
+    written = pd.read_csv(result_file, encoding='utf_8_sig', dtype={'微博ID': str})
+    assert list(written['微博ID']) == ['10']
+
+    # 重新运行：已写出的第一小时直接跳过，被中断的第二小时从头重爬
+    checkpoint = W.CrawlCheckpoint(W.checkpoint_file(result_file))
+    calls = stub_pages(monkeypatch, HOUR_PAGES)
+    W.crawl_windows('关税', HOURS, result_file, checkpoint=checkpoint)
+    assert all(start != '2025-01-01-00' for _, start, _ in calls)
+    assert ('关税', '2025-01-01-01', 1) in calls
+    result = pd.read_csv(result_file, encoding='utf_8_sig', dtype={'微博ID': str})
+    assert list(result['微博ID']) == ['10', '20', '21', '30']
+
+
+def test_duplicates_by_mid_and_hash_across_pages_and_keywords(monkeypatch, result_file):
+    window = ('2025-01-01-00', '2025-01-01-01')
+    shared = ('1', 'a', '00:10', '美国 关税 同时命中两个关键词')
+    no_mid = ('', 'b', '00:20', '美国 关税 没有 mid 的微博')
+    pages = {
+        ('关税', window[0], 1): feed_html([shared, no_mid], has_next=True),
+        ('关税', window[0], 2): feed_html([shared, no_mid, ('2', 'c', '00:30', '关税 只在第二页')]),
+        ('美国', window[0], 1): feed_html([shared, no_mid]),
+    }
+    stub_pages(monkeypatch, pages)
+    stats = W.crawl_windows(['关税', '美国'], [window], result_file)
+
+    result = pd.read_csv(result_file, encoding='utf_8_sig', dtype={'微博ID': str})
+    assert list(result['微博正文']) == [shared[3], no_mid[3], '关税 只在第二页']
+    assert list(result['匹配关键词']) == ['关税,美国', '关税,美国', '关税']
+    assert stats['duplicate_mid'] == 1 and stats['duplicate_hash'] == 1 and stats['cross_keyword'] == 2
+
+    # 再次爬取同一时间段不会重复写入
+    W.crawl_windows(['关税', '美国'], [window], result_file)
+    assert len(pd.read_csv(result_file, encoding='utf_8_sig')) == 3
+
+
+def test_offline_replay_treats_cache_miss_as_last_page(monkeypatch, tmp_path, result_file):
+    cache = W.PageCache(str(tmp_path / 'pages'))
+    stub_pages(monkeypatch, HOUR_PAGES)
+    W.crawl_windows('关税', HOURS[1:2], result_file, cache=cache)
+    online = pd.read_csv(result_file, encoding='utf_8_sig', dtype={'微博ID': str})
+    assert list(online['微博ID']) == ['20', '21']
+
+    # 删掉第 2 页的缓存后离线重放：不发任何请求，缺失的页按最后一页处理
+    os.remove(cache._path(cache.key(W.search_params('关税', *HOURS[1], 2))))
+    calls = stub_pages(monkeypatch, {})
+    replay_file = str(tmp_path / 'replay.csv')
+    W.crawl_windows('关税', HOURS[1:2], replay_file, cache=W.PageCache(str(tmp_path / 'pages')), offline=True)
+    assert calls == []
+    replayed = pd.read_csv(replay_file, encoding='utf_8_sig', dtype={'微博ID': str})
+    assert list(replayed['微博ID']) == ['20']
+
+
+def test_page_cache_evicts_least_recently_used(tmp_path):
+    cache = W.PageCache(str(tmp_path / 'pages'), max_bytes=10 ** 9)
+    fetched_at = W.datetime.datetime(2025, 1, 1)
+    params = [W.search_params('关税', '2025-01-01-00', '2025-01-01-01', page) for page in (1, 2, 3)]
+    for age, p in zip((300, 200, 100), params):
+        cache.put(p, feed_html([(str(age), 'a', '00:10', '关税' * 50)]), fetched_at)
+        path = cache._path(cache.key(p))
+        os.utime(path, (W.time.time() - age, W.time.time() - age))
+    assert cache.get(params[0]) is not None  # 读取后第 1 页变为最近使用
+
+    cache.max_bytes = sum(cache._sizes.values())
+    cache.put(W.search_params('关税', '2025-01-01-00', '2025-01-01-01', 4), feed_html([]), fetched_at)
+    assert cache.get(params[1]) is None
+    assert cache.get(params[0]) is not None and cache.get(params[2]) is not None
+
+
+def test_fetch_page_honours_retry_after(monkeypatch):
+    fake = FakeSession(FakeResponse(429, headers={'Retry-After': '7'}), FakeResponse(200, '<html></html>'))
+    monkeypatch.setattr(W, 'get_session', lambda: fake)
+    delays = []
+    monkeypatch.setattr(W.time, 'sleep', delays.append)
+    assert W.fetch_page('关税', '2025-01-01-00', '2025-01-01-01', 1) == '<html></html>'
+    assert delays == [7.0] and fake.calls == 2
@@ -0,0 +1,23 @@
+import pytest
+
+import utils
+
+
+def test_results_are_delivered_in_order():
+    results = []
+    utils.run_ordered(lambda item: item * item, range(10), lambda item, result: results.append((item, result)),
+                      max_in_flight=3)
+    assert results == [(i, i * i) for i in range(10)]
+
+
+@pytest.mark.parametrize("max_in_flight", [0, -1])
+def test_max_in_flight_below_one_is_rejected(max_in_flight):
+    with pytest.raises(ValueError, match="max_in_flight"):
+        utils.run_ordered(lambda item: item, [1, 2], lambda item, result: None, max_in_flight=max_in_flight)
+
+
+def test_entry_points_validate_before_doing_work(tmp_path):
+    with pytest.raises(ValueError, match="max_in_flight"):
+        utils.perform_sentiment_analysis(str(tmp_path / "missing.csv"), max_in_flight=0)
+    with pytest.raises(ValueError, match="max_in_flight"):
+        utils.run_streaming_pipeline(2025, 1, 1, ["交通"], max_in_flight=0)
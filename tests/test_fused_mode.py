@@ -0,0 +1,21 @@
+import os
+
+import pandas as pd
+
+import utils
+
+
+def test_fused_output_is_separate_from_two_stage_merge(workdir, mock_backend):
+    texts = [f"关于城市交通的第{i}条讨论，内容各不相同{i * 7}" for i in range(6)]
+    pd.DataFrame({"微博正文": texts}).to_csv("posts.csv", index=False, encoding="utf-8")
+    # 上一次两阶段运行留下的合并表不应混入融合模式的统计
+    pd.DataFrame({"编号": [1], "微博正文": ["旧微博"], "topics": ["旧主题"], "sentiment": ["negative"]}) \
+        .to_csv("merged_output.csv", index=False, encoding="utf-8")
+
+    sentiment_counts, topic_counts, output_file = utils.perform_fused_analysis("posts.csv", cache_file=None)
+
+    assert output_file == utils.FUSED_OUTPUT != "merged_output.csv"
+    assert len(pd.read_csv(output_file, encoding="utf-8")) == len(texts)
+    aggregated = utils.analyze_merged_output(output_file)
+    assert "旧主题" not in str(aggregated)
+    assert os.path.exists("merged_output.csv")
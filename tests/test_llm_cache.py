@@ -0,0 +1,62 @@
+import pytest
+
+import llm_cache
+from llm_cache import LLMCache
+
+
+class Clock:
+    """可控的 time.time()。"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock)
+    return clock
+
+
+def test_hits_survive_rechunking_and_whitespace(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many("model", "prompt", [("今天 天气​不错", {"sentiment": "positive"})])
+    assert cache.get_many("model", "prompt", ["今天  天气不错", "别的微博"]) == [{"sentiment": "positive"}, None]
+    assert cache.get_many("model", "another prompt", ["今天 天气不错"]) == [None]
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 2
+    cache.close()
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMCache(path, ttl=60)
+    cache.put_many("model", "prompt", [("微博", {"sentiment": "neutral"})])
+    clock.now += 59
+    assert cache.get_many("model", "prompt", ["微博"]) == [{"sentiment": "neutral"}]
+    clock.now += 2
+    assert cache.get_many("model", "prompt", ["微博"]) == [None]
+    cache.close()
+
+    # 重新打开时过期条目被删除
+    reopened = LLMCache(path, ttl=60)
+    assert reopened.stats["evicted"] == 1
+    reopened.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(llm_cache, "EVICT_EVERY", 1)
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), ttl=None, max_entries=2)
+    for text in ("第一条", "第二条"):
+        cache.put_many("model", "prompt", [(text, {"sentiment": "neutral"})])
+        clock.now += 1
+    cache.get_many("model", "prompt", ["第一条"])  # 第一条变为最近使用
+    clock.now += 1
+    cache.put_many("model", "prompt", [("第三条", {"sentiment": "negative"})])
+
+    assert cache.get_many("model", "prompt", ["第一条", "第二条", "第三条"]) == [
+        {"sentiment": "neutral"}, None, {"sentiment": "negative"}]
+    assert cache.stats["evicted"] == 1
+    cache.close()
@@ -0,0 +1,74 @@
+import pytest
+
+import llm_scheduler
+from Agents import SentimentAnalysistAgent
+from conftest import REPO_ROOT
+from llm_backends import MockAPIError, MockBackend
+from llm_scheduler import LLMRateLimitError, LLMRequestError, LLMScheduler
+
+
+class FlakyBackend(MockBackend):
+    """前 len(errors) 次调用依次抛出 errors 中的错误，之后按 MockBackend 正常回复。"""
+
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = list(errors)
+
+    def complete(self, model, messages):
+        if self.errors:
+            self.stats["calls"] += 1
+            raise self.errors.pop(0)
+        return super().complete(model, messages)
+
+
+def rate_limited(retry_after):
+    error = MockAPIError(429)
+    error.response.headers["retry-after"] = str(retry_after)
+    return error
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """记录重试前的等待秒数，不真正等待。"""
+    delays = []
+    monkeypatch.setattr(llm_scheduler.time, "sleep", delays.append)
+    return delays
+
+
+def test_429_with_retry_after_then_success(sleeps):
+    backend = FlakyBackend([rate_limited(3)])
+    scheduler = LLMScheduler()
+    messages = [{"role": "system", "content": "sentiment_analysist"}, {"role": "user", "content": "1: 好消息"}]
+    response = scheduler.call(lambda: backend.complete("model", messages), 100)
+
+    assert '"sentiment"' in response.choices[0].message.content
+    assert sleeps == [3.0]
+    assert scheduler.stats["requests"] == 2 and scheduler.stats["retries"] == 1 and scheduler.stats["failures"] == 0
+    assert scheduler.stats["used_tokens"] == response.usage.total_tokens
+
+
+def test_agent_call_retries_through_shared_scheduler(sleeps, monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "_schedulers", {})
+    backend = FlakyBackend([rate_limited(5), MockAPIError(503)])
+    agent = SentimentAnalysistAgent(f"{REPO_ROOT}/prompts/Sentiment_analysist_prompt.txt", backend=backend)
+    reply = agent.run("1: 今天天气不错")
+
+    assert '"id": 1' in reply
+    assert sleeps[0] == 5.0 and len(sleeps) == 2
+    assert backend.stats["calls"] == 3
+
+
+def test_retries_run_out_with_typed_error(sleeps):
+    scheduler = LLMScheduler(max_retries=2)
+    backend = FlakyBackend([rate_limited(1)] * 3)
+    with pytest.raises(LLMRateLimitError) as info:
+        scheduler.call(lambda: backend.complete("model", []), 10)
+    assert info.value.attempts == 3 and sleeps == [1.0, 1.0]
+
+
+def test_client_errors_are_not_retried(sleeps):
+    scheduler = LLMScheduler()
+    backend = FlakyBackend([MockAPIError(400)])
+    with pytest.raises(LLMRequestError):
+        scheduler.call(lambda: backend.complete("model", []), 10)
+    assert sleeps == [] and scheduler.stats["failures"] == 1
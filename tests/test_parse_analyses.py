@@ -0,0 +1,37 @@
+import json
+
+from utils import clean_json_output, parse_analyses
+
+ENTRIES = [{"id": 1, "sentiment": "positive"}, {"id": 2, "sentiment": "negative"}, {"id": 3, "sentiment": "neutral"}]
+
+
+def test_bare_array_reply():
+    assert parse_analyses(json.dumps(ENTRIES)) == ENTRIES
+
+
+def test_fenced_array_reply():
+    assert parse_analyses("```json\n" + json.dumps(ENTRIES) + "\n```") == ENTRIES
+
+
+def test_object_reply_with_surrounding_text():
+    reply = "以下是分析结果：\n" + json.dumps({"analyses": ENTRIES}) + "\n以上。"
+    assert parse_analyses(reply) == ENTRIES
+
+
+def test_object_reply_with_trailing_comma():
+    reply = '{"analyses": [{"id": 1, "sentiment": "positive"}, {"id": 2, "sentiment": "negative"},]}'
+    assert parse_analyses(reply) == ENTRIES[:2]
+
+
+def test_truncated_array_keeps_first_entry():
+    reply = json.dumps(ENTRIES)[:-20]
+    assert parse_analyses(reply) == ENTRIES[:2]
+
+
+def test_truncated_object_is_salvaged():
+    reply = json.dumps({"analyses": ENTRIES})[:-20]
+    assert parse_analyses(reply) == ENTRIES[:2]
+
+
+def test_plain_text_is_returned_stripped():
+    assert clean_json_output("  总结：舆情整体平稳。 ") == "总结：舆情整体平稳。"
@@ -0,0 +1,53 @@
+import random
+
+import numpy as np
+import pandas as pd
+
+from local_models import SentimentClassifier, sentiment_agreement_report
+from utils import classify_locally
+
+WORDS = {"positive": ["太好了", "点赞", "支持", "开心", "感谢"],
+         "negative": ["愤怒", "垃圾", "失望", "太差", "离谱"],
+         "neutral": ["据报道", "发布", "通知", "时间", "消息"]}
+FILLER = list("的了是在有这个我们城市交通天气工作学校医院公司新闻")
+
+
+def write_labels(path, informative, n=1500, seed=0):
+    """生成带情感标注的微博：informative 为 False 时标签与正文无关（像随机标注）。"""
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        label = rng.choice(list(WORDS))
+        text = "".join(rng.choice(FILLER) for _ in range(rng.randint(10, 40)))
+        text += "".join(rng.choice(WORDS[label]) for _ in range(2))
+        rows.append((text, label if informative else rng.choice(list(WORDS))))
+    pd.DataFrame(rows, columns=["微博正文", "sentiment"]).to_csv(path, index=False, encoding="utf-8")
+    return str(path)
+
+
+def test_informative_labels_enable_a_validated_threshold(tmp_path):
+    model, report = sentiment_agreement_report(write_labels(tmp_path / "labels.csv", True))
+    assert model.confidence is not None
+    chosen = report[report["threshold"] == model.confidence].iloc[0]
+    assert chosen["local_agreement"] >= 0.95
+
+
+def test_uninformative_labels_default_to_llm_only(tmp_path):
+    model, report = sentiment_agreement_report(write_labels(tmp_path / "labels.csv", False))
+    assert model.confidence is None
+    # 校准后的打分不再饱和：随机标注下几乎没有微博达到高置信度
+    assert report.loc[report["threshold"] == 0.9, "local_share"].iloc[0] < 0.05
+
+    df = pd.DataFrame({"微博正文": ["今天天气不错", "交通太差了"]})
+    stats = {}
+    out = list(classify_locally([df], model, stats=stats))
+    assert "本地结果" not in out[0] and not stats
+
+
+def test_save_and_load_keep_calibration(tmp_path):
+    model, _ = sentiment_agreement_report(write_labels(tmp_path / "labels.csv", True))
+    model.save(str(tmp_path / "sentiment.npz"))
+    loaded = SentimentClassifier.load(str(tmp_path / "sentiment.npz"))
+    assert loaded.scale == model.scale and loaded.confidence == model.confidence
+    texts = ["点赞支持", "太差离谱"]
+    assert np.allclose(loaded.predict_proba(texts), model.predict_proba(texts))
@@ -0,0 +1,23 @@
+import pandas as pd
+
+import utils
+
+
+def fake_crawl(posts):
+    """代替 run_weibo_crawl：把 posts 作为一个时间段的结果交给 on_write。"""
+    def crawl(year, month, day, keywords, on_write=None, **kwargs):
+        on_write(pd.DataFrame({"微博正文": posts}))
+        return "微博数据_test.csv"
+    return crawl
+
+
+def test_streaming_reports_near_duplicates_for_every_stage(workdir, mock_backend, monkeypatch, capsys):
+    posts = ["转发这条微博，关于城市交通拥堵的长篇讨论内容"] * 3 + ["另外一条完全不同的关于食品安全的微博内容"]
+    monkeypatch.setattr(utils, "run_weibo_crawl", fake_crawl(posts))
+
+    _, sentiment_counts, _, _, _ = utils.run_streaming_pipeline(2025, 1, 1, ["交通"], cache_file=None)
+
+    out = capsys.readouterr().out
+    assert "情感分析阶段：近似重复折叠：检查 4 条" in out
+    assert "主题分析阶段：近似重复折叠：检查 4 条" in out
+    assert sum(sentiment_counts.values()) == len(posts)
@@ -0,0 +1,26 @@
+import pytest
+
+from local_models import TopicRegistry, edit_similarity
+
+
+def test_near_identical_names_are_merged():
+    registry = TopicRegistry(["新冠疫情防控"])
+    assert registry.add(["新冠疫情的防控", "“新冠疫情防控”"]) == ["新冠疫情防控"]
+    assert list(registry) == ["新冠疫情防控"]
+
+
+@pytest.mark.parametrize("existing, new", [
+    ("美国对中国加征关税", "中国对美国加征关税"),
+    ("支持延迟退休", "不支持延迟退休"),
+    ("外卖平台涨价", "外卖平台没涨价"),
+])
+def test_reversed_or_negated_names_stay_separate(existing, new):
+    registry = TopicRegistry([existing])
+    assert registry.resolve(new) == new
+    assert registry.add([new]) == [new]
+    assert list(registry) == [existing, new]
+
+
+def test_edit_similarity_is_order_aware():
+    assert edit_similarity("美国对中国加征关税", "美国对中国加征关税") == 1.0
+    assert edit_similarity("中国对美国加征关税", "美国对中国加征关税") < 0.85
@@ -10,22 +10,62 @@ import re
 import pandas as pd
 import json
 import os
+import hashlib
 from tqdm import tqdm
 import csv
+import queue
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
-from Agents import Coordinator, SentimentAnalysistAgent, TopicModellingAgent, Summarizer
+from Agents import Coordinator, SentimentAnalysistAgent, TopicModellingAgent, FusedAnalysisAgent, Summarizer, \
+    load_prompt, model_for
+from llm_backends import MockBackend
 from WeiboCrawler import *
+from llm_cache import LLMCache, LLM_CACHE_FILE
+from llm_scheduler import LLMCallError, LLMRateLimitError, LLMTransientError
+from local_models import NearDuplicateIndex, SentimentClassifier, TopicRegistry, estimate_tokens, \
+    SENTIMENT_LABELS, parse_crawl_query
+
+TOKEN_BUDGET = 2000  # 每次调用分析 agent 时发送的微博正文的 token 上限（估算值）
+MAX_ENTRIES = 20  # 每次调用分析 agent 最多发送的微博条数
+ENTRY_OVERHEAD = 4  # 每条微博在 query 中的额外 token（编号、分隔符、换行）
+MAX_IN_FLIGHT = 4  # 每个分析阶段同时进行的 LLM 请求数
+MAX_REPAIR_ROUNDS = 2  # 回复中缺失或无效的条目最多补发请求的轮数
+SENTIMENT_OUTPUT = "sentiment_analysis_output.csv"
+TOPIC_OUTPUT = "topic_modelling_output.csv"
+FUSED_OUTPUT = "fused_output.csv"  # 与 merge_and_analyze 写出的 merged_output.csv 分开，避免混入两阶段模式的结果
+SENTIMENT_PROMPT = "./prompts/Sentiment_analysist_prompt.txt"
+TOPIC_PROMPT = "./prompts/Topic_modelling_prompt.txt"
+FUSED_PROMPT = "./prompts/Fused_analysis_prompt.txt"
+BATCH_URL = "/v1/chat/completions"  # 批处理模式中每个请求的接口
+BATCH_STATE_EVERY = 20  # 批处理结果写回时每写回这么多个批次保存一次进度
+
+_CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+
 
 def clean_json_output(response_str: str) -> str:
     """
-    清洗 agent 返回的字符串，去除 markdown 代码块标记（例如 ```json 和 ```），确保字符串以 { 开头，以 } 结尾。
+    清洗 agent 返回的字符串，去除 markdown 代码块标记（例如 ```json 和 ```）。
+    去掉代码块标记后已经是合法 JSON（对象或数组）时直接返回，否则确保字符串以 { 开头，以 } 结尾。
     """
+    match = _CODE_FENCE.search(response_str)
+    for text in ([match.group(1).strip()] if match else []) + [response_str.strip()]:
+        try:
+            json.loads(text)
+            return text
+        except json.JSONDecodeError:
+            pass
     # 使用正则表达式提取代码块内的内容
-    pattern = r'```json\s*(\{.*\})\s*```'
+    pattern = r'```(?:json)?\s*(\{.*\})\s*```'
     match = re.search(pattern, response_str, re.DOTALL)
     if match:
         return match.group(1).strip()
-    # 如果没有匹配到 markdown 格式，则直接返回原字符串
+    # 如果没有匹配到 markdown 格式，截取第一个 { 到最后一个 } 之间的内容（去掉前后的说明文字）
+    start, end = response_str.find('{'), response_str.rfind('}')
+    if start != -1 and end > start:
+        return response_str[start:end + 1].strip()
     return response_str.strip()
 
 def merge_and_analyze(sentiment_output, topic_output):
@@ -59,7 +99,27 @@ def merge_and_analyze(sentiment_output, topic_output):
     # 保存合并结果
     merged_df.to_csv("merged_output.csv", index=False, encoding="utf-8")
     print("合并完成，结果保存在 merged_output.csv")
-    
+    return aggregate_topic_sentiment(merged_df)
+
+
+def analyze_merged_output(merged_output):
+    """
+    读取融合模式直接写出的合并表（perform_fused_analysis 或融合模式的 run_streaming_pipeline 返回的输出文件，
+    默认为 fused_output.csv），统计每个 topics 对应的 sentiment 数量。
+    """
+    merged_df = pd.read_csv(merged_output, encoding="utf-8")
+    return aggregate_topic_sentiment(merged_df)
+
+
+def aggregate_topic_sentiment(merged_df):
+    """
+    对包含 topics 和 sentiment 两列的合并表，删除“微博正文”和“编号”两列，并删除“topics”列为空的行，
+    然后统计每个 topics 对应的 sentiment 数量，按照各 topic 的总计数降序排序，
+    结果保存到 aggregated_topic_sentiment.csv。
+
+    返回:
+        每个 topics 对应的 sentiment 数量统计 DataFrame
+    """
     # 删除“微博正文”和“编号”两列（如果存在）
     merged_df = merged_df.drop(columns=["微博正文", "编号"], errors='ignore')
     
@@ -72,7 +132,7 @@ def merge_and_analyze(sentiment_output, topic_output):
     # 遍历 merged_df 中的每一行数据
     for idx, row in merged_df.iterrows():
         topics_str = row["topics"]
-        sentiment = row["sentiment"].strip()  # 预期为 negative、neutral 或 positive
+        sentiment = str(row["sentiment"]).strip()  # 预期为 negative、neutral 或 positive
         # 拆分 topics，多个主题以逗号分隔
         topics_list = [t.strip() for t in topics_str.split(",") if t.strip()]
         
@@ -119,19 +179,31 @@ def merge_and_analyze(sentiment_output, topic_output):
     
     return result_df 
 
-def conversation_loop():
+def ask_crawl_parameters(coordinator):
     """
-    与用户持续对话，直到 agent 返回包含所有必需信息的 JSON 格式回复，
-    此时调用微博爬虫，并返回生成的 CSV 文件名和事件关键字。
+    与用户持续对话，直到 Coordinator 返回包含所有必需信息的 JSON 格式回复。
+    每次输入先用规则在本地解析（见 local_models.parse_crawl_query），信息完整且没有歧义时不调用 Coordinator。
+    返回 (year, month, day, event_keywords)。
     """
-    coordinator = Coordinator(prompt_filepath='./prompts/Coordinator_prompt.txt')
-    
     while True:
         user_text = input("请输入查询内容：")
-        # 调用 Coordinator 处理用户输入
-        response = coordinator.run(user_text)
-        response = clean_json_output(response)
-        print("Agent 回复：", response)
+        local_result = parse_crawl_query(user_text)
+        if local_result is not None:
+            response = json.dumps(local_result, ensure_ascii=False)
+            print("本地解析：", response)
+        else:
+            # 本地解析不完整或有歧义时，调用 Coordinator 处理用户输入
+            try:
+                response = coordinator.run(user_text)
+            except LLMCallError as e:
+                print(e)
+                continue
+            response = clean_json_output(response)
+            print("Agent 回复：", response)
+            usage = coordinator.turn_usage[-1] if coordinator.turn_usage else None
+            if usage:
+                print("本轮用量：历史 {} 轮，输入 {} tokens，输出 {} tokens，耗时 {} 秒".format(
+                    usage["history_turns"], usage["prompt_tokens"], usage["completion_tokens"], usage["seconds"]))
         
         # 尝试解析回复为 JSON 格式
         try:
@@ -151,79 +223,558 @@ def conversation_loop():
                     print("时间信息格式有误，请检查后重试。", e)
                     continue
 
-                # 保存事件关键字（列表格式），取第一个关键字作为爬虫关键字
-                event_keywords = result["event_keywords"]
-                keyword = event_keywords[0].strip("#")
-                
-                # 回复格式完整时调用爬虫，并返回 CSV 文件名和事件关键字
-                csv_file = run_weibo_crawl(year, month, day, keyword)
-                print("微博爬虫已启动，爬取任务开始执行。")
-                return csv_file, event_keywords
+                return year, month, day, result["event_keywords"]
+        except json.JSONDecodeError:
+            continue
+
+
+def conversation_loop():
+    """
+    与用户持续对话，直到 agent 返回包含所有必需信息的 JSON 格式回复，
+    此时调用微博爬虫，并返回生成的 CSV 文件名和事件关键字。
+    """
+    coordinator = Coordinator(prompt_filepath='./prompts/Coordinator_prompt.txt')
+    year, month, day, event_keywords = ask_crawl_parameters(coordinator)
+
+    # 保存事件关键字（列表格式），所有关键字在同一个爬取任务中一起爬取
+    keywords = [keyword.strip("#") for keyword in event_keywords]
+
+    # 回复格式完整时调用爬虫，并返回 CSV 文件名和事件关键字
+    csv_file = run_weibo_crawl(year, month, day, keywords)
+    print("微博爬虫已启动，爬取任务开始执行。")
+    return csv_file, event_keywords
+
+
+def streaming_conversation_loop(**pipeline_kwargs):
+    """
+    与 conversation_loop 相同地收集爬取参数，然后以流式流水线边爬取边分析。
+    返回 (csv_file, event_keywords, sentiment_counts, sentiment_output, topic_counts, topic_output)。
+    """
+    coordinator = Coordinator(prompt_filepath='./prompts/Coordinator_prompt.txt')
+    year, month, day, event_keywords = ask_crawl_parameters(coordinator)
+    keywords = [keyword.strip("#") for keyword in event_keywords]
+    csv_file, sentiment_counts, sentiment_output, topic_counts, topic_output = run_streaming_pipeline(
+        year, month, day, keywords, **pipeline_kwargs)
+    return csv_file, event_keywords, sentiment_counts, sentiment_output, topic_counts, topic_output
+
+
+def init_output_file(output_file, header):
+    """检查输出文件是否存在，若不存在则先创建并写入表头。"""
+    if not os.path.exists(output_file):
+        with open(output_file, "w", newline='', encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+
+
+def number_chunk(chunk):
+    """为一个批次的数据重新编号（从 1 开始，写入“编号”列）。"""
+    chunk = chunk.copy()
+    chunk.reset_index(drop=True, inplace=True)
+    chunk['编号'] = chunk.index + 1
+    return chunk
+
+
+def entry_costs(df):
+    """每条微博发送给 LLM 的估算 token 数；不需要发送的微博（近似重复、已有本地结果）记为 0。"""
+    return [estimate_tokens(text) + ENTRY_OVERHEAD if needed else 0
+            for text, needed in zip(df['微博正文'], needs_llm(df))]
+
+
+def pack_batches(frames, token_budget=TOKEN_BUDGET, max_entries=MAX_ENTRIES):
+    """
+    把任意大小的 DataFrame 流（例如整个 CSV，或爬虫逐个时间段写出的结果）按 token 预算打包成批次：
+    每批发送的微博正文估算 token 数不超过 token_budget，条数不超过 max_entries，
+    短微博多的时候每批更满、请求更少；单条超过预算的长微博单独成批。
+    每个批次重新编号后立即产出，流结束时产出最后一个不满的批次。
+    """
+    pending = None
+    for df in frames:
+        if df.empty:
+            continue
+        pending = df if pending is None else pd.concat([pending, df], ignore_index=True)
+        pending = pending.reset_index(drop=True)
+        start = 0
+        tokens = entries = 0
+        for i, cost in enumerate(entry_costs(pending)):
+            if cost and entries and tokens + cost > token_budget:
+                yield number_chunk(pending.iloc[start:i])
+                start = i
+                tokens = entries = 0
+            tokens += cost
+            entries += bool(cost)
+            if entries >= max_entries:
+                yield number_chunk(pending.iloc[start:i + 1])
+                start = i + 1
+                tokens = entries = 0
+        pending = pending.iloc[start:]
+    if pending is not None and len(pending):
+        yield number_chunk(pending)
+
+
+def _run_coroutine(coro):
+    """
+    同步地运行一个协程并返回结果。
+    如果当前线程已有事件循环在运行（例如在 Jupyter 中），就在单独的线程里运行，避免 asyncio.run 报错。
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def check_max_in_flight(max_in_flight):
+    """校验同时进行的请求数 max_in_flight，小于 1 时抛出 ValueError（否则调度器永远无法发出请求）。"""
+    if max_in_flight < 1:
+        raise ValueError(f"max_in_flight 必须不小于 1，收到 {max_in_flight!r}")
+
+
+async def dispatch_ordered(func, items, on_result, max_in_flight=MAX_IN_FLIGHT):
+    """
+    基于 asyncio 的有界并发调度器：对 items 中的每个元素在线程中调用阻塞函数 func（例如一次 LLM 请求），
+    最多同时进行 max_in_flight 个；结果严格按 items 的原始顺序交给 on_result(item, result)，
+    因此写文件、累计统计等操作仍在单一线程中按顺序完成。
+    items 可以是任意（可能阻塞的）可迭代对象，例如流式流水线里的队列，取下一个元素也在线程中进行。
+    func 抛出的异常会在轮到该元素时原样抛出。max_in_flight 小于 1 时抛出 ValueError。
+    """
+    check_max_in_flight(max_in_flight)
+    loop = asyncio.get_running_loop()
+    # 额外一个线程用于从 items 中取下一个元素
+    executor = ThreadPoolExecutor(max_workers=max_in_flight + 1)
+    iterator = iter(items)
+    end = object()
+    pending = deque()  # 按原始顺序排列的 (item, future)
+    next_item = loop.run_in_executor(executor, next, iterator, end)
+    try:
+        while next_item is not None or pending:
+            waits = [pending[0][1]] if pending else []
+            if next_item is not None and len(pending) < max_in_flight:
+                waits.append(next_item)
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+
+            if next_item is not None and next_item.done() and len(pending) < max_in_flight:
+                item = next_item.result()
+                if item is end:
+                    next_item = None
+                else:
+                    pending.append((item, loop.run_in_executor(executor, func, item)))
+                    next_item = loop.run_in_executor(executor, next, iterator, end)
+
+            # 队首完成后才交付结果，保证顺序
+            while pending and pending[0][1].done():
+                item, future = pending.popleft()
+                on_result(item, future.result())
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run_ordered(func, items, on_result, max_in_flight=MAX_IN_FLIGHT):
+    """dispatch_ordered 的同步版本。max_in_flight 为 1 时等价于逐个串行调用。"""
+    return _run_coroutine(dispatch_ordered(func, items, on_result, max_in_flight))
+
+
+def open_llm_cache(cache_file):
+    """cache_file 为 None 时不使用缓存，否则打开（或创建）对应的 LLM 结果缓存。"""
+    return LLMCache(cache_file) if cache_file else None
+
+
+def close_llm_cache(cache):
+    if cache is not None:
+        cache.report()
+        cache.close()
+
+
+def mark_near_duplicates(frames, index):
+    """
+    给数据流中的每个 DataFrame 加上“序号”（在整个数据流中的位置）和“代表序号”（所属近似重复簇的代表的序号）两列，
+    代表序号与序号不同的微博是近似重复，不需要再发送给 LLM。index 为 None 时原样产出（不折叠）。
+    """
+    if index is None:
+        yield from frames
+        return
+    seq = 0
+    for chunk in frames:
+        chunk = chunk.copy()
+        ids = list(range(seq, seq + len(chunk)))
+        seq += len(chunk)
+        chunk['序号'] = ids
+        chunk['代表序号'] = [index.assign(text, i) for text, i in zip(chunk['微博正文'], ids)]
+        yield chunk
+
+
+def duplicate_mask(chunk):
+    """chunk 中每条微博是否为近似重复（不是所在簇的代表）。"""
+    if '代表序号' not in chunk:
+        return [False] * len(chunk)
+    return list(chunk['代表序号'] != chunk['序号'])
+
+
+def classify_locally(frames, classifier, confidence=None, stats=None):
+    """
+    用本地情感分类器对数据流中的每个 DataFrame 整体打分，置信度不低于 confidence 的微博
+    在“本地结果”列中记下 {"sentiment": 标签}，这些微博不再交给 LLM；其余为 None。
+    confidence 为 None 时使用分类器经 sentiment_agreement_report 验证的阈值（classifier.confidence），
+    分类器没有验证过的阈值时不启用本地结果，全部交给 LLM。
+    classifier 为 None 时原样产出。stats 字典（可选）累计 'local'（本地给出结果）和 'total' 条数。
+    """
+    if classifier is not None and confidence is None:
+        confidence = classifier.confidence
+        if confidence is None:
+            print("本地情感分类器没有经一致率验证的置信度阈值（见 sentiment_agreement_report），全部交给 LLM")
+            classifier = None
+    for df in frames:
+        if classifier is not None and not df.empty:
+            df = df.copy()
+            labels, scores = classifier.predict(df['微博正文'].astype(str))
+            df['本地结果'] = [{"sentiment": label} if score >= confidence else None
+                          for label, score in zip(labels, scores)]
+            if stats is not None:
+                stats['total'] = stats.get('total', 0) + len(df)
+                stats['local'] = stats.get('local', 0) + int((scores >= confidence).sum())
+        yield df
+
+
+def load_classifier(classifier):
+    """classifier 可以是 SentimentClassifier、保存的模型文件路径（.npz）或 None。"""
+    if isinstance(classifier, str):
+        return SentimentClassifier.load(classifier)
+    return classifier
+
+
+def needs_llm(chunk):
+    """chunk 中每条微博是否需要交给 LLM：既不是近似重复，也没有本地结果。"""
+    local = chunk['本地结果'] if '本地结果' in chunk else [None] * len(chunk)
+    return [not duplicate and not isinstance(result, dict) for duplicate, result in zip(duplicate_mask(chunk), local)]
+
+
+def match_topics_locally(frames, matcher, block_size=MAX_ENTRIES):
+    """
+    用本地主题匹配索引（TopicMatcher）为数据流中的微博分配已有主题。每个 DataFrame 切成 block_size 条一块，
+    在打包批次需要时才匹配，这样索引已经吸收了此前批次的 LLM 结果；匹配成功的微博在“本地结果”列中
+    记下 {"topics": [...]}，不再交给 LLM，未匹配或有歧义的微博仍交给 LLM 发现新主题。matcher 为 None 时原样产出。
+    """
+    for df in frames:
+        if matcher is None or df.empty:
+            yield df
+            continue
+        for start in range(0, len(df), block_size):
+            block = df.iloc[start:start + block_size].copy()
+            results = list(block['本地结果']) if '本地结果' in block else [None] * len(block)
+            todo = [i for i, needed in enumerate(needs_llm(block)) if needed]
+            for i, topics_list in zip(todo, matcher.match(block['微博正文'].iloc[todo])):
+                if topics_list:
+                    results[i] = {"topics": topics_list}
+            block['本地结果'] = results
+            yield block
+
+
+def learn_topics(matcher, chunk, analyses, topics=None):
+    """
+    把 LLM 对一个批次给出的主题（不含本地结果和近似重复）加入本地主题匹配索引。
+    topics 为 TopicRegistry 时先把主题名映射为规范主题。
+    """
+    if matcher is None:
+        return
+    rows = [i for i, needed in enumerate(needs_llm(chunk)) if needed]
+    topic_lists = [topics_of(analyses[i]) for i in rows]
+    if isinstance(topics, TopicRegistry):
+        topic_lists = [list(dict.fromkeys(topics.resolve(topic) for topic in topics_list))
+                       for topics_list in topic_lists]
+    matcher.update(chunk['微博正文'].iloc[rows], topic_lists)
+
+
+_LINE_COMMENT = re.compile(r'^\s*//.*$', re.M)
+_TRAILING_COMMA = re.compile(r',\s*([\]}])')
+
+
+def repair_json(text):
+    """宽松地解析 JSON：直接解析失败时去掉 // 注释行和多余的尾随逗号再解析，仍失败时抛出 json.JSONDecodeError。"""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(_TRAILING_COMMA.sub(r'\1', _LINE_COMMENT.sub('', text)))
+
+
+def salvage_objects(text):
+    """
+    从无法整体解析（例如被截断）的回复中逐个取出能够解析的 JSON 对象；
+    能整体解析的 {"analyses": [...]} 对象展开为其中的条目，无法解析的外层对象跳过，继续找里面的条目。
+    """
+    decoder = json.JSONDecoder()
+    items = []
+    pos = text.find('{')
+    while pos != -1:
+        try:
+            item, end = decoder.raw_decode(text, pos)
         except json.JSONDecodeError:
+            pos = text.find('{', pos + 1)
             continue
+        if isinstance(item, dict) and isinstance(item.get("analyses"), list):
+            items.extend(entry for entry in item["analyses"] if isinstance(entry, dict))
+        elif isinstance(item, dict):
+            items.append(item)
+        pos = text.find('{', end)
+    return items
+
+
+def parse_analyses(response):
+    """
+    取出 LLM 回复中的 analyses 条目列表：先整体解析（容忍代码块标记、前后说明文字、注释和尾随逗号），
+    回复可以是 {"analyses": [...]} 对象，也可以直接是条目数组；整体解析失败时逐个恢复其中能解析的条目。
+    """
+    cleaned = clean_json_output(response)
+    try:
+        data = repair_json(cleaned)
+    except json.JSONDecodeError as e:
+        print("JSON解析失败，逐条恢复:", e)
+        return salvage_objects(cleaned)
+    if isinstance(data, dict):
+        data = data.get("analyses", [])
+    return data if isinstance(data, list) else []
+
+
+def validate_analysis(item, fields):
+    """
+    校验一条结果，返回只保留 fields 中各字段的字典；缺少字段或取值无效时返回 None。
+    sentiment 必须是 positive / neutral / negative 之一（统一为小写），topics 必须是主题列表（允许为空）。
+    """
+    if not isinstance(item, dict):
+        return None
+    result = {}
+    for field in fields:
+        value = item.get(field)
+        if field == "sentiment":
+            value = str(value).strip().lower()
+            if value not in SENTIMENT_LABELS:
+                return None
+        elif field == "topics":
+            if isinstance(value, str):
+                value = value.split(",")
+            if not isinstance(value, list):
+                return None
+            value = [str(topic).strip() for topic in value if str(topic).strip()]
+        elif value is None:
+            return None
+        result[field] = value
+    return result
+
+
+def align_analyses(entries, size):
+    """
+    把解析出的条目按 "id"（请求中的编号 1..size）对齐到请求的各条微博，返回长度为 size 的列表，缺失的位置为 None。
+    所有条目都没有 id 时，只有条数恰好为 size 才按顺序对齐，否则无法确定对应关系，全部视为缺失。
+    """
+    aligned = [None] * size
+    ids = []
+    for item in entries:
+        try:
+            ids.append(int(item.get("id")) if isinstance(item, dict) else None)
+        except (TypeError, ValueError):
+            ids.append(None)
+    if any(number is not None for number in ids):
+        for item, number in zip(entries, ids):
+            if number is not None and 1 <= number <= size and aligned[number - 1] is None:
+                aligned[number - 1] = item
+        return aligned
+    if len(entries) == size:
+        return list(entries)
+    return aligned
+
+
+def request_analyses(chunk, agent, ask, fields, cache=None):
+    """
+    为一个批次（已编号）请求逐条分析结果，返回与 chunk 等长、按原顺序排列的列表
+    （每条为只保留 fields 中各字段的字典，例如 {"sentiment": ...}）。
+    近似重复的微博不发送给 LLM，对应位置为 None，写出时由 fan_out 取所在簇代表的结果；
+    已有本地结果（“本地结果”列，见 classify_locally）的微博直接采用本地结果；
+    给定 cache 时先逐条查缓存，只把未命中的微博（重新编号）交给 ask(sub_chunk) 请求 LLM。
+    回复按条目的 id 对齐并逐条校验（见 parse_analyses、validate_analysis、align_analyses），
+    缺失或无效的条目（以及限流、临时错误重试用尽的整个请求）重新编号后单独补发请求，最多 MAX_REPAIR_ROUNDS 轮；有效的结果逐条写入缓存，
+    补发后仍没有有效结果的位置为空字典。
+    """
+    texts = list(chunk['微博正文'])
+    analyses = [None] * len(chunk)
+    if '本地结果' in chunk:
+        for i, result in enumerate(chunk['本地结果']):
+            if isinstance(result, dict):
+                analyses[i] = result
+    todo = [i for i, needed in enumerate(needs_llm(chunk)) if needed]
+    if cache is not None and todo:
+        cached = cache.get_many(agent.model, agent.system_prompt, [texts[i] for i in todo])
+        for i, item in zip(todo, cached):
+            analyses[i] = item
+        todo = [i for i, item in zip(todo, cached) if item is None]
+    if not todo:
+        return analyses
+
+    for attempt in range(MAX_REPAIR_ROUNDS + 1):
+        if attempt:
+            print(f"{len(todo)} 条结果缺失或无效，补发请求")
+        sub_chunk = number_chunk(chunk.iloc[todo])
+        try:
+            response = ask(sub_chunk)
+        except (LLMRateLimitError, LLMTransientError) as e:
+            # 调度器的重试已用尽，这些微博留到下一轮补发；不可重试的错误照常抛出
+            print(e)
+            continue
+        print(clean_json_output(response))
+        entries = align_analyses(parse_analyses(response), len(sub_chunk))
+        fresh = [validate_analysis(item, fields) for item in entries]
+        done = [(i, item) for i, item in zip(todo, fresh) if item is not None]
+        for i, item in done:
+            analyses[i] = item
+        if cache is not None and done:
+            cache.put_many(agent.model, agent.system_prompt, [(texts[i], item) for i, item in done])
+        todo = [i for i, item in zip(todo, fresh) if item is None]
+        if not todo:
+            return analyses
+    print(f"警告：{len(todo)} 条微博补发 {MAX_REPAIR_ROUNDS} 次后仍没有有效的分析结果！")
+    for i in todo:
+        analyses[i] = {}
+    return analyses
+
+
+def fan_out(chunk, analyses, labels):
+    """
+    把簇代表的分析结果复制给同簇的近似重复微博，返回补全后的列表。
+    labels 记录每个代表序号的结果，必须按数据的原始顺序调用（代表总是先于它的重复出现）。
+    """
+    if '代表序号' not in chunk:
+        return analyses
+    analyses = list(analyses)
+    for pos, (seq, rep) in enumerate(zip(chunk['序号'], chunk['代表序号'])):
+        if seq == rep:
+            labels[seq] = analyses[pos]
+        else:
+            analyses[pos] = labels.get(rep, {})
+    return analyses
+
+
+def sentiment_query(chunk):
+    """拼接情感分析的 query：每行一条 “编号: 微博正文”。"""
+    # 拼接每条微博文本（假设 CSV 中的“微博正文”列包含文本）
+    query_lines = chunk.apply(lambda row: f"{row['编号']}: {row['微博正文']}", axis=1)
+    return "\n".join(query_lines)
+
+
+def request_sentiment(chunk, agent, cache=None):
+    """为一个批次（已编号）请求情感分析，返回逐条结果列表（见 request_analyses）。"""
+    return request_analyses(chunk, agent, lambda sub_chunk: agent.run(sentiment_query(sub_chunk)),
+                            ("sentiment",), cache)
+
+
+def sentiment_of(item, sentiment_counts):
+    """取出一条结果中的情感（原样返回，用于写文件），并累加到 sentiment_counts。"""
+    sentiment = (item or {}).get("sentiment") or ""
+    label = str(sentiment).strip().lower()
+    if label in sentiment_counts:
+        sentiment_counts[label] += 1
+    return sentiment
 
 
-def perform_sentiment_analysis(csv_file: str):
+def topics_of(item):
+    """取出一条结果中的主题列表（去掉空白和空主题）。"""
+    topics_list = (item or {}).get("topics") or []
+    if isinstance(topics_list, str):
+        topics_list = topics_list.split(",")
+    return [str(topic).strip() for topic in topics_list if str(topic).strip()]
+
+
+def update_topics(topic_lists, topics, topic_counts):
     """
-    读取 CSV 文件，分批调用情感分析 agent，
-    并累计统计情感结果。同时将每条微博文本及对应的情感写入 "public_opinion.csv" 文件。
-    返回 sentiment_counts 字典。
+    把每条微博的主题加入主题列表 topics，并更新讨论量统计 topic_counts，返回实际计入的逐条主题列表。
+    topics 为 TopicRegistry（主题词表）时，近义的主题名先归并为规范主题，统计和返回的都是规范主题。
     """
+    merged = []
+    for topics_list in topic_lists:
+        if isinstance(topics, TopicRegistry):
+            topics_list = topics.add(topics_list)
+        for topic in topics_list:
+            if topic not in topics:
+                topics.append(topic)
+            if topic in topic_counts:
+                topic_counts[topic] += 1
+            else:
+                topic_counts[topic] = 1
+                print("新增主题：", topic)
+        merged.append(topics_list)
+    return merged
+
+
+def apply_sentiment_result(chunk, analyses, sentiment_counts, output_file, labels=None):
+    """
+    按逐条结果累加情感统计（近似重复的微博按其代表的情感计数），
+    并将每条微博文本及对应的情感追加写入 output_file。labels 见 fan_out。
+    """
+    analyses = fan_out(chunk, analyses, {} if labels is None else labels)
+    
+    # 将每条微博及对应情感写入文件，并更新累计情感统计
+    with open(output_file, "a", newline='', encoding="utf-8") as f:
+        writer = csv.writer(f)
+        for item, (_, row) in zip(analyses, chunk.iterrows()):
+            sentiment = sentiment_of(item, sentiment_counts)
+            writer.writerow([row["编号"], row["微博正文"], sentiment])
+
+
+def analyze_sentiment_chunk(chunk, sentiment_counts, output_file, agent=None):
+    """
+    对一个批次（已编号）调用情感分析 agent，累加情感统计，
+    并将每条微博文本及对应的情感追加写入 output_file。
+    agent 每次调用都是无状态的，可在所有批次间复用；未给定时新建一个（共享客户端和提示词缓存）。
+    """
+    if agent is None:
+        agent = SentimentAnalysistAgent(SENTIMENT_PROMPT)
+    apply_sentiment_result(chunk, request_sentiment(chunk, agent), sentiment_counts, output_file)
+
+
+def perform_sentiment_analysis(csv_file: str, max_in_flight=MAX_IN_FLIGHT, cache_file=LLM_CACHE_FILE,
+                               near_duplicates=True, token_budget=TOKEN_BUDGET, max_entries=MAX_ENTRIES,
+                               classifier=None, confidence=None):
+    """
+    读取 CSV 文件，分批调用情感分析 agent（最多 max_in_flight 个批次同时请求），
+    并累计统计情感结果。同时将每条微博文本及对应的情感按原始顺序写入 "sentiment_analysis_output.csv" 文件。
+    已分析过的微博直接从 cache_file（LLM 结果缓存，None 表示不使用）中读取，不再调用 LLM；
+    near_duplicates 为 True 时近似重复的微博（转发、模板、机器人）只分析每簇的代表，结果复制给同簇的其它微博。
+    每次请求发送的微博按 token 预算打包（见 pack_batches 的 token_budget、max_entries）。
+    给定本地情感分类器 classifier（SentimentClassifier 或模型文件路径）时，置信度不低于 confidence 的微博
+    直接采用本地结果，只有其余微博交给 LLM；confidence 默认取 local_models.sentiment_agreement_report
+    验证并记录在分类器中的阈值，没有验证过的阈值时全部交给 LLM。
+    返回 sentiment_counts 字典和输出文件名。
+    """
+    check_max_in_flight(max_in_flight)
     df = pd.read_csv(csv_file, encoding='utf-8')
-    chunk_size = 10
-    num_rows = len(df)
     sentiment_counts = {"positive": 0, "neutral": 0, "negative": 0}
     
     # 输出文件名
-    output_file = "sentiment_analysis_output.csv"
-    # 检查文件是否存在，若不存在则先创建并写入表头
-    if not os.path.exists(output_file):
-        with open(output_file, "w", newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["编号", "微博正文", "sentiment"])
+    output_file = SENTIMENT_OUTPUT
+    init_output_file(output_file, ["编号", "微博正文", "sentiment"])
     
-    for start in tqdm(range(0, num_rows, chunk_size), desc="Processing chunks"):
-        # 每个批次重新实例化 agent，避免对话历史过长
-        agent = SentimentAnalysistAgent("./prompts/Sentiment_analysist_prompt.txt")
-        
-        # 取出当前块数据，并为每条微博添加编号
-        chunk = df.iloc[start:start + chunk_size].copy()
-        chunk.reset_index(drop=True, inplace=True)
-        chunk['编号'] = chunk.index + 1
-        
-        # 拼接每条微博文本（假设 CSV 中的“微博正文”列包含文本）
-        query_lines = chunk.apply(lambda row: f"{row['编号']}: {row['微博正文']}", axis=1)
-        query = "\n".join(query_lines)
-        
-        response_str = agent.run(query)
-        cleaned_response = clean_json_output(response_str)
-        print(cleaned_response)
-        
-        try:
-            response_data = json.loads(cleaned_response)
-            # 更新累计情感统计
-            summary = response_data.get("summary", {})
-            sentiment_counts["positive"] += summary.get("positive", 0)
-            sentiment_counts["neutral"] += summary.get("neutral", 0)
-            sentiment_counts["negative"] += summary.get("negative", 0)
-            
-            # 获取每条微博对应的情感结果
-            analyses = response_data.get("analyses", [])
-            # 检查 analyses 数量是否与当前 chunk 数量一致
-            if len(analyses) != len(chunk):
-                print("警告：分析结果数量与原始数据数量不匹配！")
-            
-            # 将每条微博及对应情感写入文件
-            with open(output_file, "a", newline='', encoding="utf-8") as f:
-                writer = csv.writer(f)
-                for i, row in chunk.iterrows():
-                    if i < len(analyses):
-                        sentiment = analyses[i].get("sentiment", "")
-                    else:
-                        sentiment = ""
-                    writer.writerow([row["编号"], row["微博正文"], sentiment])
-        except json.JSONDecodeError as e:
-            print("JSON解析失败:", e)
+    # 整个分析过程复用同一个 agent（无状态调用，共享客户端）
+    agent = SentimentAnalysistAgent(SENTIMENT_PROMPT)
+    cache = open_llm_cache(cache_file)
+    index = NearDuplicateIndex() if near_duplicates else None
+    labels = {}
+    classifier = load_classifier(classifier)
+    local_stats = {}
+    frames = classify_locally(mark_near_duplicates([df], index), classifier, confidence, local_stats)
+    batches = list(pack_batches(frames, token_budget, max_entries))
+    progress = tqdm(total=len(batches), desc="Processing chunks")
+
+    def on_result(chunk, analyses):
+        apply_sentiment_result(chunk, analyses, sentiment_counts, output_file, labels)
+        progress.update(1)
+
+    try:
+        with progress:
+            run_ordered(lambda chunk: request_sentiment(chunk, agent, cache),
+                        batches, on_result, max_in_flight)
+    finally:
+        close_llm_cache(cache)
+    if index is not None:
+        index.report()
+    if classifier is not None:
+        print("本地情感分类器直接给出 {} / {} 条".format(local_stats.get('local', 0), local_stats.get('total', 0)))
 
     print("累计情感统计:")
     print("Positive:", sentiment_counts["positive"])
@@ -231,82 +782,114 @@ def perform_sentiment_analysis(csv_file: str):
     print("Negative:", sentiment_counts["negative"])
     return sentiment_counts, output_file
 
-def perform_topic_analysis(csv_file: str):
+
+def topic_query(chunk, topics):
+    """
+    拼接主题分析的 query：当前批次的公民意见和已确定的主题列表。
+    topics 为 TopicRegistry 时只列出与本批次最相关和讨论量最高的部分规范主题，query 长度不随主题数增长。
+    """
+    # 拼接每条公民意见数据（假设 CSV 中的“微博正文”列包含公民意见）
+    query_lines = chunk.apply(lambda row: f"{row['编号']}: {row['微博正文']}", axis=1)
+    opinions_text = "\n".join(query_lines)
+    
+    # 构造 query：包含当前批次的公民意见和已确定的主题列表
+    if isinstance(topics, TopicRegistry):
+        topics = topics.prompt_topics(chunk['微博正文'])
+    topics_str = ", ".join(list(topics)) if topics else "无"
+    query = (
+        f"请基于以下公民意见数据和当前主题列表进行主题分析：\n\n"
+        f"公民意见：\n{opinions_text}\n\n"
+        f"当前主题列表：{topics_str}\n\n"
+    )
+    return query
+
+
+def request_topics(chunk, topics, agent, cache=None):
     """
-    读取 CSV 文件，分批调用 TopicModellingAgent 进行主题分析，
-    并根据返回结果更新主题列表和统计每个主题的讨论量，同时将每条公民意见及对应的主题写入 "topic_modelling_output.csv" 文件。
-    返回更新后的主题列表和统计字典。
+    为一个批次（已编号）请求主题分析（query 中包含当前主题列表 topics），
+    返回逐条结果列表（见 request_analyses）。
     """
+    return request_analyses(chunk, agent, lambda sub_chunk: agent.run(topic_query(sub_chunk, topics)),
+                            ("topics",), cache)
+
+
+def apply_topic_result(chunk, analyses, topics, topic_counts, output_file, labels=None):
+    """
+    按逐条结果更新主题列表 topics 和讨论量统计 topic_counts（近似重复的微博按其代表的主题计数），
+    并将每条公民意见及对应的主题追加写入 output_file。labels 见 fan_out。
+    """
+    analyses = fan_out(chunk, analyses, {} if labels is None else labels)
+
+    # 更新主题列表和讨论量统计（主题词表会把近义主题名归并为规范主题）
+    topic_lists = update_topics([topics_of(item) for item in analyses], topics, topic_counts)
+
+    # 将每条公民意见及对应的主题写入文件
+    with open(output_file, "a", newline='', encoding="utf-8") as f:
+        writer = csv.writer(f)
+        for topics_list, (_, row) in zip(topic_lists, chunk.iterrows()):
+            writer.writerow([row["编号"], row["微博正文"], ", ".join(topics_list)])
+
+
+def analyze_topic_chunk(chunk, topics, topic_counts, output_file, agent=None):
+    """
+    对一个批次（已编号）调用 TopicModellingAgent 进行主题分析，
+    更新主题列表 topics 和讨论量统计 topic_counts，并将每条公民意见及对应的主题追加写入 output_file。
+    agent 的用法同 analyze_sentiment_chunk。
+    """
+    if agent is None:
+        agent = TopicModellingAgent(TOPIC_PROMPT)
+    apply_topic_result(chunk, request_topics(chunk, topics, agent), topics, topic_counts, output_file)
+
+
+def perform_topic_analysis(csv_file: str, max_in_flight=MAX_IN_FLIGHT, cache_file=LLM_CACHE_FILE,
+                           near_duplicates=True, token_budget=TOKEN_BUDGET, max_entries=MAX_ENTRIES, matcher=None):
+    """
+    读取 CSV 文件，分批调用 TopicModellingAgent 进行主题分析（最多 max_in_flight 个批次同时请求），
+    并根据返回结果更新主题列表和统计每个主题的讨论量，同时将每条公民意见及对应的主题按原始顺序写入 "topic_modelling_output.csv" 文件。
+    并发请求时，每个批次看到的是它发出请求时已确定的主题列表；max_in_flight 为 1 时与逐批串行完全一致。
+    主题列表是一个主题词表（TopicRegistry）：近义的主题名归并为规范主题后再写出和计数，
+    每个批次的 query 中只列出与该批次最相关和讨论量最高的部分主题。
+    cache_file、near_duplicates、token_budget 和 max_entries 的用法同 perform_sentiment_analysis。
+    给定本地主题匹配索引 matcher（TopicMatcher）时，与已有主题足够相似的微博直接在本地分配主题，
+    只有未匹配或有歧义的微博交给 LLM；索引随 LLM 给出的新主题和示例增量更新。
+    返回每个主题的讨论量统计字典和输出文件名。
+    """
+    check_max_in_flight(max_in_flight)
     initial_topics = []
     df = pd.read_csv(csv_file, encoding='utf-8')
-    chunk_size = 10
-    num_rows = len(df)
-    topics = initial_topics.copy()  # 初始化主题列表
+    topics = TopicRegistry(initial_topics)  # 初始化主题词表
     topic_counts = {}  # 初始化每个主题的讨论量统计
 
-    output_file = "topic_modelling_output.csv"
-    # 检查文件是否存在，若不存在则创建并写入表头
-    if not os.path.exists(output_file):
-        with open(output_file, "w", newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["编号", "微博正文", "topics"])
+    output_file = TOPIC_OUTPUT
+    init_output_file(output_file, ["编号", "微博正文", "topics"])
 
-    for start in tqdm(range(0, num_rows, chunk_size), desc="Processing chunks"):
-        # 每个批次重新实例化 agent，避免对话历史过长
-        agent = TopicModellingAgent("./prompts/Topic_modelling_prompt.txt")
-        
-        # 取出当前块数据，并为每条数据添加编号
-        chunk = df.iloc[start:start + chunk_size].copy()
-        chunk.reset_index(drop=True, inplace=True)
-        chunk['编号'] = chunk.index + 1
-        
-        # 拼接每条公民意见数据（假设 CSV 中的“微博正文”列包含公民意见）
-        query_lines = chunk.apply(lambda row: f"{row['编号']}: {row['微博正文']}", axis=1)
-        opinions_text = "\n".join(query_lines)
-        
-        # 构造 query：包含当前批次的公民意见和已确定的主题列表
-        topics_str = ", ".join(topics) if topics else "无"
-        query = (
-            f"请基于以下公民意见数据和当前主题列表进行主题分析：\n\n"
-            f"公民意见：\n{opinions_text}\n\n"
-            f"当前主题列表：{topics_str}\n\n"
-        )
-        
-        response_str = agent.run(query)
-        cleaned_response = clean_json_output(response_str)
-        print(cleaned_response)
-        
-        try:
-            response_data = json.loads(cleaned_response)
-            analyses = response_data.get("analyses", [])
-            # 将每条公民意见及对应的主题写入文件
-            with open(output_file, "a", newline='', encoding="utf-8") as f:
-                writer = csv.writer(f)
-                if len(analyses) != len(chunk):
-                    print("警告：分析结果数量与原始数据数量不匹配！")
-                for i, row in chunk.iterrows():
-                    if i < len(analyses):
-                        topics_list = analyses[i].get("topics", [])
-                        topics_output = ", ".join(topic.strip() for topic in topics_list if topic.strip())
-                    else:
-                        topics_output = ""
-                    writer.writerow([row["编号"], row["微博正文"], topics_output])
-            
-            # 更新主题列表和讨论量统计
-            for item in analyses:
-                topics_list = item.get("topics", [])
-                for topic in topics_list:
-                    topic = topic.strip()
-                    if topic:
-                        if topic not in topics:
-                            topics.append(topic)
-                            print("新增主题：", topic)
-                        if topic in topic_counts:
-                            topic_counts[topic] += 1
-                        else:
-                            topic_counts[topic] = 1
-        except json.JSONDecodeError as e:
-            print("JSON解析失败:", e)
+    agent = TopicModellingAgent(TOPIC_PROMPT)
+    cache = open_llm_cache(cache_file)
+    index = NearDuplicateIndex() if near_duplicates else None
+    labels = {}
+    frames = match_topics_locally(mark_near_duplicates([df], index), matcher)
+    batches = pack_batches(frames, token_budget, max_entries)
+    if matcher is None:
+        batches = list(batches)
+    # 本地匹配要在打包时才进行（此时索引已吸收之前的结果），批次数事先未知
+    progress = tqdm(total=None if matcher is not None else len(batches), desc="Processing chunks")
+
+    def on_result(chunk, analyses):
+        apply_topic_result(chunk, analyses, topics, topic_counts, output_file, labels)
+        learn_topics(matcher, chunk, analyses, topics)
+        progress.update(1)
+
+    try:
+        with progress:
+            run_ordered(lambda chunk: request_topics(chunk, topics, agent, cache),
+                        batches, on_result, max_in_flight)
+    finally:
+        close_llm_cache(cache)
+    if index is not None:
+        index.report()
+    if matcher is not None:
+        matcher.report()
+    topics.report()
 
     print("更新后的主题列表:")
     print(topics)
@@ -314,6 +897,447 @@ def perform_topic_analysis(csv_file: str):
     print(topic_counts)
     return topic_counts, output_file
 
+
+def request_fused(chunk, topics, agent, cache=None):
+    """
+    融合模式：一次请求同时得到一个批次（已编号）每条微博的情感和主题，
+    query 与主题分析相同（包含当前主题列表 topics），返回逐条结果列表（见 request_analyses）。
+    """
+    return request_analyses(chunk, agent, lambda sub_chunk: agent.run(topic_query(sub_chunk, topics)),
+                            ("sentiment", "topics"), cache)
+
+
+def apply_fused_result(chunk, analyses, sentiment_counts, topics, topic_counts, output_file, labels=None):
+    """
+    按逐条结果同时累加情感统计、更新主题列表和讨论量统计，
+    并将每条微博的编号、正文、主题和情感作为一行追加写入合并表 output_file。labels 见 fan_out。
+    """
+    analyses = fan_out(chunk, analyses, {} if labels is None else labels)
+    topic_lists = update_topics([topics_of(item) for item in analyses], topics, topic_counts)
+    with open(output_file, "a", newline='', encoding="utf-8") as f:
+        writer = csv.writer(f)
+        for item, topics_list, (_, row) in zip(analyses, topic_lists, chunk.iterrows()):
+            sentiment = sentiment_of(item, sentiment_counts)
+            writer.writerow([row["编号"], row["微博正文"], ", ".join(topics_list), sentiment])
+
+
+def perform_fused_analysis(csv_file: str, max_in_flight=MAX_IN_FLIGHT, cache_file=LLM_CACHE_FILE,
+                           near_duplicates=True, token_budget=TOKEN_BUDGET, max_entries=MAX_ENTRIES):
+    """
+    融合模式：读取 CSV 文件，分批调用 FusedAnalysisAgent，一次请求同时完成情感分析和主题分析，
+    请求数和输入 token 约为两阶段模式（perform_sentiment_analysis + perform_topic_analysis）的一半，
+    并直接按原始顺序写出合并表 FUSED_OUTPUT（fused_output.csv：编号, 微博正文, topics, sentiment），不再需要 merge_and_analyze。
+    其余参数的用法同 perform_sentiment_analysis。之后可用 analyze_merged_output(output_file) 统计每个主题的情感分布。
+    返回 (sentiment_counts, topic_counts, output_file)。
+    """
+    check_max_in_flight(max_in_flight)
+    df = pd.read_csv(csv_file, encoding='utf-8')
+    sentiment_counts = {"positive": 0, "neutral": 0, "negative": 0}
+    topics = TopicRegistry()
+    topic_counts = {}
+
+    output_file = FUSED_OUTPUT
+    init_output_file(output_file, ["编号", "微博正文", "topics", "sentiment"])
+
+    agent = FusedAnalysisAgent(FUSED_PROMPT)
+    cache = open_llm_cache(cache_file)
+    index = NearDuplicateIndex() if near_duplicates else None
+    labels = {}
+    batches = list(pack_batches(mark_near_duplicates([df], index), token_budget, max_entries))
+    progress = tqdm(total=len(batches), desc="Processing chunks")
+
+    def on_result(chunk, analyses):
+        apply_fused_result(chunk, analyses, sentiment_counts, topics, topic_counts, output_file, labels)
+        progress.update(1)
+
+    try:
+        with progress:
+            run_ordered(lambda chunk: request_fused(chunk, topics, agent, cache),
+                        batches, on_result, max_in_flight)
+    finally:
+        close_llm_cache(cache)
+    if index is not None:
+        index.report()
+    topics.report()
+
+    print("累计情感统计:", sentiment_counts)
+    print("每个主题的讨论量:", topic_counts)
+    return sentiment_counts, topic_counts, output_file
+
+
+# 批处理模式（Batch API）：每个阶段的 (提示词文件, 结果字段, 输出文件, 表头, agent 类)
+BATCH_STAGES = {
+    "sentiment": (SENTIMENT_PROMPT, ("sentiment",), SENTIMENT_OUTPUT, ["编号", "微博正文", "sentiment"],
+                  SentimentAnalysistAgent),
+    "topic": (TOPIC_PROMPT, ("topics",), TOPIC_OUTPUT, ["编号", "微博正文", "topics"], TopicModellingAgent),
+}
+
+
+def batch_paths(stage, batch_file=None):
+    """批处理模式的文件名：(请求文件, 清单文件, 结果文件, 进度文件)，默认为 batch_requests_<阶段>.jsonl 及其同名文件。"""
+    batch_file = batch_file or f"batch_requests_{stage}.jsonl"
+    base = os.path.splitext(batch_file)[0]
+    return batch_file, base + "_manifest.jsonl", base + "_results.jsonl", base + "_state.json"
+
+
+def stage_query(stage, chunk, topics=None):
+    """拼接某个阶段对一个批次（已编号）的 query。"""
+    return sentiment_query(chunk) if stage == "sentiment" else topic_query(chunk, topics)
+
+
+def emit_batch_requests(csv_file, stage="sentiment", batch_file=None, model=None, topics=(),
+                        near_duplicates=True, token_budget=TOKEN_BUDGET, max_entries=MAX_ENTRIES):
+    """
+    批处理模式第一步：把 csv_file 的所有批次请求写成 OpenAI Batch API 格式的 JSONL 请求文件
+    （每行一个请求，custom_id 为 “阶段-批次号”），同时写出清单文件，记录每个批次包含的微博（CSV 中的行号）
+    和近似重复关系，供 ingest_batch_results 把结果写回。分批和近似重复折叠与 perform_*_analysis 相同。
+    主题分析阶段的请求同时生成，query 中的主题列表只来自 topics（例如之前分析得到的主题），不随批次更新。
+    model 为 None 时使用该阶段 agent 配置的模型（见 Agents.AGENT_MODELS）。
+    同名的写回进度文件属于上一个批处理任务，会被删除。返回请求文件名。
+    """
+    prompt_file, agent_class = BATCH_STAGES[stage][0], BATCH_STAGES[stage][4]
+    model = model or model_for(agent_class)
+    batch_file, manifest_file, _, state_file = batch_paths(stage, batch_file)
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    system_prompt = load_prompt(prompt_file)
+    registry = TopicRegistry(topics)
+    df = pd.read_csv(csv_file, encoding='utf-8')
+    df['序号'] = range(len(df))
+    df['代表序号'] = df['序号']
+    index = NearDuplicateIndex() if near_duplicates else None
+
+    requests_count = 0
+    with open(batch_file, "w", encoding="utf-8") as requests_out, \
+            open(manifest_file, "w", encoding="utf-8") as manifest_out:
+        batches = pack_batches(mark_near_duplicates([df], index), token_budget, max_entries)
+        for number, chunk in enumerate(batches):
+            sent = [i for i, needed in enumerate(needs_llm(chunk)) if needed]
+            # 整批都是近似重复时不需要请求，写回时直接取簇代表的结果
+            custom_id = f"{stage}-{number:06d}" if sent else None
+            if sent:
+                query = stage_query(stage, number_chunk(chunk.iloc[sent]), registry)
+                request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_URL,
+                    "body": {
+                        "model": model,
+                        "messages": [{"role": "system", "content": system_prompt},
+                                     {"role": "user", "content": query}],
+                    },
+                }
+                requests_out.write(json.dumps(request, ensure_ascii=False) + "\n")
+                requests_count += 1
+            manifest_out.write(json.dumps({
+                "custom_id": custom_id,
+                "model": model,
+                "rows": [int(seq) for seq in chunk['序号']],
+                "reps": [int(rep) for rep in chunk['代表序号']],
+            }) + "\n")
+    if index is not None:
+        index.report()
+    print(f"已写出 {requests_count} 个批处理请求：{batch_file}（清单：{manifest_file}）")
+    return batch_file
+
+
+def batch_reply(result):
+    """取出 Batch API 结果文件中一行的回复内容；请求失败（error 或非 200）时返回空字符串。"""
+    response = result.get("response") or {}
+    if result.get("error") or response.get("status_code") != 200:
+        return ""
+    try:
+        return response["body"]["choices"][0]["message"]["content"] or ""
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def read_batch_results(results_file):
+    """读取 Batch API 结果文件，返回 custom_id -> 回复内容；无法解析的行跳过。"""
+    replies = {}
+    with open(results_file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(result, dict) and result.get("custom_id"):
+                replies[result["custom_id"]] = batch_reply(result)
+    return replies
+
+
+def manifest_digest(manifest_file):
+    """清单文件内容的 SHA-256，用于确认写回进度属于同一个批处理任务。"""
+    with open(manifest_file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def ingest_batch_results(csv_file, stage="sentiment", results_file=None, batch_file=None,
+                         cache_file=LLM_CACHE_FILE, online_repair=True):
+    """
+    批处理模式第二步：按清单顺序把 Batch API 的结果文件写回与 perform_*_analysis 相同的输出 CSV，并累计统计。
+    可以反复运行：进度文件记录已写回的批次数、输出行数、统计、主题词表和近似重复簇代表的结果，
+    再次运行时先把输出 CSV 截回到上次保存的进度，再从第一个未写回的批次继续；
+    进度文件同时记录清单的哈希和 csv_file，与本次不一致（属于另一个批处理任务）时忽略旧进度，从头写回；
+    遇到结果文件中还没有的批次（例如结果只下载了一部分）就停下，等结果齐了再运行。
+    回复中缺失或无效的条目按 request_analyses 的补发逻辑在线补齐，online_repair 为 False 时留空。
+    有效结果写入 LLM 缓存（cache_file 为 None 时不使用缓存）。
+    返回 (统计字典, 输出文件名, 是否已全部写回)；情感分析阶段的统计为情感计数，主题分析阶段为每个主题的讨论量。
+    """
+    prompt_file, fields, output_file, header, agent_class = BATCH_STAGES[stage]
+    batch_file, manifest_file, default_results, state_file = batch_paths(stage, batch_file)
+    replies = read_batch_results(results_file or default_results)
+    with open(manifest_file, encoding="utf-8") as f:
+        manifest = [json.loads(line) for line in f if line.strip()]
+    df = pd.read_csv(csv_file, encoding='utf-8')
+    job = {"manifest": manifest_digest(manifest_file), "csv_file": os.path.abspath(csv_file)}
+
+    state = None
+    if os.path.exists(state_file):
+        with open(state_file, encoding="utf-8") as f:
+            state = json.load(f)
+        if any(state.get(key) != value for key, value in job.items()):
+            print(f"进度文件 {state_file} 属于另一个批处理任务（清单或 CSV 文件不同），忽略旧进度，从头写回")
+            state = None
+    if state is not None:
+        # 截掉上次保存进度之后写出的行，这些批次会重新写回
+        pd.read_csv(output_file, encoding="utf-8").iloc[:state["rows"]].to_csv(output_file, index=False)
+    else:
+        init_output_file(output_file, header)
+        state = {
+            **job,
+            "ingested": 0,
+            "rows": len(pd.read_csv(output_file, encoding="utf-8")),
+            "counts": {"positive": 0, "neutral": 0, "negative": 0} if stage == "sentiment" else {},
+            "labels": {},
+            "topics": TopicRegistry().state(),
+        }
+    counts = state["counts"]
+    labels = {int(rep): item for rep, item in state["labels"].items()}
+    topics = TopicRegistry.from_state(state["topics"])
+    system_prompt = load_prompt(prompt_file)
+    cache = open_llm_cache(cache_file)
+    agents = []
+
+    def save_state():
+        state["counts"] = counts
+        state["labels"] = {str(rep): item for rep, item in labels.items()}
+        state["topics"] = topics.state()
+        _write_json_atomic(state_file, state)
+
+    def ask_online(sub_chunk, model):
+        if not online_repair:
+            raise LLMTransientError("批处理结果缺失或无效，未开启在线补发")
+        if not agents:
+            agents.append(agent_class(prompt_file, model=model))
+        return agents[0].run(stage_query(stage, sub_chunk, topics))
+
+    try:
+        with tqdm(total=len(manifest), initial=state["ingested"], desc="Ingesting batches") as progress:
+            for entry in manifest[state["ingested"]:]:
+                custom_id = entry["custom_id"]
+                if custom_id is not None and custom_id not in replies:
+                    print(f"结果文件中还没有 {custom_id}，已写回 {state['ingested']}/{len(manifest)} 个批次")
+                    break
+                chunk = number_chunk(df.iloc[entry["rows"]])
+                chunk['序号'] = entry["rows"]
+                chunk['代表序号'] = entry["reps"]
+                pending = [replies.get(custom_id)]
+
+                def ask(sub_chunk):
+                    # 第一次取批处理的回复，之后（补发缺失或无效的条目）在线请求
+                    reply = pending.pop() if pending else None
+                    return reply if reply is not None else ask_online(sub_chunk, entry["model"])
+
+                analyses = request_analyses(chunk, None, ask, fields)
+                if cache is not None:
+                    cache.put_many(entry["model"], system_prompt,
+                                   [(text, item) for text, item, needed
+                                    in zip(chunk['微博正文'], analyses, needs_llm(chunk)) if needed and item])
+                if stage == "sentiment":
+                    apply_sentiment_result(chunk, analyses, counts, output_file, labels)
+                else:
+                    apply_topic_result(chunk, analyses, topics, counts, output_file, labels)
+                state["ingested"] += 1
+                state["rows"] += len(chunk)
+                progress.update(1)
+                if state["ingested"] % BATCH_STATE_EVERY == 0:
+                    save_state()
+    finally:
+        save_state()
+        close_llm_cache(cache)
+
+    complete = state["ingested"] == len(manifest)
+    print(f"{'全部' if complete else '部分'}写回完成：{state['ingested']}/{len(manifest)} 个批次")
+    print("统计:", counts)
+    return counts, output_file, complete
+
+
+def fabricate_batch_results(batch_file, results_file=None, reply=None):
+    """
+    批处理结果的本地替身（不调用 LLM，用于测试写回流程）：为请求文件中的每个请求伪造一条 Batch API 格式的结果。
+    reply(custom_id, body) 返回伪造的回复内容，默认用 MockBackend 按消息内容确定性地生成（带 id 的逐条结果，
+    主题优先从 query 中的主题列表里选）。返回结果文件名。
+    """
+    results_file = results_file or batch_paths(None, batch_file)[2]
+    mock = MockBackend()
+    reply = reply or (lambda custom_id, body: mock.reply(body["messages"]))
+    with open(batch_file, encoding="utf-8") as requests_in, open(results_file, "w", encoding="utf-8") as out:
+        for number, line in enumerate(requests_in):
+            request = json.loads(line)
+            content = reply(request["custom_id"], request["body"])
+            out.write(json.dumps({
+                "id": f"batch_req_{number:06d}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": {
+                    "model": request["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                 "finish_reason": "stop"}],
+                }},
+                "error": None,
+            }, ensure_ascii=False) + "\n")
+    return results_file
+
+
+def _iter_queue(q):
+    """逐个取出队列中的元素，遇到 None 结束。"""
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        yield item
+
+
+def _run_stage(name, q, request, apply_result, errors, token_budget, max_entries, max_in_flight, index=None,
+               prepare=None):
+    """
+    流式流水线中的一个分析阶段：从队列中取出新爬到的微博，凑满一批（见 pack_batches）就发出请求（request），
+    最多 max_in_flight 个请求同时进行，结果按原始顺序交给 apply_result；给定 index 时折叠近似重复，
+    给定 prepare 时先用它处理数据流（例如 classify_locally）。
+    出错时记录异常并继续清空队列，避免上游因队列满而永久阻塞。
+    """
+    try:
+        frames = mark_near_duplicates(_iter_queue(q), index)
+        if prepare is not None:
+            frames = prepare(frames)
+        chunks = pack_batches(frames, token_budget, max_entries)
+        run_ordered(request, chunks, apply_result, max_in_flight)
+    except Exception as e:
+        print(f"{name}阶段出错：{e}")
+        errors.append(e)
+        for _ in _iter_queue(q):
+            pass
+
+
+def run_streaming_pipeline(year, month, day, keywords, token_budget=TOKEN_BUDGET, max_entries=MAX_ENTRIES,
+                           max_pending=8, max_in_flight=MAX_IN_FLIGHT, cache_file=LLM_CACHE_FILE,
+                           near_duplicates=True, fused=False, classifier=None, confidence=None,
+                           matcher=None, **crawl_kwargs):
+    """
+    流式流水线：爬虫每写出一个时间段的微博，就立即分发给情感分析和主题分析两个阶段，
+    两个阶段各在自己的线程中凑满一批（见 pack_batches）即调用 LLM（每个阶段最多 max_in_flight 个请求同时进行），
+    不必等整天爬完、也不经过 CSV 中转，端到端耗时接近 max(爬取, 分析) 而不是两者之和。
+    阶段之间用有界队列（最多 max_pending 个待处理的时间段）连接，分析跟不上时爬虫阻塞等待（背压）。
+    两个阶段共用 cache_file 指定的 LLM 结果缓存（None 表示不使用）；near_duplicates 同 perform_sentiment_analysis。
+    fused 为 True 时只有一个融合阶段（见 perform_fused_analysis），直接写出合并表。
+    classifier 和 confidence 用于情感分析阶段的本地分类器（见 perform_sentiment_analysis），
+    matcher 用于主题分析阶段的本地主题匹配（见 perform_topic_analysis），融合模式下都不使用。
+    crawl_kwargs 会传给 run_weibo_crawl（例如 max_workers、min_interval）。
+
+    返回 (csv_file, sentiment_counts, sentiment_output, topic_counts, topic_output)，
+    与先后调用 run_weibo_crawl、perform_sentiment_analysis、perform_topic_analysis 的结果一致；
+    融合模式下 sentiment_output 和 topic_output 都是合并表。
+    """
+    check_max_in_flight(max_in_flight)
+    sentiment_counts = {"positive": 0, "neutral": 0, "negative": 0}
+    topics = TopicRegistry()
+    topic_counts = {}
+    errors = []
+    cache = open_llm_cache(cache_file)
+
+    # 每个阶段：(名称, 请求函数, 写出函数, 预处理)；各阶段独立地折叠近似重复，各自记录簇代表的结果
+    if fused:
+        init_output_file(FUSED_OUTPUT, ["编号", "微博正文", "topics", "sentiment"])
+        fused_agent = FusedAnalysisAgent(FUSED_PROMPT)
+        fused_labels = {}
+        stage_specs = [(
+            "融合分析",
+            lambda chunk: request_fused(chunk, topics, fused_agent, cache),
+            lambda chunk, analyses: apply_fused_result(chunk, analyses, sentiment_counts, topics, topic_counts,
+                                                       FUSED_OUTPUT, fused_labels),
+            None,
+        )]
+        sentiment_output = topic_output = FUSED_OUTPUT
+    else:
+        init_output_file(SENTIMENT_OUTPUT, ["编号", "微博正文", "sentiment"])
+        init_output_file(TOPIC_OUTPUT, ["编号", "微博正文", "topics"])
+        sentiment_agent = SentimentAnalysistAgent(SENTIMENT_PROMPT)
+        topic_agent = TopicModellingAgent(TOPIC_PROMPT)
+        classifier = load_classifier(classifier)
+        sentiment_labels = {}
+        topic_labels = {}
+        stage_specs = [(
+            "情感分析",
+            lambda chunk: request_sentiment(chunk, sentiment_agent, cache),
+            lambda chunk, analyses: apply_sentiment_result(chunk, analyses, sentiment_counts, SENTIMENT_OUTPUT,
+                                                           sentiment_labels),
+            lambda frames: classify_locally(frames, classifier, confidence),
+        ), (
+            "主题分析",
+            lambda chunk: request_topics(chunk, topics, topic_agent, cache),
+            lambda chunk, analyses: (apply_topic_result(chunk, analyses, topics, topic_counts, TOPIC_OUTPUT,
+                                                        topic_labels),
+                                     learn_topics(matcher, chunk, analyses, topics)),
+            lambda frames: match_topics_locally(frames, matcher),
+        )]
+        sentiment_output, topic_output = SENTIMENT_OUTPUT, TOPIC_OUTPUT
+
+    queues = [queue.Queue(maxsize=max_pending) for _ in stage_specs]
+    indexes = [NearDuplicateIndex() if near_duplicates else None for _ in stage_specs]
+    stages = [
+        threading.Thread(target=_run_stage, args=(name, q, request, apply_result, errors, token_budget,
+                                                  max_entries, max_in_flight, index, prepare))
+        for (name, request, apply_result, prepare), q, index in zip(stage_specs, queues, indexes)
+    ]
+    for stage in stages:
+        stage.start()
+
+    def on_write(df):
+        if not df.empty:
+            for q in queues:
+                q.put(df)
+
+    try:
+        csv_file = run_weibo_crawl(year, month, day, keywords, on_write=on_write, **crawl_kwargs)
+    finally:
+        # 通知各阶段数据已经结束，等待它们处理完剩余数据
+        for q in queues:
+            q.put(None)
+        for stage in stages:
+            stage.join()
+        close_llm_cache(cache)
+    if errors:
+        raise errors[0]
+    # 各阶段独立折叠近似重复，分别报告
+    for (name, _, _, _), index in zip(stage_specs, indexes):
+        if index is not None:
+            print(f"{name}阶段：", end="")
+            index.report()
+    if matcher is not None and not fused:
+        matcher.report()
+
+    print("累计情感统计:", sentiment_counts)
+    print("每个主题的讨论量:", topic_counts)
+    return csv_file, sentiment_counts, sentiment_output, topic_counts, topic_output
+
+
 def summarize_sentiment_event(event_keywords, sentiment_counts):
     """
     根据事件关键字和累积情感统计生成总结的 prompt，